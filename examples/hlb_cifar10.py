@@ -9,7 +9,7 @@ from tinygrad import nn
 from tinygrad.state import get_parameters
 from tinygrad.nn import optim
 from tinygrad.tensor import Tensor
-from tinygrad.helpers import getenv
+from tinygrad.helpers import getenv, dtypes
 from tinygrad.ops import GlobalCounters
 from extra.lr_scheduler import OneCycleLR
 from tinygrad.jit import TinyJit
@@ -93,8 +93,12 @@ def train_cifar(bs=512, eval_bs=500, steps=1000, div_factor=1e16, final_lr_ratio
   else:
     X_train, Y_train = fetch_cifar(train=True)
     X_test, Y_test = fetch_cifar(train=False)
+  # HALF=1 or BF16=1 trains in float16 or bfloat16, the optimizer keeps float32 master weights and scales the loss by LOSS_SCALE
+  dtype = dtypes.float16 if getenv("HALF") else dtypes.bfloat16 if getenv("BF16") else dtypes.float32
+  Tensor.default_type = dtype
   model = SpeedyResNet()
-  optimizer = optim.SGD(get_parameters(model), lr=0.01, momentum=MOMENTUM, nesterov=True, weight_decay=WD)
+  Tensor.default_type = dtypes.float32
+  optimizer = optim.SGD(get_parameters(model), lr=0.01, momentum=MOMENTUM, nesterov=True, weight_decay=WD, loss_scale=getenv("LOSS_SCALE", 2.0**16) if dtype != dtypes.float32 else None)
   lr_scheduler = OneCycleLR(optimizer, max_lr=MAX_LR, div_factor=DIV_FACTOR, final_div_factor=FINAL_DIV_FACTOR,
                             total_steps=STEPS, pct_start=PCT_START)
 
@@ -103,18 +107,18 @@ def train_cifar(bs=512, eval_bs=500, steps=1000, div_factor=1e16, final_lr_ratio
   def train_step_jitted(model, optimizer, lr_scheduler, Xr, Xl, Yr, Yl, mixup_prob):
     X, Y = Xr*mixup_prob + Xl*(1-mixup_prob), Yr*mixup_prob + Yl*(1-mixup_prob)
     X = Tensor.where(Tensor.rand(X.shape[0],1,1,1) < 0.5, X[..., ::-1], X) # flip augmentation
-    out = model(X)
+    out = model(X.cast(dtype)).cast(dtypes.float32)
     loss = (1 - LABEL_SMOOTHING) * out.mul(Y).mean() + (-1 * LABEL_SMOOTHING * out.mean())
     if not getenv("DISABLE_BACKWARD"):
       optimizer.zero_grad()
-      loss.backward()
+      optimizer.scale(loss).backward()
       optimizer.step()
       lr_scheduler.step()
     return loss.realize()
 
   @TinyJit
   def eval_step_jitted(model, X, Y):
-    out = model(X, training=False)
+    out = model(X.cast(dtype), training=False).cast(dtypes.float32)
     loss = out.mul(Y).mean()
     return out.realize(), loss.realize()
 
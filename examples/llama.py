@@ -15,8 +15,10 @@ from tinygrad.helpers import Timing, getenv, DEBUG, dtypes
 from tinygrad.lazy import Device
 from tinygrad.tensor import Tensor
 from tinygrad.nn import Embedding, Linear
+from tinygrad.nn.quant import QuantizedLinear, quantize_state_dict
 from tinygrad.ops import GlobalCounters
 from tinygrad.jit import TinyJit
+from tinygrad.state import disk_cat
 
 # https://github.com/facebookresearch/llama/blob/1076b9c51c77ad06e9d7ba8a4c6df775741732bd/llama/model.py#L47
 def precompute_freqs_cis(dim: int, end: int, theta: float = 10000.0):
@@ -51,8 +53,8 @@ class RMSNorm:
     return (x * (x.pow(2).mean(-1, keepdim=True) + self.eps).rsqrt()) * self.weight
 
 class Attention:
-  def __init__(self, dim, n_heads):
-    self.wq, self.wk, self.wv, self.wo = [Linear(dim, dim, bias=False) for _ in range(4)]
+  def __init__(self, dim, n_heads, linear=Linear):
+    self.wq, self.wk, self.wv, self.wo = [linear(dim, dim, bias=False) for _ in range(4)]
     self.n_heads = n_heads
     self.head_dim = dim // n_heads
 
@@ -92,21 +94,21 @@ class Attention:
     return self.wo(output)
 
 class FeedForward:
-  def __init__(self, dim, hidden_dim, multiple_of):
+  def __init__(self, dim, hidden_dim, multiple_of, linear=Linear):
     # TODO: what is this?
     hidden_dim = int(2 * hidden_dim / 3)
     hidden_dim = multiple_of * ((hidden_dim + multiple_of - 1) // multiple_of)
-    self.w1 = Linear(dim, hidden_dim, bias=False)
-    self.w2 = Linear(hidden_dim, dim, bias=False)
-    self.w3 = Linear(dim, hidden_dim, bias=False)
+    self.w1 = linear(dim, hidden_dim, bias=False)
+    self.w2 = linear(hidden_dim, dim, bias=False)
+    self.w3 = linear(dim, hidden_dim, bias=False)
 
   def __call__(self, x:Tensor) -> Tensor:
     return self.w2(self.w1(x).silu() * self.w3(x))
 
 class TransformerBlock:
-  def __init__(self, dim, multiple_of, n_heads, norm_eps):
-    self.attention = Attention(dim, n_heads)
-    self.feed_forward = FeedForward(dim, 4*dim, multiple_of)
+  def __init__(self, dim, multiple_of, n_heads, norm_eps, linear=Linear):
+    self.attention = Attention(dim, n_heads, linear)
+    self.feed_forward = FeedForward(dim, 4*dim, multiple_of, linear)
     self.attention_norm = RMSNorm(dim, norm_eps)
     self.ffn_norm = RMSNorm(dim, norm_eps)
     if getenv("JIT"):
@@ -130,11 +132,11 @@ class TransformerBlock:
     return self._post(x, output)
 
 class Transformer:
-  def __init__(self, dim, multiple_of, n_heads, n_layers, norm_eps, vocab_size, max_batch_size=32, max_seq_len=1024):
-    self.layers = [TransformerBlock(dim, multiple_of, n_heads, norm_eps) for _ in range(n_layers)]
+  def __init__(self, dim, multiple_of, n_heads, n_layers, norm_eps, vocab_size, max_batch_size=32, max_seq_len=1024, linear=Linear):
+    self.layers = [TransformerBlock(dim, multiple_of, n_heads, norm_eps, linear) for _ in range(n_layers)]
     self.norm = RMSNorm(dim, norm_eps)
     self.tok_embeddings = Embedding(vocab_size, dim)
-    self.output = Linear(dim, vocab_size, bias=False)
+    self.output = linear(dim, vocab_size, bias=False)
     self.freqs_cis = Tensor(precompute_freqs_cis(dim // n_heads, max_seq_len * 2))
 
   def __call__(self, tokens:Tensor, start_pos:int):
@@ -178,20 +180,17 @@ def sample(logits, temperature):
     probs = probs.numpy().flatten()
     return int(np.random.choice(len(probs), p=probs))
 
+# the axis the model parallel checkpoints are split on, the norms aren't split
+def split_axis(name, shape):
+  if len(shape) == 1: return None
+  return 1 if name.startswith('tok_embeddings.') or name.endswith('.attention.wo.weight') or name.endswith('.feed_forward.w2.weight') else 0
+
 def concat_weights(models):
   def convert(name) -> Tensor:
     disk_tensors = [model[name] for model in models]
-    if len(disk_tensors) == 1:
-      return disk_tensors[0]
-    if len(disk_tensors[0].shape) == 1:
+    if len(disk_tensors) == 1 or (axis := split_axis(name, disk_tensors[0].shape)) is None:
       return disk_tensors[0]
-    if name.startswith('tok_embeddings.') or name.endswith('.attention.wo.weight') or name.endswith('.feed_forward.w2.weight'):
-      axis = 1
-    else:
-      axis = 0
-    lazy_tensors = [data.to(device=Device.DEFAULT) for data in disk_tensors]
-    first, rest = lazy_tensors[0], lazy_tensors[1:]
-    return first.cat(*rest, dim=axis)
+    return disk_cat(disk_tensors, axis, Device.DEFAULT)
   return {name: convert(name) for name in {name: None for model in models for name in model}}
 
 # **** main code ****
@@ -214,30 +213,25 @@ if __name__ == "__main__":
   parser.add_argument('--timing', action='store_true', help="Print timing per token")
   parser.add_argument('--profile', action='store_true', help="Output profile data to out.prof")
   parser.add_argument('--size', type=str, default="7B", help="Size of model to use [7B, 13B, 30B, 65B]")
+  parser.add_argument('--quantize', type=str, default=None, help="Quantize the linear weights as they are loaded [int8, int4]")
+  parser.add_argument('--shard', action='store_true', help="Write the weights as sharded safetensors with an index next to the .pth files")
 
   args = parser.parse_args()
   chatbot = args.prompt == None
 
-  from tinygrad.state import torch_load, load_state_dict
-  if args.size == "65B":
-    print("using 65B model")
-    model = Transformer(**args_65B)
-    weights = [torch_load(filename) for filename in WEIGHTS_65B_FILENAMES]
-    load_state_dict(model, concat_weights(weights), strict=False)
-  elif args.size == "30B":
-    print("using 30B model")
-    model = Transformer(**args_30B)
-    weights = [torch_load(filename) for filename in WEIGHTS_30B_FILENAMES]
-    load_state_dict(model, concat_weights(weights), strict=False)
-  elif args.size == "13B":
-    print("using 13B model")
-    model = Transformer(**args_13B)
-    weights = [torch_load(filename) for filename in WEIGHTS_13B_FILENAMES]
-    load_state_dict(model, concat_weights(weights), strict=False)
+  from tinygrad.state import torch_load, load_state_dict, safe_save_sharded, safe_load_sharded
+  linear = functools.partial(QuantizedLinear, qtype=args.quantize) if args.quantize else Linear
+  model_args, filenames = {"65B": (args_65B, WEIGHTS_65B_FILENAMES), "30B": (args_30B, WEIGHTS_30B_FILENAMES), "13B": (args_13B, WEIGHTS_13B_FILENAMES)}.get(args.size, (args_7B, [WEIGHTS_7B_FILENAME]))
+  print(f"using {args.size} model")
+  model = Transformer(**model_args, linear=linear)
+  # a sharded safetensors checkpoint with an index is used if it's there, --shard writes one from the .pth files
+  index = filenames[0].parent / "model.safetensors.index.json"
+  if index.exists():
+    weights = safe_load_sharded(str(index))
   else:
-    print("using 7B model")
-    model = Transformer(**args_7B)
-    load_state_dict(model, torch_load(WEIGHTS_7B_FILENAME), strict=False)
+    weights = concat_weights([torch_load(filename) for filename in filenames])
+    if args.shard: safe_save_sharded(weights, str(index), splits={k:split_axis(k, v.shape) for k,v in weights.items()}, parts=len(filenames))
+  load_state_dict(model, quantize_state_dict(model, weights) if args.quantize else weights, strict=False)
 
   # *** prompt engineers work here ****
 
@@ -0,0 +1,19 @@
+# the timing and memory helpers of the test/external/external_benchmark_*.py scripts
+import time, pathlib
+from typing import Callable, Tuple, Any
+from tinygrad.lazy import Device
+
+# the best of cnt runs of fxn in ms, the device is synchronized after each one. the result of the last run is returned with it
+def bench(fxn:Callable[[], Any], cnt:int) -> Tuple[Any, float]:
+  ret, tms = None, []
+  for _ in range(cnt):
+    st = time.perf_counter()
+    ret = fxn()
+    Device[Device.DEFAULT].synchronize()
+    tms.append(time.perf_counter()-st)
+  return ret, min(tms)*1e3
+
+# a memory counter of this process from /proc/self/status in GB, like VmRSS, RssAnon or RssFile
+def rss(key="VmRSS") -> float:
+  status = dict(l.split(":", 1) for l in pathlib.Path("/proc/self/status").read_text().splitlines())
+  return int(status[key].split()[0])/1e6
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+# compile only profiling of the models. the kernels are generated and compiled for a real device (CLANG=1, LLVM=1, ...) but the FAKE device never runs them
+#   CLANG=1 python3 extra/compile_profile.py resnet50 efficientnet --log /tmp/compile.jsonl
+#   python3 extra/compile_profile.py --summary /tmp/compile.jsonl
+import os, sys, json, time, argparse
+from collections import defaultdict
+
+def summarize(fn:str, top:int=10):
+  recs = [json.loads(l) for l in open(fn) if l.strip()]
+  if not recs: return print(f"no kernels in {fn}")
+  total = sum(r["total_ms"] for r in recs)
+  stages = defaultdict(list)
+  for r in recs:
+    for k,v in r["stages_ms"].items(): stages[k].append((v, r["name"]))
+    stages["other"].append((r["total_ms"]-sum(r["stages_ms"].values()), r["name"]))
+  print(f"{len(recs)} kernels compiled in {total:.2f} ms")
+  for k,v in sorted(stages.items(), key=lambda x: -sum(y[0] for y in x[1])):
+    tm, mx = sum(x[0] for x in v), max(v)
+    print(f"  {k:26s} {tm:10.2f} ms {100*tm/total:5.1f}%   mean {tm/len(v):8.3f} ms   max {mx[0]:8.2f} ms {mx[1]}")
+  print(f"slowest {top} kernels")
+  for r in sorted(recs, key=lambda r: -r["total_ms"])[:top]:
+    print(f"  {r['name']:40s} {r['total_ms']:8.2f} ms  " + " ".join(f"{k}:{v:.2f}" for k,v in sorted(r["stages_ms"].items(), key=lambda x: -x[1])[:3]))
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="per stage compile time of the kernels of a model", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument("models", nargs="*", default=["resnet18"], help="resnet18, resnet50, efficientnet, vit")
+  parser.add_argument("--log", default="/tmp/compile.jsonl", help="json lines file to write, COMPILE_LOG overrides it")
+  parser.add_argument("--bs", type=int, default=1, help="batch size")
+  parser.add_argument("--summary", help="only summarize this json lines file")
+  args = parser.parse_args()
+  if args.summary: sys.exit(summarize(args.summary))
+
+  # the compile log has to be set before tinygrad is imported
+  os.environ["COMPILE_LOG"] = log = os.getenv("COMPILE_LOG", args.log)
+  if os.path.exists(log): os.remove(log)
+  from tinygrad.tensor import Tensor
+  from tinygrad.lazy import Device
+  from tinygrad.ops import Compiled
+  from tinygrad.state import get_state_dict
+  from tinygrad.runtime.ops_fake import FakeProgram
+  from models.resnet import ResNet
+  from models.efficientnet import EfficientNet
+  from models.vit import ViT
+
+  device = Device.DEFAULT
+  assert isinstance(Device[device], Compiled), f"{device} doesn't compile kernels"
+  # use the codegen and the compiler of the real device, but never run anything
+  Device.DEFAULT = "FAKE"
+  Device["FAKE"].codegen = Device[device].codegen
+  Device["FAKE"].runtime = lambda name, prg, **kwargs: (Device[device].runtime(name, prg, **kwargs), FakeProgram(name, prg))[1]
+
+  models = {"resnet18": (lambda: ResNet(18, 1000), (3,224,224)), "resnet50": (lambda: ResNet(50, 1000), (3,224,224)),
+            "efficientnet": (lambda: EfficientNet(0), (3,224,224)), "vit": (lambda: ViT(), (3,224,224))}
+  for name in args.models:
+    fxn, shape = models[name]
+    model = fxn()
+    for v in get_state_dict(model).values(): v.assign(Tensor.empty(*v.shape, dtype=v.dtype))
+    st = time.perf_counter()
+    model.forward(Tensor.empty(args.bs, *shape)).realize()
+    print(f"{name}: {time.perf_counter()-st:.2f} s on {device}")
+  summarize(log)
@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+# load time, memory and decode speed of the LLaMA model from examples/llama.py with float32 and bfloat16 weights, each in a fresh process
+#   CLANG=1 python3 test/external/external_benchmark_bf16.py
+# DIM and LAYERS set the size of the model (random weights, the default is 0.7 GB in float32), TOKENS the number of tokens decoded
+import time, sys, os, subprocess
+import numpy as np
+from tinygrad.tensor import Tensor
+from tinygrad.state import safe_save, safe_load, get_state_dict, load_state_dict
+from tinygrad.lazy import Device
+from tinygrad.helpers import getenv, dtypes
+from examples.llama import Transformer, args_small
+from extra.bench import rss
+
+DIM, LAYERS, TOKENS = getenv("DIM", 1024), getenv("LAYERS", 8), getenv("TOKENS", 16)
+model_args = {**args_small, "dim": DIM, "n_layers": LAYERS, "n_heads": DIM//64}
+def fn(dtype): return f"/tmp/llama_{DIM}_{LAYERS}_{dtype}.safetensors"
+
+if __name__ == "__main__":
+  Tensor.no_grad = True
+  if len(sys.argv) == 2:
+    model = Transformer(**model_args)
+    weights = safe_load(fn(sys.argv[1]))
+    # the weights stay in the dtype of the file, the math is in float32
+    for k,v in get_state_dict(model).items(): v.lazydata = Tensor.empty(*v.shape, dtype=weights[k].dtype).lazydata
+    st = time.perf_counter()
+    load_state_dict(model, weights)
+    lt = time.perf_counter()-st
+    toks = [1]
+    model(Tensor([toks]), 0).realize()  # warm up, the kernels are compiled here
+    st = time.perf_counter()
+    for i in range(TOKENS): toks.append(int(model(Tensor([toks[-1:]]), len(toks)-1).numpy().argmax()))
+    print(f"{lt:.3f} {TOKENS/(time.perf_counter()-st):.2f} {rss():.2f} {toks[-1]}")
+  else:
+    if not os.path.exists(fn("float32")):
+      model = Transformer(**model_args)
+      for v in get_state_dict(model).values(): v.assign(Tensor((np.random.randn(*v.shape) / np.sqrt(v.shape[-1])).astype(np.float32)))
+      safe_save(get_state_dict(model), fn("float32"))
+    # the rotary embedding table stays float32
+    if not os.path.exists(fn("bfloat16")): safe_save({k:v.to(Device.DEFAULT).cast(dtypes.bfloat16) if k.endswith("weight") else v for k,v in safe_load(fn("float32")).items()}, fn("bfloat16"))
+    for dtype in ["float32", "bfloat16"]:
+      lt, tps, mem, last = subprocess.check_output([sys.executable, __file__, dtype], env={**os.environ, "PYTHONPATH": "."}).decode().splitlines()[-1].split()
+      print(f"{Device.DEFAULT:6s} {dtype:8s}: file {os.path.getsize(fn(dtype))/1e9:5.2f} GB   load {float(lt):6.2f} s   {float(tps):6.2f} tok/s   RSS {float(mem):5.2f} GB   last token {last}")
@@ -0,0 +1,32 @@
+#!/usr/bin/env python
+# reading sub-blocks of a large matrix on disk, the view on the DISK tensor vs reading all of it and slicing on the device
+#   CLANG=1 python3 test/external/external_benchmark_disk_view.py
+# N sets the size of the NxN float32 matrix, the default is 1 GB
+import time, os
+import numpy as np
+from tinygrad.tensor import Tensor
+from tinygrad.lazy import Device
+from tinygrad.helpers import getenv
+
+N = getenv("N", 16384)
+
+if __name__ == "__main__":
+  fn = f"/tmp/disk_view_{N}.bin"
+  if not os.path.exists(fn) or os.path.getsize(fn) != N*N*4:
+    with open(fn, "wb") as f:
+      for i in range(0, N, 1024): f.write(np.random.rand(min(1024, N-i), N).astype(np.float32).tobytes())
+  with open(fn, "rb") as f:
+    while f.read(1<<24): pass   # everything starts with the file in the page cache
+  t = Tensor.empty(N, N, device=f"disk:{fn}")
+  blocks = {"column block": lambda x: x[:, N//2:N//2+N//16], "row block": lambda x: x[N//2:N//2+N//16], "tile": lambda x: x[N//4:N//4+512, N//4:N//4+512],
+            "strided": lambda x: x[::16, ::16], "transposed tile": lambda x: x[N//4:N//4+512, N//4:N//4+512].permute(1, 0)}
+  for name,fxn in blocks.items():
+    st = time.perf_counter()
+    view = fxn(t).to(Device.DEFAULT).realize()
+    vt = time.perf_counter()-st
+    st = time.perf_counter()
+    full = fxn(t.to(Device.DEFAULT)).realize()
+    ft = time.perf_counter()-st
+    np.testing.assert_equal(view.numpy(), full.numpy())
+    print(f"{Device.DEFAULT:6s} {name:16s} {view.nbytes()/1e6:8.2f} MB: view {vt*1e3:9.2f} ms   full read {ft*1e3:9.2f} ms")
+    del full
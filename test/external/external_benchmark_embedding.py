@@ -0,0 +1,26 @@
+#!/usr/bin/env python
+# nn.Embedding lookup with the gather against the one-hot matmul it replaces, the LLaMA vocab and dim by default
+#   CLANG=1 python3 test/external/external_benchmark_embedding.py
+# VOCAB and DIM set the size of the table, TOKENS the number of indices, CNT the number of runs, the best one is reported
+import numpy as np
+from tinygrad.tensor import Tensor
+from tinygrad.nn import Embedding
+from tinygrad.lazy import Device
+from tinygrad.helpers import getenv
+from extra.bench import bench
+
+VOCAB, DIM, CNT = getenv("VOCAB", 32000), getenv("DIM", 4096), getenv("CNT", 5)
+
+def onehot(emb:Embedding, idx:Tensor) -> Tensor:
+  vocab_counter = Tensor.arange(emb.vocab_size, requires_grad=False).reshape(1, 1, emb.vocab_size).expand(*idx.shape, emb.vocab_size)
+  return (vocab_counter == idx.unsqueeze(2).expand(*idx.shape, emb.vocab_size)) @ emb.weight
+
+if __name__ == "__main__":
+  Tensor.no_grad = True
+  emb = Embedding(VOCAB, DIM)
+  emb.weight.realize()
+  for tokens in [1, 16, 128] if not getenv("TOKENS") else [getenv("TOKENS")]:
+    idx = Tensor(np.random.randint(0, VOCAB, (1, tokens)).astype(np.float32)).realize()
+    (gout, gms), (oout, oms) = bench(lambda: emb(idx).realize(), CNT), bench(lambda: onehot(emb, idx).realize(), CNT)
+    np.testing.assert_allclose(gout.numpy(), oout.numpy())
+    print(f"{Device.DEFAULT:6s} {tokens:4d} tokens of {VOCAB}x{DIM}: gather {gms:8.3f} ms {tokens*DIM*4/gms*1e-6:6.2f} GB/s   one-hot matmul {oms:9.2f} ms   {oms/gms:7.1f}x")
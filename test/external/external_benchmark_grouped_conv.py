@@ -0,0 +1,27 @@
+#!/usr/bin/env python
+# efficientnet-b0 inference and a training step, the MBConv blocks have a depthwise conv each
+#   CLANG=1 python3 test/external/external_benchmark_grouped_conv.py
+# BS is the batch size, HW the size of the image, TRAIN_HW the size of the image of the training step, CNT the number of runs, the best one is reported
+from tinygrad.tensor import Tensor
+from tinygrad.nn.optim import SGD
+from tinygrad.state import get_parameters
+from tinygrad.lazy import Device
+from tinygrad.helpers import getenv
+from models.efficientnet import EfficientNet
+from extra.bench import bench
+
+BS, HW, TRAIN_HW, CNT = getenv("BS", 1), getenv("HW", 224), getenv("TRAIN_HW", 112), getenv("CNT", 5)
+
+if __name__ == "__main__":
+  model = EfficientNet(0)
+  x = Tensor.randn(BS, 3, HW, HW).realize()
+  Tensor.no_grad = True
+  print(f"{Device.DEFAULT:6s} efficientnet-b0 inference bs {BS} {HW}x{HW}: {bench(lambda: model.forward(x).realize(), CNT)[1]:9.2f} ms")
+  Tensor.no_grad, Tensor.training = False, True
+  opt = SGD(get_parameters(model), lr=1e-4)
+  x = Tensor.randn(BS, 3, TRAIN_HW, TRAIN_HW).realize()
+  def step():
+    opt.zero_grad()
+    model.forward(x).mean().backward()
+    opt.step()
+  print(f"{Device.DEFAULT:6s} efficientnet-b0 training step bs {BS} {TRAIN_HW}x{TRAIN_HW}: {bench(step, CNT)[1]:9.2f} ms")
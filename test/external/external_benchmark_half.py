@@ -0,0 +1,26 @@
+#!/usr/bin/env python
+# bandwidth of elementwise ops and matmuls with float32 and float16 buffers, the float16 math is in float32
+#   CLANG=1 python3 test/external/external_benchmark_half.py
+# N sets the number of elements of the elementwise ops and the size of the NxN matmul weight, CNT the number of runs, the best one is reported
+import numpy as np
+from tinygrad.tensor import Tensor
+from tinygrad.lazy import Device
+from tinygrad.helpers import getenv, dtypes
+from extra.bench import bench
+
+N, CNT = getenv("N", 4096), getenv("CNT", 5)
+
+if __name__ == "__main__":
+  data = {"a": np.random.randn(N*N), "b": np.random.randn(N*N), "c": np.random.randn(N*N), "w": np.random.randn(N, N)/np.sqrt(N), "x": np.random.randn(1, N), "xs": np.random.randn(64, N)}
+  # the weights are (out, in) like nn.Linear, the decode-style matvec reads them once, it's bound by the memory bandwidth like the elementwise ops
+  ops = {f"add {N*N}": (lambda t: t["a"] + t["b"], ["a", "b", "a"]),
+         f"mul add {N*N}": (lambda t: t["a"] * t["b"] + t["c"], ["a", "b", "c", "a"]),
+         f"matvec 1x{N}x{N}": (lambda t: t["x"] @ t["w"].T, ["w"]),
+         f"matmul 64x{N}x{N}": (lambda t: t["xs"] @ t["w"].T, ["w", "xs"])}
+  for name,(fxn,bufs) in ops.items():
+    for dtype in [dtypes.float32, dtypes.float16]:
+      ts = {k:Tensor(v.astype(dtype.np)).realize() for k,v in data.items()}
+      out, ms = bench(lambda: fxn(ts).realize(), CNT)
+      out, gbs = out.numpy(), sum(data[k].size for k in bufs)*dtype.itemsize/ms*1e-6
+      if dtype == dtypes.float32: ref = out
+      print(f"{Device.DEFAULT:6s} {name:20s} {dtype.name:6s}: {ms:8.2f} ms {gbs:7.2f} GB/s   max error vs float32 {np.abs(out.astype(np.float32) - ref).max():.4f}")
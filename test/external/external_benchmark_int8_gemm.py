@@ -0,0 +1,29 @@
+#!/usr/bin/env python
+# int8 x int8 matmul and conv, with float math and with INT32_ACC=1 (int32 math and result), against the float32 ones of the same shape
+#   CLANG=1 python3 test/external/external_benchmark_int8_gemm.py
+# N sets the size of the NxN matmul, CNT the number of runs, the best one is reported
+import numpy as np
+from tinygrad.tensor import Tensor
+from tinygrad.lazy import Device
+from tinygrad.helpers import getenv, dtypes, Context
+from extra.bench import bench
+
+N, CNT = getenv("N", 1024), getenv("CNT", 5)
+
+def gops(fxn, flops):
+  ret, ms = bench(lambda: fxn().realize(), CNT)
+  return ret.numpy(), flops/ms*1e-6
+
+if __name__ == "__main__":
+  a, b = np.random.randint(-128, 128, (N, N)).astype(np.int8), np.random.randint(-128, 128, (N, N)).astype(np.int8)
+  x, w = np.random.randint(-128, 128, (16, 64, 32, 32)).astype(np.int8), np.random.randint(-128, 128, (64, 64, 3, 3)).astype(np.int8)
+  shapes = {f"matmul {N}x{N}x{N}": (lambda t: t(a) @ t(b), 2*N**3, a.astype(np.int64) @ b.astype(np.int64)),
+            "conv 16x64x32x32 3x3": (lambda t: t(x).conv2d(t(w), padding=1), 2*16*64*32*32*64*9, None)}
+  for name,(fxn,flops,ref) in shapes.items():
+    _, gflops = gops(lambda: fxn(lambda y: Tensor(y)), flops)
+    with Context(INT32_ACC=1): iout, igflops = gops(lambda: fxn(lambda y: Tensor(y)), flops)
+    fout, fgflops = gops(lambda: fxn(lambda y: Tensor(y.astype(np.float32))), flops)
+    # the float32 sums are only exact up to 2**24
+    err = np.abs(fout.astype(np.int64) - (iout if ref is None else ref)).max()
+    if ref is not None: np.testing.assert_equal(iout, ref)
+    print(f"{Device.DEFAULT:6s} {name:22s}: int8 {gflops:7.2f} GOPS   int8 INT32_ACC {igflops:7.2f} GOPS   float32 {fgflops:7.2f} GFLOPS   max float32 error {err}")
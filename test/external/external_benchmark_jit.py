@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+# per call overhead of a small MLP with and without TinyJit, run with CPU=1, CLANG=1 or LLVM=1
+# BS=1,4,8 cycles through those batch sizes, each one gets its own capture in the jit
+# CHAIN=200 replays a chain of that many tiny kernels instead, compare JIT_GRAPH=0 and JIT_GRAPH=1 on CLANG
+import time
+import numpy as np
+from tinygrad.tensor import Tensor
+from tinygrad.nn import Linear
+from tinygrad.jit import TinyJit
+from tinygrad.lazy import Device
+from tinygrad.helpers import getenv
+
+class MLP:
+  def __init__(self): self.layers = [Linear(64, 128), Linear(128, 128), Linear(128, 10)]
+  def __call__(self, x:Tensor) -> Tensor: return x.sequential([self.layers[0], Tensor.relu, self.layers[1], Tensor.relu, self.layers[2]]).log_softmax()
+
+class Chain:
+  def __init__(self, n): self.n = n
+  def __call__(self, x:Tensor) -> Tensor:
+    for _ in range(self.n): x = (x + 1).realize()
+    return x
+
+if __name__ == "__main__":
+  model = Chain(getenv("CHAIN")) if getenv("CHAIN") else MLP()
+  @TinyJit
+  def jit(x:Tensor) -> Tensor: return model(x).realize()
+  bss = [int(x) for x in getenv("BS", "4").split(",")]
+  inputs = [Tensor(np.random.rand(*((16,) if getenv("CHAIN") else (bs, 64))).astype(np.float32)).realize() for _ in range(10) for bs in bss]
+  for name,fxn in [("python", lambda x: model(x).realize()), ("jit", jit)]:
+    for x in inputs[:3*len(bss)]: fxn(x)
+    tms = []
+    for _ in range(getenv("CNT", 100)):
+      for x in inputs:
+        st = time.perf_counter()
+        fxn(x).lazydata.realized
+        tms.append(time.perf_counter()-st)
+    print(f"{Device.DEFAULT:6s} {name:6s} {np.median(tms)*1e6:9.2f} us/call median, {min(tms)*1e6:9.2f} us min")
+  for x in inputs[:len(bss)]: np.testing.assert_allclose(jit(x).numpy(), model(x).numpy(), atol=1e-5)
+  print(f"jit {jit.stats()}")
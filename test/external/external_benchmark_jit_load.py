@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+# time to the first inference in a fresh process, building the model and capturing the JIT vs TinyJit.load
+#   CLANG=1 python3 test/external/external_benchmark_jit_load.py efficientnet resnet50
+import time
+st = time.perf_counter()
+import sys, os, subprocess
+import numpy as np
+from tinygrad.tensor import Tensor
+from tinygrad.jit import TinyJit
+from tinygrad.lazy import Device
+
+def build(name):
+  if name == "efficientnet":
+    from models.efficientnet import EfficientNet
+    return EfficientNet(0)
+  from models.resnet import ResNet
+  return ResNet(50, 1000)
+
+if __name__ == "__main__":
+  if len(sys.argv) == 3 and sys.argv[1] in ("capture", "load"):
+    mode, name = sys.argv[1:]
+    fn = f"/tmp/jit_{name}_{Device.DEFAULT.lower()}.safetensors"
+    x = Tensor(np.ones((1,3,224,224), dtype=np.float32)).realize()
+    if mode == "capture":
+      model = build(name)
+      @TinyJit
+      def run(x): return model.forward(x).realize()
+      for _ in range(3): out = run(x)
+      run.save(fn)
+    else:
+      out = TinyJit.load(fn)(x)
+    print(f"{time.perf_counter()-st:.3f} {out.numpy().sum():.4f}")
+  else:
+    for name in sys.argv[1:] or ["efficientnet", "resnet50"]:
+      res = {mode:subprocess.check_output([sys.executable, __file__, mode, name], env={**os.environ, "PYTHONPATH": "."}).decode().split() for mode in ["capture", "load"]}
+      assert abs(float(res["capture"][1])-float(res["load"][1])) < 1e-2, f"output mismatch {res}"
+      print(f"{name:15s} on {Device.DEFAULT}: build+capture {float(res['capture'][0]):7.2f} s   load {float(res['load'][0]):7.2f} s")
@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+# loading a safetensors state dict, one tensor at a time vs disk_prefetch, against the raw read bandwidth of the file
+#   CLANG=1 python3 test/external/external_benchmark_prefetch.py
+# DIM and LAYERS set the size, the default is 1 GB of float32 weights. COLD=1 drops the page cache first (needs root), DISK_DIRECT=1 reads with O_DIRECT. load_state_dict uses disk_prefetch with PREFETCH=1
+import time, os
+import numpy as np
+from tinygrad.tensor import Tensor
+from tinygrad.state import safe_load, safe_save, disk_prefetch
+from tinygrad.lazy import Device
+from tinygrad.helpers import getenv
+
+DIM, LAYERS = getenv("DIM", 4096), getenv("LAYERS", 16)
+fn = f"/tmp/prefetch_{DIM}_{LAYERS}.safetensors"
+
+def warm():
+  if getenv("COLD"):
+    os.sync()
+    with open("/proc/sys/vm/drop_caches", "w") as f: f.write("3")
+  else:
+    with open(fn, "rb") as f:
+      while f.read(1<<24): pass
+
+if __name__ == "__main__":
+  if not os.path.exists(fn): safe_save({f"layer{i}": Tensor(np.random.rand(DIM, DIM).astype(np.float32)) for i in range(LAYERS)}, fn)
+  gb = os.path.getsize(fn)/1e9
+  warm()
+  st = time.perf_counter()
+  with open(fn, "rb", buffering=0) as f:
+    buf = bytearray(1<<24)
+    while f.readinto(buf): pass
+  print(f"{'raw read':12s}: {gb:.2f} GB in {time.perf_counter()-st:6.3f} s, {gb/(time.perf_counter()-st):5.2f} GB/s")
+  # each weight is used by a matmul after it's loaded, like the first forward pass after loading a model
+  for name,load in [("sequential", lambda x: x.items()), ("prefetch", disk_prefetch)]:
+    warm()
+    st = time.perf_counter()
+    out = Tensor.ones(1, DIM)
+    for _,w in load({k:v.to(Device.DEFAULT) for k,v in safe_load(fn).items()}): out = ((out @ w.realize()).relu() / DIM).realize()
+    et = time.perf_counter()-st
+    print(f"{name:12s}: {gb:.2f} GB in {et:6.3f} s, {gb/et:5.2f} GB/s on {Device.DEFAULT}, out {out.numpy().sum():.6f}")
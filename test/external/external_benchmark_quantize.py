@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+# decode speed and memory of the LLaMA model from examples/llama.py with float32, int8 and int4 linear weights, each in a fresh process
+#   CLANG=1 python3 test/external/external_benchmark_quantize.py
+# DIM and LAYERS set the size of the model (random weights, the default is 0.7 GB in float32), TOKENS the number of tokens decoded
+import time, sys, os, subprocess, functools
+import numpy as np
+from tinygrad.tensor import Tensor
+from tinygrad.state import safe_save, safe_load, get_state_dict, load_state_dict
+from tinygrad.nn import Linear
+from tinygrad.nn.quant import QuantizedLinear, quantize_state_dict, quantization_metadata, safe_load_quantization
+from tinygrad.lazy import Device
+from tinygrad.helpers import getenv
+from examples.llama import Transformer, args_small
+from extra.bench import rss
+
+DIM, LAYERS, TOKENS = getenv("DIM", 1024), getenv("LAYERS", 8), getenv("TOKENS", 16)
+model_args = {**args_small, "dim": DIM, "n_layers": LAYERS, "n_heads": DIM//64}
+def fn(qtype): return f"/tmp/llama_{DIM}_{LAYERS}_{qtype}.safetensors"
+
+if __name__ == "__main__":
+  Tensor.no_grad = True
+  if len(sys.argv) == 2:
+    qtype = sys.argv[1]
+    quant = {k:v["qtype"] for k,v in safe_load_quantization(fn(qtype)).items()}
+    model = Transformer(**model_args, linear=functools.partial(QuantizedLinear, qtype=qtype) if quant else Linear)
+    load_state_dict(model, safe_load(fn(qtype)))
+    toks = [1]
+    model(Tensor([toks]), 0).realize()  # warm up, the kernels are compiled here
+    st = time.perf_counter()
+    for i in range(TOKENS): toks.append(int(model(Tensor([toks[-1:]]), len(toks)-1).numpy().argmax()))
+    print(f"{TOKENS/(time.perf_counter()-st):.2f} {rss():.2f} {toks[-1]}")
+  else:
+    if not os.path.exists(fn("float32")):
+      model = Transformer(**model_args)
+      for v in get_state_dict(model).values(): v.assign(Tensor((np.random.randn(*v.shape) / np.sqrt(v.shape[-1])).astype(np.float32)))
+      safe_save(get_state_dict(model), fn("float32"))
+    for qtype in ["int8", "int4"]:
+      if os.path.exists(fn(qtype)): continue
+      qmodel = Transformer(**model_args, linear=functools.partial(QuantizedLinear, qtype=qtype))
+      load_state_dict(qmodel, quantize_state_dict(qmodel, safe_load(fn("float32"))))
+      safe_save(get_state_dict(qmodel), fn(qtype), metadata=quantization_metadata(qmodel))
+    for qtype in ["float32", "int8", "int4"]:
+      tps, mem, last = subprocess.check_output([sys.executable, __file__, qtype], env={**os.environ, "PYTHONPATH": "."}).decode().splitlines()[-1].split()
+      print(f"{Device.DEFAULT:6s} {qtype:8s}: file {os.path.getsize(fn(qtype))/1e9:5.2f} GB   {float(tps):6.2f} tok/s   RSS {float(mem):5.2f} GB   last token {last}")
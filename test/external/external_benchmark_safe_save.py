@@ -0,0 +1,22 @@
+#!/usr/bin/env python
+# checkpointing speed of safe_save, how long it blocks and the write bandwidth
+#   CLANG=1 python3 test/external/external_benchmark_safe_save.py
+# DIM and LAYERS set the size of the state dict, the default is 1 GB of float32 weights. SAVE_THREADS sets the number of writers
+import time, os
+from tinygrad.tensor import Tensor
+from tinygrad.state import safe_save, safe_load
+from tinygrad.lazy import Device
+from tinygrad.helpers import getenv
+
+if __name__ == "__main__":
+  DIM, LAYERS = getenv("DIM", 4096), getenv("LAYERS", 16)
+  state_dict = {f"layer{i}": Tensor.rand(DIM, DIM).realize() for i in range(LAYERS)}
+  fn = "/tmp/safe_save_bench.safetensors"
+  for background in [False, True]:
+    st = time.perf_counter()
+    handle = safe_save(state_dict, fn, background=background)
+    bt = time.perf_counter()
+    if handle is not None: handle.result()
+    et = time.perf_counter()
+    print(f"{Device.DEFAULT:6s} background={background!s:5s}: blocked {bt-st:6.3f} s, written in {et-st:6.3f} s at {os.path.getsize(fn)/(et-st)/1e9:5.2f} GB/s")
+  assert (safe_load(fn)["layer0"].numpy() == state_dict["layer0"].numpy()).all()
@@ -0,0 +1,34 @@
+#!/usr/bin/env python
+# times the shapetracker on the test_shapetracker and fuzz_shapetracker workloads, the first run is cold, the rest hit the caches
+import time, random, unittest, io, contextlib
+from tinygrad.helpers import getenv
+from tinygrad.shape.shapetracker import ShapeTracker
+from test.external.fuzz_shapetracker import do_permute, do_pad, do_shrink, do_reshape_split_one, do_reshape_combine_two, do_stride, do_expand
+
+class NoChecking:
+  def __init__(self, shape): self.st = ShapeTracker(shape)
+  def __getattr__(self, name): return getattr(self.st, name)
+
+def fuzz(cnt=200):
+  random.seed(42)
+  ops = [do_permute, do_pad, do_shrink, do_reshape_split_one, do_reshape_combine_two, do_stride, do_expand]
+  for _ in range(cnt):
+    st = NoChecking((random.randint(2, 10), random.randint(2, 10), random.randint(2, 10)))
+    for _ in range(8):
+      random.choice(ops)(st)
+      # what the linearizer asks for after every kernel change
+      st.real_strides(), st.simplify(), st.expr_idxs()
+
+def unit():
+  with contextlib.redirect_stdout(io.StringIO()):
+    suite = unittest.defaultTestLoader.loadTestsFromName("test.unit.test_shapetracker")
+    unittest.TextTestRunner(stream=io.StringIO()).run(suite)
+
+if __name__ == "__main__":
+  for name,fxn in [("test_shapetracker", unit), ("fuzz_shapetracker", fuzz)]:
+    tms = []
+    for _ in range(getenv("CNT", 5)):
+      st = time.perf_counter()
+      fxn()
+      tms.append(time.perf_counter()-st)
+    print(f"{name:20s} cold {tms[0]*1e3:9.2f} ms   warm {min(tms[1:])*1e3:9.2f} ms")
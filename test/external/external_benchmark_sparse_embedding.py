@@ -0,0 +1,30 @@
+#!/usr/bin/env python
+# the time of a training step of an Embedding with dense and sparse grads as the vocab grows, the sparse step only touches the rows of the batch
+#   CLANG=1 python3 test/external/external_benchmark_sparse_embedding.py
+# VOCABS is a comma separated list of vocab sizes, DIM the size of a row, TOKENS the number of tokens in a batch, CNT the number of steps, the best one is reported
+import numpy as np
+from tinygrad.tensor import Tensor
+from tinygrad.nn import Embedding
+from tinygrad.nn.optim import SGD, Adam
+from tinygrad.lazy import Device
+from tinygrad.helpers import getenv
+from extra.bench import bench
+
+VOCABS, DIM, TOKENS, CNT = [int(x) for x in getenv("VOCABS", "1000,10000,100000").split(",")], getenv("DIM", 256), getenv("TOKENS", 512), getenv("CNT", 5)
+
+def train(vocab, sparse, opt):
+  emb = Embedding(vocab, DIM, sparse=sparse)
+  emb.weight.assign(Tensor.uniform(vocab, DIM)).realize()
+  opt = opt([emb.weight])
+  idxs = [Tensor(np.random.randint(0, vocab, (TOKENS,))) for _ in range(CNT)]
+  def step():
+    opt.zero_grad()
+    emb(idxs.pop()).square().sum().backward()
+    opt.step()
+  return bench(step, CNT)[1]
+
+if __name__ == "__main__":
+  for name,opt in [("sgd momentum", lambda p: SGD(p, lr=0.01, momentum=0.9)), ("adam", lambda p: Adam(p, lr=0.01))]:
+    for vocab in VOCABS:
+      dense, sparse = train(vocab, False, opt), train(vocab, True, opt)
+      print(f"{Device.DEFAULT:6s} {name:12s} vocab {vocab:7d} dim {DIM} tokens {TOKENS}: dense {dense:8.2f} ms   sparse {sparse:8.2f} ms   {dense/sparse:6.1f}x")
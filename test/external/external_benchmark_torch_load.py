@@ -0,0 +1,31 @@
+#!/usr/bin/env python
+# loading a checkpoint sharded like LLaMA (consolidated.*.pth, some weights stored transposed), cat of the copies vs disk_cat
+#   CLANG=1 python3 test/external/external_benchmark_torch_load.py
+# SHARDS, DIM and LAYERS set the size, the default is 1 GB of float32 weights
+import time, os
+import numpy as np
+from tinygrad.tensor import Tensor
+from tinygrad.state import torch_load, disk_cat
+from tinygrad.lazy import Device
+from tinygrad.helpers import getenv
+
+SHARDS, DIM, LAYERS = getenv("SHARDS", 4), getenv("DIM", 4096), getenv("LAYERS", 8)
+
+if __name__ == "__main__":
+  fns = [f"/tmp/torch_load_{DIM}_{LAYERS}_{i}.pth" for i in range(SHARDS)]
+  if not all(os.path.exists(fn) for fn in fns):
+    import torch
+    for fn in fns: torch.save({**{f"layer{l}.wq": torch.rand(DIM//SHARDS, DIM) for l in range(LAYERS)}, **{f"layer{l}.wo": torch.rand(DIM, DIM//SHARDS).T.contiguous().T for l in range(LAYERS)}}, fn)
+  for fn in fns:
+    with open(fn, "rb") as f:
+      while f.read(1<<24): pass   # both start with the files in the page cache
+  shards = [torch_load(fn) for fn in fns]
+  def cat(tensors, dim, device): return tensors[0].to(device).cat(*[t.to(device) for t in tensors[1:]], dim=dim)
+  outs = {}
+  for name,fxn in [("cat", cat), ("disk_cat", disk_cat)]:
+    st = time.perf_counter()
+    outs[name] = {k:fxn([x[k] for x in shards], 1 if k.endswith(".wo") else 0, Device.DEFAULT).realize() for k in shards[0]}
+    et = time.perf_counter()-st
+    gb = sum(v.nbytes() for v in outs[name].values())/1e9
+    print(f"{Device.DEFAULT:6s} {name:8s}: {gb:.2f} GB in {et:6.3f} s, {gb/et:5.2f} GB/s")
+  for k in ["layer0.wq", "layer0.wo"]: np.testing.assert_equal(outs["cat"][k].numpy(), outs["disk_cat"][k].numpy())
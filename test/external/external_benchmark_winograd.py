@@ -0,0 +1,28 @@
+#!/usr/bin/env python
+# forward time of models with 3x3 convs with the direct conv and the winograd one, and the max error between the two
+#   CLANG=1 python3 test/external/external_benchmark_winograd.py
+# MODELS is a comma separated list of resnet18,resnet34,vgg7, BS the batch size, HW the size of the image, CNT the number of runs, the best one is reported
+import numpy as np
+from tinygrad.tensor import Tensor
+from tinygrad.lazy import Device
+from tinygrad.helpers import getenv, Context
+from models.resnet import ResNet18, ResNet34
+from examples.vgg7_helpers.waifu2x import Vgg7
+from extra.bench import bench
+
+MODELS, BS, HW, CNT = getenv("MODELS", "resnet18,resnet34,vgg7").split(","), getenv("BS", 1), getenv("HW", 224), getenv("CNT", 3)
+
+def run(fxn, x, wino):
+  def f():
+    with Context(WINO=wino): return fxn(x).realize()
+  ret, ms = bench(f, CNT)
+  return ret.numpy(), ms
+
+if __name__ == "__main__":
+  Tensor.no_grad = True
+  models = {"resnet18": lambda: ResNet18(), "resnet34": lambda: ResNet34(), "vgg7": lambda: Vgg7().forward}
+  for name in MODELS:
+    fxn = models[name]()
+    x = Tensor.randn(BS, 3, HW, HW).realize()
+    (direct, direct_tm), (wino, wino_tm) = run(fxn, x, 0), run(fxn, x, 1)
+    print(f"{Device.DEFAULT:6s} {name:9s} bs {BS} {HW}x{HW}: direct {direct_tm:9.2f} ms   wino {wino_tm:9.2f} ms   {direct_tm/wino_tm:5.2f}x   max error {np.abs(wino - direct).max() / np.abs(direct).max():.2e}")
@@ -0,0 +1,33 @@
+#!/usr/bin/env python
+# time to the first token and memory of a fresh process loading a safetensors file, copying it in vs DISK_ZEROCOPY=1
+#   CLANG=1 python3 test/external/external_benchmark_zerocopy_load.py
+# DIM and LAYERS set the size of the fake model, the default is 1 GB of float32 weights
+import time, sys, os, subprocess
+import numpy as np
+from tinygrad.tensor import Tensor
+from tinygrad.state import safe_load, safe_save
+from tinygrad.lazy import Device
+from tinygrad.helpers import getenv
+from extra.bench import rss
+
+DIM, LAYERS = getenv("DIM", 4096), getenv("LAYERS", 16)
+fn = f"/tmp/zerocopy_{DIM}_{LAYERS}.safetensors"
+
+if __name__ == "__main__":
+  if len(sys.argv) == 2 and sys.argv[1] == "run":
+    st = time.perf_counter()
+    weights = [v.to(Device.DEFAULT).realize() for v in safe_load(fn).values()]
+    lt = time.perf_counter()
+    x = Tensor.ones(1, DIM)
+    for w in weights: x = (x @ w).relu() / DIM
+    out = x.numpy()
+    print(f"{lt-st:.3f} {time.perf_counter()-st:.3f} {rss('RssAnon'):.2f} {rss('RssFile'):.2f} {out.sum():.6f}")
+  else:
+    if not os.path.exists(fn): safe_save({f"layer{i}": Tensor(np.random.rand(DIM, DIM).astype(np.float32)) for i in range(LAYERS)}, fn)
+    with open(fn, "rb") as f:
+      while f.read(1<<24): pass   # both start with the file in the page cache
+    res = {zc:subprocess.check_output([sys.executable, __file__, "run"], env={**os.environ, "PYTHONPATH": ".", "DISK_ZEROCOPY": str(zc)}).decode().split() for zc in [0, 1]}
+    assert res[0][-1] == res[1][-1], f"output mismatch {res}"
+    print(f"{os.path.getsize(fn)/1e9:.2f} GB on {Device.DEFAULT}")
+    for zc,(load,first,anon,file,_) in res.items():
+      print(f"{'zerocopy' if zc else 'copy':8s}: load {float(load):6.3f} s   first token {float(first):6.3f} s   RssAnon {float(anon):5.2f} GB   RssFile {float(file):5.2f} GB")
@@ -1,6 +1,6 @@
 import unittest
 import numpy as np
-from tinygrad.helpers import getenv, DType, DEBUG
+from tinygrad.helpers import getenv, DType, DEBUG, Context
 from tinygrad.lazy import Device
 from tinygrad.tensor import Tensor, dtypes
 from extra.utils import OSX, temp
@@ -27,25 +27,53 @@ def _test_mul_upcast(a:Tensor, b:Tensor, target_dtype:DType, target): _test_op(l
 def _test_matmul_upcast(a:Tensor, b:Tensor, target_dtype:DType, target): _test_op(lambda: a@b, target_dtype, target)
 
 
+@unittest.skipIf(Device.DEFAULT not in ["CPU", "CLANG", "LLVM"], "bf16 only on CPU, CLANG and LLVM")
 class TestBFloat16DType(unittest.TestCase):
   def test_bf16_to_float(self):
-    with self.assertRaises(AssertionError):
-      _test_cast(Tensor([100000], dtype=dtypes.bfloat16), dtypes.float32, [100000])
+    _test_cast(Tensor([100000], dtype=dtypes.bfloat16), dtypes.float32, [99840])
 
   def test_float_to_bf16(self):
-    with self.assertRaises(AssertionError):
-      _test_cast(Tensor([100000], dtype=dtypes.float32), dtypes.bfloat16, [100000])
+    _test_cast(Tensor([100000], dtype=dtypes.float32), dtypes.bfloat16, [99840])
 
-  # torch.tensor([10000, -1, -1000, -10000, 20]).type(torch.bfloat16)
+  def test_bf16_to_np(self):
+    _test_to_np(Tensor([1.5, -2, 3], dtype=dtypes.bfloat16), np.float32, [1.5, -2, 3])
+    assert Tensor([1.5, -2, 3], dtype=dtypes.bfloat16).lazydata.toCPU().dtype == dtypes.bfloat16.np
+
+  # a uint16 array is a uint16 tensor, not the bits of a bfloat16
+  def test_uint16_is_not_bf16(self):
+    x = np.array([1, 16256, 65535], dtype=np.uint16)
+    assert Tensor(x).dtype == dtypes.uint16
+    _test_to_np(Tensor(x), np.uint16, x)
+    _test_cast(Tensor(x), dtypes.float32, [1, 16256, 65535])
+    _test_cast(Tensor(x).cast(dtypes.bfloat16), dtypes.float32, [1, 16256, 65536])
 
-  @unittest.skipIf(Device.DEFAULT not in ["LLVM"], "bf16 only on LLVM")
+  # torch.tensor([10000, -1, -1000, -10000, 20]).type(torch.bfloat16)
   def test_bf16(self):
     t = Tensor([10000, -1, -1000, -10000, 20]).cast(dtypes.bfloat16)
     t.realize()
     back = t.cast(dtypes.float32)
     assert tuple(back.numpy().tolist()) == (9984., -1, -1000, -9984, 20)
 
-  @unittest.skipIf(Device.DEFAULT not in ["LLVM"], "bf16 only on LLVM")
+  # round to nearest even, in the kernel and on the store
+  def test_bf16_rounding(self):
+    vals = [1+2**-8, 1+3*2**-8, 1+2**-8+2**-20, float("inf"), float("nan"), 3.4e38]
+    target = [1, 1+2**-6, 1+2**-7, float("inf"), float("nan"), float("inf")]
+    np.testing.assert_equal(Tensor(vals).cast(dtypes.bfloat16).numpy(), target)
+    np.testing.assert_equal(Tensor(vals).cast(dtypes.bfloat16).realize().numpy(), target)
+
+  def test_bf16_math(self):
+    a, b = Tensor([1, 2.5, -3], dtype=dtypes.bfloat16), Tensor([1000, 1, 0.5], dtype=dtypes.bfloat16)
+    _test_add(a, b, dtypes.bfloat16, [1000, 3.5, -2.5])
+    _test_mul(a, b, dtypes.bfloat16, [1000, 2.5, -1.5])
+    _test_add_upcast(a, Tensor([1000, 1, 0.5]), dtypes.float32, [1001, 3.5, -2.5])
+    # 1001 isn't a bfloat16
+    _test_op(lambda: (a+b).cast(dtypes.float32)+1, dtypes.float32, [1001, 4.5, -1.5])
+
+  def test_bf16_sum_accumulates_in_float(self):
+    # a bfloat16 accumulator stops at 256
+    _test_op(lambda: Tensor.ones(4096).cast(dtypes.bfloat16).sum(), dtypes.bfloat16, 4096)
+    _test_matmul(Tensor.ones(4, 1024, dtype=dtypes.bfloat16), Tensor.ones(1024, 4, dtype=dtypes.bfloat16), dtypes.bfloat16, np.full((4, 4), 1024))
+
   def test_bf16_disk_write_read(self):
     t = Tensor([10000, -1, -1000, -10000, 20]).cast(dtypes.float32)
     t.to(f"disk:{temp('f32')}").realize()
@@ -55,12 +83,12 @@ class TestBFloat16DType(unittest.TestCase):
     adat = b''.join([dat[i+2:i+4] for i in range(0, len(dat), 4)])
     with open(temp('bf16'), "wb") as f: f.write(adat)
 
-    t = Tensor.empty(5, dtype=dtypes.bfloat16, device=f"disk:{temp('bf16')}").llvm().realize()
+    t = Tensor.empty(5, dtype=dtypes.bfloat16, device=f"disk:{temp('bf16')}").to(Device.DEFAULT).realize()
     back = t.cast(dtypes.float32)
     assert tuple(back.numpy().tolist()) == (9984., -1, -1000, -9984, 20)
 
 # for GPU, cl_khr_fp16 isn't supported (except now we don't need it!)
-# for LLVM, it segfaults because it can't link to the casting function
+# for LLVM without f16c, it segfaults because it can't link to the casting function
 @unittest.skipIf((getenv("CI", "") != "" and Device.DEFAULT in ["LLVM"]) or Device.DEFAULT == "WEBGPU", "float16 broken in some CI backends")
 class TestHalfDtype(unittest.TestCase):
   def test_half_to_np(self): _test_to_np(Tensor([1,2,3,4], dtype=dtypes.float16), np.float16, [1,2,3,4])
@@ -86,6 +114,21 @@ class TestHalfDtype(unittest.TestCase):
   def test_half_matmul_upcast_float(self): _test_matmul_upcast(Tensor([[1,2],[3,4]], dtype=dtypes.float16), Tensor.eye(2, dtype=dtypes.float32), dtypes.float32, [[1,2],[3,4]])
   def test_int8_matmul_upcast_half(self): _test_matmul_upcast(Tensor([[1,2],[3,4]], dtype=dtypes.int8), Tensor.eye(2, dtype=dtypes.float16), dtypes.float16, [[1,2],[3,4]])
 
+  def test_half_all_values(self):
+    x = np.arange(1<<16, dtype=np.uint16).view(np.float16)
+    np.testing.assert_equal(Tensor(x).float().numpy(), x.astype(np.float32))
+    np.testing.assert_equal(Tensor(x.astype(np.float32)).half().numpy().view(np.uint16)[~np.isnan(x)], x.view(np.uint16)[~np.isnan(x)])
+
+  # half is only stored, the sum and the matmul accumulate in float32. 2048+1 is 2048 in float16
+  def test_half_sum_accumulates_in_float(self): _test_op(lambda: Tensor([2048]+[1]*1000, dtype=dtypes.float16).sum(), dtypes.float16, [3048])
+  def test_half_matmul_accumulates_in_float(self):
+    _test_op(lambda: Tensor([[2048]+[1]*1000], dtype=dtypes.float16) @ Tensor.ones(1001, 1, dtype=dtypes.float16), dtypes.float16, [[3048]])
+  def test_half_padded_conv(self):
+    x, w = np.random.randn(2, 4, 9, 12).astype(np.float16), np.random.randn(8, 4, 3, 3).astype(np.float16)
+    out = Tensor(x).conv2d(Tensor(w), padding=1)
+    assert out.dtype == dtypes.float16
+    np.testing.assert_allclose(out.numpy(), Tensor(x.astype(np.float32)).conv2d(Tensor(w.astype(np.float32)), padding=1).numpy(), atol=2e-2, rtol=1e-3)
+
 @unittest.skipIf(Device.DEFAULT == "WEBGPU", "webgpu does not support int8")
 class TestInt8Dtype(unittest.TestCase):
   def test_int8_to_np(self): _test_to_np(Tensor([1,2,3,4], dtype=dtypes.int8), np.int8, [1,2,3,4])
@@ -112,6 +155,17 @@ class TestInt8Dtype(unittest.TestCase):
   def test_int64_mul(self): _test_mul(Tensor([1,2,3,4], dtype=dtypes.int64), Tensor([1,2,3,4], dtype=dtypes.int64), dtypes.int64, [1,4,9,16])
 
   def test_int8_matmul(self): _test_matmul(Tensor([[1,2],[3,4]], dtype=dtypes.int8), Tensor.eye(2, dtype=dtypes.int8), dtypes.int8, [[1,2],[3,4]])
+  def test_int8_matmul_accumulate_int32(self):
+    # the sums are past 2**24, where a float accumulator isn't exact anymore
+    a, b = np.random.randint(-128, 128, (16, 4096)).astype(np.int8), np.full((4096, 8), -128, dtype=np.int8)
+    a[0] = -128
+    with Context(INT32_ACC=1): _test_matmul(Tensor(a), Tensor(b), dtypes.int32, a.astype(np.int64) @ b.astype(np.int64))
+  def test_uint8_int8_matmul(self):
+    a, b = np.random.randint(0, 256, (8, 64)).astype(np.uint8), np.random.randint(-128, 128, (64, 8)).astype(np.int8)
+    with Context(INT32_ACC=1): _test_matmul(Tensor(a), Tensor(b), dtypes.int32, a.astype(np.int64) @ b.astype(np.int64))
+  def test_int8_conv2d(self):
+    x, w = np.random.randint(-128, 128, (2, 4, 9, 9)).astype(np.int8), np.random.randint(-128, 128, (6, 4, 3, 3)).astype(np.int8)
+    with Context(INT32_ACC=1): _test_op(lambda: Tensor(x).conv2d(Tensor(w), padding=1), dtypes.int32, Tensor(x.astype(np.float32)).conv2d(Tensor(w.astype(np.float32)), padding=1).numpy())
   def test_int64_matmul(self): _test_matmul(Tensor([[1,2],[3,4]], dtype=dtypes.int64), Tensor.eye(2, dtype=dtypes.int64), dtypes.int64, [[1,2],[3,4]])
 
   def test_int8_add_upcast_float(self): _test_add_upcast(Tensor([1,2,3,4], dtype=dtypes.int8), Tensor([1,2,3,4], dtype=dtypes.float32), dtypes.float32, [2,4,6,8])
@@ -1,5 +1,5 @@
 #!/usr/bin/env python
-import unittest
+import unittest, tempfile
 import numpy as np
 from tinygrad.tensor import Tensor, Device
 from tinygrad.jit import TinyJit, JIT_SUPPORTED_DEVICE
@@ -45,9 +45,23 @@ class TestJit(unittest.TestCase):
       a = Tensor.randn(10, 10)
       b = Tensor.randn(10, 10)
       c = add(a, b)
-    bad = Tensor.randn(20, 20)
-    with self.assertRaises(AssertionError):
-      add(a, bad)
+    # a different signature is a new capture
+    for _ in range(5):
+      a, b = Tensor.randn(20, 20), Tensor.randn(20, 20)
+      np.testing.assert_allclose(add(a, b).numpy(), a.numpy()+b.numpy(), atol=1e-6)
+    a, b = Tensor.randn(10, 10), Tensor.randn(10, 10)
+    np.testing.assert_allclose(add(a, b).numpy(), a.numpy()+b.numpy(), atol=1e-6)
+    assert add.stats()["misses"] == 2 and list(add.stats()["entries"].values()) == [3, 4]
+
+  def test_jit_lru(self):
+    def add(a, b): return (a+b).realize()
+    add = TinyJit(add, max_entries=2)
+    for sz in [4, 5, 6, 4, 6, 4]:
+      for _ in range(3):
+        a, b = Tensor.randn(sz), Tensor.randn(sz)
+        np.testing.assert_allclose(add(a, b).numpy(), a.numpy()+b.numpy(), atol=1e-6)
+    assert [k[0][1] for k in add.entries] == [(6,), (4,)]
+    assert add.stats()["evictions"] == 2 and add.stats()["misses"] == 4
 
   def test_jit_duplicate_fail(self):
     # the jit doesn't support duplicate arguments
@@ -102,7 +116,8 @@ class TestJit(unittest.TestCase):
     a = Tensor([1, 2, 3])
     for i in range(5):
       np.testing.assert_equal(f(a, Tensor([i])).cpu().numpy(), (a+i).cpu().numpy())
-    assert len(f.jit_cache) == 1
+    # NOTE: the interpreted backends realize the expand of b on its own
+    assert len(f.jit_cache) == (2 if Device.DEFAULT in ["CPU", "TORCH"] else 1)
 
   def test_jit_output_non_tensor_fail(self):
     @TinyJit
@@ -122,5 +137,46 @@ class TestJit(unittest.TestCase):
     assert output2 != expect2
     assert len(f.jit_cache) == 1
 
+  @unittest.skipIf(Device.DEFAULT in ["CPU", "TORCH"], "only compiled programs can be saved")
+  def test_jit_save_load(self):
+    w = Tensor.randn(10, 10).realize()
+    @TinyJit
+    def f(a, b): return (a@w+b).realize(), (a*2).realize()
+    for _ in range(3): f(Tensor.randn(10, 10), Tensor.randn(10, 10))
+    with tempfile.TemporaryDirectory() as tmp:
+      f.save(fn:=f"{tmp}/jit.safetensors")
+      g = TinyJit.load(fn)
+    assert len(g.jit_cache) == len(f.jit_cache)
+    for _ in range(3):
+      a, b = Tensor.randn(10, 10), Tensor.randn(10, 10)
+      c, d = g(a, b)
+      np.testing.assert_allclose(c.numpy(), a.numpy()@w.numpy()+b.numpy(), atol=1e-5, rtol=1e-5)
+      np.testing.assert_equal(d.numpy(), a.numpy()*2)
+
+  @unittest.skipUnless(Device.DEFAULT == "CLANG", "no graph replay")
+  def test_jit_graph(self):
+    w = Tensor.randn(10, 10).realize()
+    @TinyJit
+    def f(a, b): return ((a@w).realize()+b+a).realize()
+    for _ in range(5):
+      a, b = Tensor.randn(10, 10), Tensor.randn(10, 10)
+      c = f(a, b)
+      np.testing.assert_allclose(c.numpy(), a.numpy()@w.numpy()+b.numpy()+a.numpy(), atol=1e-5, rtol=1e-5)
+    assert f.graph is not None and len(f.jit_cache) == 2
+
+  @unittest.skipUnless(Device.DEFAULT == "CLANG", "no graph replay")
+  def test_jit_graph_reuses_library(self):
+    # the addresses of the buffers and the kernels aren't in the source, the same graph on other weights is the same library
+    def make(w):
+      @TinyJit
+      def f(a): return ((a@w).realize()+a).realize()
+      return f
+    ws = [Tensor.randn(10, 10).realize() for _ in range(2)]
+    fs = [make(w) for w in ws]
+    for _ in range(3):
+      a = Tensor.randn(10, 10)
+      for f,w in zip(fs, ws): np.testing.assert_allclose(f(a).numpy(), a.numpy()@w.numpy()+a.numpy(), atol=1e-5, rtol=1e-5)
+    assert fs[0].graph is not None and fs[1].graph is not None and fs[0].graph.prg.fn == fs[1].graph.prg.fn
+
 if __name__ == '__main__':
   unittest.main()
\ No newline at end of file
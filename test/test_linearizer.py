@@ -2,8 +2,11 @@ import numpy as np
 import unittest
 
 from tinygrad.lazy import Device
-from tinygrad.ops import GlobalCounters, Compiled
+from tinygrad.ops import GlobalCounters, Compiled, BinaryOps, TernaryOps
 from tinygrad.tensor import Tensor
+from tinygrad.helpers import dtypes, Context
+from tinygrad.codegen.linearizer import UOps, UOp, Token, MemOp, ConstOp, optimize_uops, hoist_index_exprs, split_border
+from tinygrad.shape.symbolic import Variable
 
 class TestLinearizer(unittest.TestCase):
   def test_arg_dedup(self):
@@ -19,5 +22,90 @@ class TestLinearizer(unittest.TestCase):
     np_c = (np_a[:2] - np_a[2:]) - (np_b[:2] - np_b[2:])
     np.testing.assert_allclose(np_c, c.numpy())
 
+  def test_split_reduce_divmod(self):
+    # the reduce axis is indexed with a div and a mod, the loop gets split
+    a = Tensor.randn(2,8,4,4)
+    np.testing.assert_allclose(a.numpy().transpose(0,2,3,1).reshape(2,4,32).sum(axis=2), a.permute(0,2,3,1).reshape(2,4,32).sum(axis=2).numpy(), atol=1e-4, rtol=1e-5)
+
+def _load(name, buf, idx, valid=1): return UOp(UOps.LOAD, Token(name, dtypes.float32), [], MemOp(buf, Variable.num(idx), False, dtypes.float32, Variable.num(valid)))
+def _const(name, val): return UOp(UOps.LOAD, Token(name, dtypes.float32), [], ConstOp(val, Variable.num(1)))
+def _alu(name, op, *vin): return UOp(UOps.ALU, Token(name, dtypes.float32), list(vin), op)
+def _store(buf, idx, tok): return UOp(UOps.STORE, None, [tok], MemOp(buf, Variable.num(idx), False, dtypes.float32, Variable.num(1)))
+def _t(name): return Token(name, dtypes.float32)
+
+class TestUOpOptimizer(unittest.TestCase):
+  def test_cse_load_and_alu(self):
+    uops = [_load("val0", "data1", 0), _load("val1", "data1", 0), _alu("alu0", BinaryOps.ADD, _t("val0"), _t("val0")), _alu("alu1", BinaryOps.ADD, _t("val1"), _t("val1")),
+            _store("data0", 0, _t("alu0")), _store("data0", 1, _t("alu1"))]
+    opt = optimize_uops(uops)
+    assert len(opt) == 4
+    assert opt[-1].vin == [_t("alu0")]
+
+  def test_store_kills_load(self):
+    uops = [_load("val0", "data0", 0), _store("data0", 0, _t("val0")), _load("val1", "data0", 0), _store("data0", 1, _t("val1"))]
+    assert len(optimize_uops(uops)) == 4
+
+  def test_constant_folding(self):
+    uops = [_const("c0", 2.0), _const("c1", 3.0), _alu("alu0", BinaryOps.MUL, _t("c0"), _t("c1")), _store("data0", 0, _t("alu0"))]
+    opt = optimize_uops(uops)
+    assert len(opt) == 2 and opt[0].arg.value == 6.0 and opt[0].out == _t("alu0")
+
+  def test_identity_and_dead_code(self):
+    uops = [_load("val0", "data1", 0), _const("c0", 1.0), _alu("alu0", BinaryOps.MUL, _t("val0"), _t("c0")), _alu("alu1", BinaryOps.ADD, _t("val0"), _t("val0")), _store("data0", 0, _t("alu0"))]
+    opt = optimize_uops(uops)
+    assert len(opt) == 2 and opt[-1].vin == [_t("val0")]
+
+  def test_invalid_load_in_accumulator(self):
+    # acc is assigned twice, it must not be folded. the padded load is a 0, the MULACC stays since the other side could be an inf or a nan
+    loop = UOp(UOps.LOOP, None, [], ([Variable("ridx0", 0, 3)], "reduce"))
+    endloop = UOp(UOps.ENDLOOP, None, [], ([Variable("ridx0", 0, 3)], "reduce"))
+    uops = [_const("acc0", 0.0), loop, _load("val0", "data1", 0, valid=0), _load("val1", "data2", 0), _alu("acc0", TernaryOps.MULACC, _t("val0"), _t("val1"), _t("acc0")),
+            _alu("acc0", BinaryOps.ADD, _t("val1"), _t("acc0")), endloop, _store("data0", 0, _t("acc0"))]
+    opt = optimize_uops(uops)
+    assert [u.uop for u in opt] == [UOps.LOAD, UOps.LOOP, UOps.LOAD, UOps.LOAD, UOps.ALU, UOps.ALU, UOps.ENDLOOP, UOps.STORE]
+    assert opt[0].arg.value == 0.0 and opt[2].arg.value == 0.0 and [u.arg for u in opt[4:6]] == [TernaryOps.MULACC, BinaryOps.ADD]
+
+  def test_no_fold_mul_zero(self):
+    # inf*0 and nan*0 are nan
+    uops = [_load("val0", "data1", 0), _const("c0", 0.0), _alu("alu0", BinaryOps.MUL, _t("val0"), _t("c0")), _store("data0", 0, _t("alu0"))]
+    assert len(optimize_uops(uops)) == 4
+
+  def test_no_cse_out_of_loop(self):
+    loop = UOp(UOps.LOOP, None, [], ([Variable("ridx0", 0, 3)], "reduce"))
+    endloop = UOp(UOps.ENDLOOP, None, [], ([Variable("ridx0", 0, 3)], "reduce"))
+    uops = [loop, _load("val0", "data1", 0), _store("data0", 0, _t("val0")), endloop, _load("val1", "data1", 0), _store("data0", 1, _t("val1"))]
+    assert len(optimize_uops(uops)) == 6
+
+  def test_hoist_index(self):
+    gidx0, ridx0 = Variable("gidx0", 0, 7), Variable("ridx0", 0, 3)
+    load = UOp(UOps.LOAD, _t("val0"), [], MemOp("data1", gidx0*16 + (gidx0//2)*4 + ridx0 + 1, False, dtypes.float32, (gidx0*2+ridx0) < 9))
+    uops = [UOp(UOps.LOOP, None, [], ([gidx0], "global")), UOp(UOps.LOOP, None, [], ([ridx0], "reduce")), load,
+            UOp(UOps.ENDLOOP, None, [], ([ridx0], "reduce")), UOp(UOps.ENDLOOP, None, [], ([gidx0], "global+local"))]
+    opt = hoist_index_exprs(uops)
+    assert [u.uop for u in opt] == [UOps.LOOP, UOps.INDEX, UOps.INDEX, UOps.LOOP, UOps.LOAD, UOps.ENDLOOP, UOps.ENDLOOP]
+    assert opt[4].arg.idx.render() == "(1+hidx0+ridx0)" and opt[4].arg.valid.render() == "((hidx1+ridx0)<9)"
+    for g in range(8):
+      hidxs = {u.arg[0].expr: eval(u.arg[1].render(), {"gidx0": g}) for u in opt[1:3]}
+      for r in range(4):
+        for x,y in [(opt[4].arg.idx, load.arg.idx), (opt[4].arg.valid, load.arg.valid)]:
+          assert eval(x.render(), {**hidxs, "ridx0": r}) == eval(y.render(), {"gidx0": g, "ridx0": r})
+
+  def test_split_border(self):
+    # a padding of 1 on both sides, the interior loads in the reduce loop have no valid
+    gidx0, ridx0 = Variable("gidx0", 0, 9), Variable("ridx0", 0, 3)
+    load = UOp(UOps.LOAD, _t("val0"), [], MemOp("data1", gidx0*4 + ridx0 + -4, False, dtypes.float32, Variable.ands([(gidx0*-1) < 0, gidx0 < 9])))
+    store = UOp(UOps.STORE, None, [_t("val0")], MemOp("data0", gidx0, False, dtypes.float32, Variable.num(1)))
+    body = [UOp(UOps.LOOP, None, [], ([ridx0], "reduce")), load, UOp(UOps.ENDLOOP, None, [], ([ridx0], "reduce")), store]
+    uops = [UOp(UOps.LOOP, None, [], ([gidx0], "global")), *body, UOp(UOps.ENDLOOP, None, [], ([gidx0], "global+local"))]
+    # it's opt-in, the body is copied
+    assert split_border(uops) == uops
+    with Context(BORDER=1): opt = split_border(uops)
+    assert [u.uop for u in opt] == [UOps.LOOP, *[u.uop for u in body], UOps.ENDLOOP]*3
+    assert [(u.arg[0][0].min, u.arg[0][0].max) for u in opt[::6]] == [(1, 8), (0, 0), (9, 9)]
+    assert opt[2].arg.valid.min == 1 and opt[8].arg.valid.max == 0 and opt[14].arg.valid.max == 0
+    assert len(set(u.out.name for u in opt if u.out is not None)) == 3
+    # a valid that isn't in a reduce loop is checked once per output, it's not worth the copies
+    with Context(BORDER=1): assert split_border([uops[0], load, store, uops[-1]]) == [uops[0], load, store, uops[-1]]
+
 if __name__ == '__main__':
   unittest.main()
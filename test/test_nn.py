@@ -2,10 +2,11 @@
 import unittest
 import numpy as np
 from extra.utils import WINDOWS
-from tinygrad.helpers import getenv
+from tinygrad.helpers import getenv, dtypes, Context
 from tinygrad.jit import TinyJit
-from tinygrad.tensor import Tensor, Device
+from tinygrad.tensor import Tensor, Device, SparseGrad
 from tinygrad.nn import BatchNorm2d, Conv1d, ConvTranspose1d, Conv2d, ConvTranspose2d, Linear, GroupNorm, LayerNorm, LayerNorm2d, Embedding, InstanceNorm
+from tinygrad.nn.quant import QuantizedLinear, quantize, quantize_state_dict, quantization_metadata, safe_load_quantization, requantize
 import torch
 
 class TestNN(unittest.TestCase):
@@ -75,6 +76,46 @@ class TestNN(unittest.TestCase):
     _test_linear(Tensor.randn(BS, in_dim))
     _test_linear(Tensor.randn(BS, T, in_dim)) # test with more dims
 
+  def test_quantized_linear(self):
+    from tinygrad.state import safe_save, safe_load, get_state_dict, load_state_dict
+    from tinygrad.ops import GlobalCounters
+    from extra.utils import temp
+    class Model:
+      def __init__(self, linear): self.l1, self.l2 = linear(64, 32), linear(32, 8, bias=False)
+      def __call__(self, x): return self.l2(self.l1(x).relu())
+    fp = Model(Linear)
+    x = Tensor.randn(4, 64).realize()
+    for qtype,atol in [("int8", 2e-2), ("int4", 3e-1)]:
+      w = fp.l1.weight.numpy()
+      q, s = quantize(w, qtype, 16)
+      assert q.shape == (32, 64 if qtype == "int8" else 32) and s.shape == (32, 4)
+      model = Model(lambda *args, **kwargs: QuantizedLinear(*args, **kwargs, qtype=qtype, block=16))
+      load_state_dict(model, quantize_state_dict(model, get_state_dict(fp)))
+      np.testing.assert_allclose(model(x).numpy(), fp(x).numpy(), atol=atol, rtol=0)
+      # with one row, like decoding a token, the dequantization is fused into the matmul
+      GlobalCounters.reset()
+      model.l2(x[:1, :32]).realize()
+      if Device.DEFAULT not in ["CPU", "TORCH"]: self.assertEqual(GlobalCounters.kernel_count, 1)
+      # it round trips through safetensors with the qtype in the metadata
+      safe_save(get_state_dict(model), temp(f"quant_{qtype}.safetensors"), metadata=quantization_metadata(model))
+      assert safe_load_quantization(temp(f"quant_{qtype}.safetensors")) == {"l1": {"qtype": qtype, "block": 16}, "l2": {"qtype": qtype, "block": 16}}
+      loaded = Model(lambda *args, **kwargs: QuantizedLinear(*args, **kwargs, qtype=qtype, block=16))
+      load_state_dict(loaded, safe_load(temp(f"quant_{qtype}.safetensors")))
+      np.testing.assert_equal(loaded(x).numpy(), model(x).numpy())
+
+  def test_requantize(self):
+    # an int8 layer with a scale per tensor for the input and per output channel for the weight
+    x, w = np.random.randn(4, 64).astype(np.float32), np.random.randn(64, 16).astype(np.float32)
+    sx, sw = np.abs(x).max() / 127, np.abs(w).max(axis=0) / 127
+    qx, qw = np.round(x / sx).astype(np.int8), np.round(w / sw).astype(np.int8)
+    with Context(INT32_ACC=1): acc = Tensor(qx) @ Tensor(qw)
+    np.testing.assert_equal(acc.numpy(), qx.astype(np.int64) @ qw.astype(np.int64))
+    sy = np.abs(x @ w).max() / 127
+    y = requantize(acc, Tensor((sx * sw / sy).astype(np.float32)))
+    assert y.dtype == dtypes.int8
+    np.testing.assert_allclose(y.numpy() * sy, x @ w, atol=4*sy, rtol=0)
+    np.testing.assert_equal(requantize(Tensor([-300, -5, 0, 5, 7, 300], dtype=dtypes.int32), 0.1).numpy(), [-30, -1, 0, 1, 1, 30])
+
   def test_conv1d(self):
     BS, C1, W = 4, 16, 224
     C2, K, S, P = 64, 7, 2, 1
@@ -282,6 +323,40 @@ class TestNN(unittest.TestCase):
       torch_z = torch_layer(torch_x)
       np.testing.assert_allclose(z.numpy(), torch_z.detach().numpy(), atol=1e-8, rtol=1e-8)
 
+  def test_embedding_backward(self):
+    B, T, C, VS = 4, 10, 20, 28
+    layer = Embedding(VS, C)
+    layer.weight.requires_grad = True
+    torch_layer = torch.nn.Embedding(VS, C)
+    with torch.no_grad(): torch_layer.weight[:] = torch.tensor(layer.weight.numpy(), dtype=torch.float32)
+
+    # the repeated indices add up in the gradient
+    x = np.random.randint(0, VS, (B, T))
+    x[0, :3] = 5
+    w = Tensor(np.random.randn(B, T, C).astype(np.float32))
+    (layer(Tensor(x.astype(np.float32))) * w).sum().backward()
+    (torch_layer(torch.tensor(x)) * torch.tensor(w.numpy())).sum().backward()
+    np.testing.assert_allclose(layer.weight.grad.numpy(), torch_layer.weight.grad.numpy(), atol=1e-5, rtol=1e-5)
+
+  def test_embedding_sparse_backward(self):
+    B, T, C, VS = 4, 10, 20, 28
+    layer = Embedding(VS, C, sparse=True)
+    layer.weight.requires_grad = True
+    x, w = np.random.randint(0, VS, (B, T)), np.random.randn(B, T, C).astype(np.float32)
+    x[0, :3] = 5
+    # the grad is the rows, a dense grad of the same weight adds to them
+    (layer(Tensor(x)) * Tensor(w)).sum().backward()
+    assert isinstance(layer.weight.grad, SparseGrad) and layer.weight.grad.values.shape == (B*T, C)
+    sparse = layer.weight.grad.numpy()
+    (layer(Tensor(x)) * Tensor(w)).sum().backward()
+    assert isinstance(layer.weight.grad, SparseGrad) and layer.weight.grad.values.shape == (2*B*T, C)
+    (layer.weight * 3).sum().backward()
+    assert isinstance(layer.weight.grad, Tensor)
+    ref = np.zeros((VS, C), np.float32)
+    np.add.at(ref, x.reshape(-1), w.reshape(-1, C))
+    np.testing.assert_allclose(sparse, ref, atol=1e-5, rtol=1e-5)
+    np.testing.assert_allclose(layer.weight.grad.numpy(), 2*ref + 3, atol=1e-5, rtol=1e-5)
+
 
 if __name__ == '__main__':
   unittest.main()
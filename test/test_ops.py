@@ -229,9 +229,27 @@ class TestOps(unittest.TestCase):
     helper_test_op([(45,65)], lambda x: x*2,  lambda x: x*2)
     helper_test_op([(45,65)], lambda x: x*-1, lambda x: x*-1)
     helper_test_op([(45,65)], lambda x: 255*x, lambda x: 255*x)
+  def test_mul_zero_inf_nan(self):
+    # the kernels don't fold x*0, it's nan for an inf or a nan
+    x = np.array([np.inf, -np.inf, np.nan, 1.], dtype=np.float32)
+    with np.errstate(invalid="ignore"):
+      np.testing.assert_equal((Tensor(x)*0).numpy(), x*0)
+      np.testing.assert_equal((Tensor(x).reshape(1, 4) @ Tensor.zeros(4, 2)).numpy(), x.reshape(1, 4) @ np.zeros((4, 2), dtype=np.float32))
   def test_div(self):
     helper_test_op([(45,65), (45,65)], lambda x,y: x/y, Tensor.div)
     helper_test_op([(), ()], lambda x,y: x/y, Tensor.div)
+  def test_fmod(self):
+    helper_test_op(None, torch.fmod, Tensor.fmod, vals=[[7., 255., -7., 3.5, 0., 16., 7., -7.], [2., 16., 2., 1., 3., 16., -2., -2.]], forward_only=True)
+    helper_test_op([(45,65), (45,65)], torch.fmod, Tensor.fmod, a=-0.5)
+    # the quotient doesn't fit in a long
+    helper_test_op(None, torch.fmod, Tensor.fmod, vals=[[3e30, -3e30, 1e20], [7., 7., 3.]], forward_only=True)
+  def test_mod(self):
+    helper_test_op(None, torch.remainder, Tensor.mod, vals=[[7., 255., -7., 3.5, 0., 16., 7., -7.], [2., 16., 2., 1., 3., 16., -2., -2.]], forward_only=True)
+    helper_test_op([(45,65), (45,65)], torch.remainder, Tensor.mod, a=-0.5)
+    helper_test_op([(45,65)], lambda x: x % 0.3, lambda x: x % 0.3)
+    helper_test_op([(45,65)], lambda x: x % -0.3, lambda x: x % -0.3)
+    # NOTE: torch has no derivative of remainder for a python float dividend
+    helper_test_op([(45,65)], lambda x: 2.5 - torch.floor(2.5/x)*x, lambda x: 2.5 % x, a=-0.5)
   def test_div_const(self):
     helper_test_op([(45,65)], lambda x: x/255, lambda x: x/255)
     helper_test_op([(45,65)], lambda x: x/1, lambda x: x/1)
@@ -375,6 +393,8 @@ class TestOps(unittest.TestCase):
     helper_test_op([(4), (4,4)], lambda x,y: x.matmul(y), Tensor.dot, atol=1e-4)
   def test_matmul(self):
     helper_test_op([(64), (64,99)], lambda x,y: x.matmul(y), Tensor.dot, atol=1e-4)
+  def test_matmul_expanded(self):
+    helper_test_op([], lambda: torch.ones(4,8) @ torch.full((8,4), 2.), lambda: Tensor.ones(4,8) @ Tensor.full((8,4), 2.), forward_only=True)
 
   @unittest.skipIf(IMAGE>0, "no batched matmul on images")
   def test_matmul_batched(self):
@@ -524,6 +544,40 @@ class TestOps(unittest.TestCase):
     helper_test_op([(10,10)], lambda x: x[1], lambda x: x[1])
     helper_test_op([(3,3,3)], lambda x: x[1,1,1], lambda x: x[1,1,1])
 
+  def test_tensor_indexing(self):
+    idx = np.array([[2, 0, 2], [4, 1, 3]])
+    helper_test_op([(5,4)], lambda x: x[torch.tensor(idx)], lambda x: x[Tensor(idx)])
+    helper_test_op([(5,3,2)], lambda x: x[torch.tensor(idx)], lambda x: x[Tensor(idx.astype(np.float32))])
+    helper_test_op([(5)], lambda x: x[torch.tensor(idx[0])]*2, lambda x: x[Tensor(idx[0])]*2)
+  def test_tensor_indexing_negative(self):
+    idx = np.array([[-1, 0, -5], [4, -2, 3]])
+    helper_test_op([(5,4)], lambda x: x[torch.tensor(idx)], lambda x: x[Tensor(idx)])
+    helper_test_op([(5,3)], lambda x: x[torch.tensor(idx)], lambda x: x[Tensor(idx.astype(np.float32))])
+  def test_tensor_indexing_out_of_range(self):
+    # torch raises, the indices are clamped to the first and the last row
+    x = np.random.randn(5, 4).astype(np.float32)
+    np.testing.assert_equal(Tensor(x)[Tensor([7, -9, 5, -6, 2])].numpy(), x[[4, 0, 4, 0, 2]])
+  def test_tensor_indexing_empty(self):
+    # zeros aren't allowed in a shape, an empty index is an error on every backend
+    with self.assertRaisesRegex(AssertionError, "empty index"): Tensor.randn(5, 4)[Tensor(np.zeros((0,), np.float32))]
+
+  def test_index_add_copy(self):
+    # a repeated index adds all of its rows, or keeps the last one
+    idx = np.array([3, 0, 3, 4])
+    helper_test_op([(5,4), (4,4)], lambda x,s: x.index_add(0, torch.tensor(idx), s), lambda x,s: x.index_add(Tensor(idx), s), forward_only=True)
+    helper_test_op([(5,3,2), (2,2,3,2)], lambda x,s: x.index_add(0, torch.tensor(idx), s.reshape(4,3,2)), lambda x,s: x.index_add(Tensor(idx.reshape(2,2)), s), forward_only=True)
+    helper_test_op([(5,4), (4,4)], lambda x,s: x.index_copy(0, torch.tensor([3, 0, 1, 4]), s), lambda x,s: x.index_copy(Tensor([3, 0, 1, 4]), s), forward_only=True)
+
+  def test_index_add_copy_repeated(self):
+    # the rows of an index that's in idx more than once are all added, or the last one is kept, on the parallel backends too
+    x, s, idx = np.random.randn(5, 4).astype(np.float32), np.random.randn(6, 4).astype(np.float32), np.array([3, 0, 3, 3, -1, 0])
+    add, copy = x.copy(), x.copy()
+    np.add.at(add, idx, s)
+    for i,r in zip(idx, s): copy[i] = r
+    np.testing.assert_allclose(Tensor(x).index_add(Tensor(idx), Tensor(s)).numpy(), add, atol=1e-6, rtol=1e-5)
+    np.testing.assert_equal(Tensor(x).index_copy(Tensor(idx), Tensor(s)).numpy(), copy)
+    helper_test_op([(5,4)], lambda x: x[torch.tensor([1, 1, 4, 1, 0, 4])], lambda x: x[Tensor([1, 1, 4, 1, 0, 4])])
+
   def test_slice_in_bounds_multidim(self):
     helper_test_op([(3,3,3)], lambda x: x[1:2], lambda x: x[1:2])
     helper_test_op([(3,3,3)], lambda x: x[1:2, 2], lambda x: x[1:2, 2])
@@ -886,6 +940,22 @@ class TestOps(unittest.TestCase):
       lambda x,w: torch.nn.functional.conv2d(x,w,groups=groups).relu(),
       lambda x,w: Tensor.conv2d(x,w,groups=groups).relu(), atol=1e-4, grad_rtol=1e-5)
 
+  def test_depthwise_conv2d_padded_strided(self):
+    # the MBConv depthwise convs of efficientnet, and a depth multiplier of 2
+    for k,stride,padding,dilation,rcout in [(3,1,1,1,1), (3,2,(0,1,0,1),1,1), (5,2,(1,2,1,2),1,1), (3,1,2,2,1), (3,2,1,1,2)]:
+      with self.subTest(k=k, stride=stride, padding=padding, dilation=dilation, rcout=rcout):
+        p = padding if isinstance(padding, tuple) else (padding,)*4
+        helper_test_op([(2,8,11,12), (8*rcout,1,k,k)],
+          lambda x,w: torch.nn.functional.conv2d(torch.nn.functional.pad(x, p),w,stride=stride,dilation=dilation,groups=8).relu(),
+          lambda x,w: Tensor.conv2d(x,w,stride=stride,dilation=dilation,padding=padding,groups=8).relu(), atol=1e-4, grad_rtol=1e-5)
+
+  def test_grouped_conv2d_strided_dilated(self):
+    for stride,dilation in [(2,1), (1,2), ((2,1),(1,2))]:
+      with self.subTest(stride=stride, dilation=dilation):
+        helper_test_op([(2,12,10,9), (8,3,3,3)],
+          lambda x,w: torch.nn.functional.conv2d(x,w,stride=stride,dilation=dilation,padding=1,groups=4).relu(),
+          lambda x,w: Tensor.conv2d(x,w,stride=stride,dilation=dilation,padding=1,groups=4).relu(), atol=1e-4, grad_rtol=1e-5)
+
   def test_fancy_conv2d(self):
     bs = 2
     cin = 3
@@ -1023,6 +1093,13 @@ class TestOps(unittest.TestCase):
         lambda x: torch.nn.functional.max_pool2d(x, kernel_size=(5,5), dilation=dilation),
         lambda x: Tensor.max_pool2d(x, kernel_size=(5,5), dilation=dilation))
 
+  def test_maxpool2d_dilation_stride(self):
+    for stride, dilation in [((2,3), 2), (3, (2,1)), (7, 2)]:
+      with self.subTest(stride=stride, dilation=dilation):
+        helper_test_op([(4,2,31,28)],
+          lambda x: torch.nn.functional.max_pool2d(x, kernel_size=(3,3), stride=stride, dilation=dilation),
+          lambda x: Tensor.max_pool2d(x, kernel_size=(3,3), stride=stride, dilation=dilation))
+
   def test_avgpool2d(self):
     shape = (32,2,111,28)
     for ksz in [(2,2), (3,3), (3,2), (5,5), (5,1)]:
@@ -1,10 +1,11 @@
 import numpy as np
 from tinygrad.helpers import dtypes
-from tinygrad.nn import Linear
+from tinygrad.nn import Linear, Embedding
 import torch
 import unittest
 from tinygrad.tensor import Tensor
-from tinygrad.nn.optim import Adam, SGD, AdamW
+from tinygrad.nn.optim import Adam, SGD, AdamW, LAMB
+from tinygrad.lazy import Device
 
 np.random.seed(1337)
 x_init = np.random.randn(1,4).astype(np.float32)
@@ -93,5 +94,74 @@ class TestOptim(unittest.TestCase):
 
       np.testing.assert_allclose(losses[0], losses[1], atol=1e-4, rtol=0)
 
+class TestSparse(unittest.TestCase):
+  def _steps(self, opt, sparse, idxs, vs=8):
+    emb = Embedding(vs, 4, sparse=sparse)
+    emb.weight.assign(Tensor(np.arange(vs*4, dtype=np.float32).reshape(vs, 4) / 10 - 1)).realize()
+    opt = opt([emb.weight])
+    for idx in idxs:
+      opt.zero_grad()
+      (emb(Tensor(idx)) * Tensor(m_init)).sum().backward()
+      opt.step()
+    return emb.weight.numpy()
+
+  def test_sparse_matches_dense(self):
+    # every row is in every step with repeated indices, so the lazy decay and the trust ratio over the updated rows are the dense ones
+    idxs = [np.array([[0, 1, 2, 3], [4, 5, 6, 7], [7, 7, 2, 0]]), np.array([[7, 6, 5, 4], [3, 2, 1, 0], [1, 1, 1, 1]])] * 2
+    for Opt,kwargs in [(SGD, {}), (SGD, {'momentum': 0.9, 'nesterov': True, 'weight_decay': 0.1}), (Adam, {}), (AdamW, {}), (LAMB, {'wd': 0.01})]:
+      np.testing.assert_allclose(self._steps(lambda p: Opt(p, lr=0.1, **kwargs), True, idxs), self._steps(lambda p: Opt(p, lr=0.1, **kwargs), False, idxs), atol=1e-5, rtol=1e-5)
+
+  def test_sparse_only_updates_rows(self):
+    # the rows that aren't in a step aren't updated, when a row is back its momentum is decayed for the steps it missed
+    idxs = [np.array([1, 3, 3]), np.array([5]), np.array([5]), np.array([3])]
+    w = self._steps(lambda p: SGD(p, lr=0.1, momentum=0.5), True, idxs)
+    w0 = self._steps(lambda p: SGD(p, lr=0.1), True, [])
+    np.testing.assert_equal(w[[0, 2, 4, 6, 7]], w0[[0, 2, 4, 6, 7]])
+    np.testing.assert_allclose(w[1], w0[1] - 0.1*m_init[0], atol=1e-6)
+    np.testing.assert_allclose(w[3], w0[3] - 0.1*2*m_init[0] - 0.1*(0.5**3*2 + 1)*m_init[0], atol=1e-6)
+    np.testing.assert_allclose(w[5], w0[5] - 0.1*m_init[0] - 0.1*1.5*m_init[0], atol=1e-6)
+
+class TestMixedPrecision(unittest.TestCase):
+  def test_bf16_master_weights(self):
+    w_init = Tensor(W_init).cast(dtypes.bfloat16).numpy()
+    for Opt,kwargs in [(SGD, {'momentum': 0.9}), (Adam, {}), (AdamW, {})]:
+      ws = []
+      for dtype,loss_scale in [(dtypes.float32, None), (dtypes.bfloat16, 2.0**8)]:
+        w = Tensor(w_init, dtype=dtype, requires_grad=True) if dtype == dtypes.float32 else Tensor(w_init.tolist(), dtype=dtype, requires_grad=True)
+        opt = Opt([w], lr=0.01, loss_scale=loss_scale, **kwargs)
+        for _ in range(5):
+          opt.zero_grad()
+          opt.scale(Tensor(x_init).matmul(w).relu().sum()).backward()
+          opt.step()
+        ws.append((w, opt.master[0]))
+      (w32, _), (w16, master) = ws
+      assert w16.dtype == dtypes.bfloat16 and master.dtype == dtypes.float32
+      np.testing.assert_equal(w16.numpy(), master.cast(dtypes.bfloat16).numpy())
+      np.testing.assert_allclose(master.numpy(), w32.numpy(), atol=1e-2)
+
+  def test_loss_scale_skips_and_grows(self):
+    w = Tensor([1., 2., 3.], requires_grad=True)
+    opt = SGD([w], lr=0.1, loss_scale=16.0)
+    opt.growth_interval = 2
+    # an overflow or a nan in the grads skips the step and halves the scale, two good steps in a row double it
+    for mult,target,scale in [(1e38, [1, 2, 3], 8), (1, [0.9, 1.9, 2.9], 8), (1, [0.8, 1.8, 2.8], 16), (float("nan"), [0.8, 1.8, 2.8], 8), (1, [0.7, 1.7, 2.7], 8)]:
+      opt.zero_grad()
+      opt.scale((w * mult).sum()).backward()
+      opt.step()
+      np.testing.assert_allclose(w.numpy(), target, atol=1e-6)
+      np.testing.assert_equal(opt.loss_scale.numpy(), [scale])
+
+  @unittest.skipIf(Device.DEFAULT not in ["CPU", "TORCH", "CLANG", "LLVM"], "float16 compute")
+  def test_fp16_grads_underflow(self):
+    for loss_scale,target in [(None, [1, 2, 3]), (2.0**16, [1-2e-4, 2-2e-4, 3-2e-4])]:
+      w = Tensor([1., 2., 3.], dtype=dtypes.float16, requires_grad=True)
+      opt = SGD([w], lr=1e4, loss_scale=loss_scale)
+      opt.zero_grad()
+      # the grad of w is 2e-8 in float16, that's 0 without loss scaling
+      opt.scale((w * 2).cast(dtypes.float32).sum() * 1e-8).backward()
+      opt.step()
+      # the update is smaller than the float16 resolution, it's only in the master weights
+      np.testing.assert_allclose(opt.master[0].numpy(), target, atol=2e-5)
+
 if __name__ == '__main__':
   unittest.main()
\ No newline at end of file
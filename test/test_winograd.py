@@ -0,0 +1,40 @@
+import unittest
+import numpy as np
+from tinygrad.tensor import Tensor
+from tinygrad.helpers import Context
+
+def helper_test_winograd(shp, cout, groups=1, padding=1, stride=1, atol=1e-4):
+  x, w, b = [Tensor(np.random.randn(*s).astype(np.float32), requires_grad=True) for s in [shp, (cout, shp[1]//groups, 3, 3), (cout,)]]
+  ret = []
+  for wino in [0, 1]:
+    with Context(WINO=wino):
+      out = x.conv2d(w, b, groups=groups, padding=padding, stride=stride)
+      x.grad, w.grad, b.grad = None, None, None
+      (out * out).mean().backward()
+      ret.append([out.numpy()] + [t.grad.numpy() for t in [x, w, b]])
+  for direct, wino in zip(*ret): np.testing.assert_allclose(wino, direct, atol=atol, rtol=1e-3)
+
+class TestWinograd(unittest.TestCase):
+  # F(2x2,3x3) for the small outputs, F(4x4,3x3) for the rest, the outputs that aren't whole tiles are padded
+  def test_f2(self): helper_test_winograd((2,16,7,7), 16)
+  def test_f4(self): helper_test_winograd((1,16,16,16), 24)
+  def test_f4_partial_tiles(self): helper_test_winograd((1,16,13,10), 16)
+  def test_padding(self):
+    helper_test_winograd((1,16,12,12), 16, padding=0)
+    helper_test_winograd((1,16,11,9), 16, padding=(2,0))
+  def test_groups(self): helper_test_winograd((1,32,10,10), 32, groups=2)
+  # these aren't winograd
+  def test_stride(self): helper_test_winograd((1,16,10,10), 16, stride=2)
+  def test_few_channels(self): helper_test_winograd((1,3,10,10), 16)
+
+  def test_accuracy(self):
+    # the error of F(4x4,3x3) grows with the size of the transform matrices, it's still well within float32 tolerances of a 3x3 conv
+    x, w = np.random.randn(1,64,32,32).astype(np.float32), np.random.randn(64,64,3,3).astype(np.float32)
+    xp = np.pad(x.astype(np.float64), ((0,0),(0,0),(1,1),(1,1)))
+    direct = sum(np.einsum("bchw,oc->bohw", xp[:, :, i:i+32, j:j+32], w[:, :, i, j]) for i in range(3) for j in range(3))
+    with Context(WINO=1): wino = Tensor(x).conv2d(Tensor(w), padding=1).numpy()
+    np.testing.assert_allclose(wino, direct, atol=1e-3, rtol=1e-3)
+    assert np.abs(wino - direct).max() / np.abs(direct).max() < 1e-5
+
+if __name__ == '__main__':
+  unittest.main()
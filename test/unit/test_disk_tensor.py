@@ -1,11 +1,12 @@
+import os
 import pathlib
 import unittest
 import numpy as np
 from tinygrad.tensor import Tensor, Device
-from tinygrad.state import safe_load, safe_save, get_state_dict, torch_load
+from tinygrad.state import safe_load, safe_save, get_state_dict, torch_load, disk_cat, disk_prefetch, safe_save_sharded, safe_load_sharded
 from tinygrad.helpers import dtypes
 from tinygrad.runtime.ops_disk import RawDiskBuffer
-from tinygrad.helpers import Timing
+from tinygrad.helpers import Timing, Context
 from extra.utils import fetch_as_file, temp
 
 def compare_weights_both(url):
@@ -86,6 +87,97 @@ class TestSafetensors(unittest.TestCase):
       for k in f.keys():
         np.testing.assert_array_equal(f.get_tensor(k).numpy(), state_dict[k].numpy())
 
+  def test_zerocopy_load(self):
+    tensors = {"weight": Tensor.arange(16).reshape(4, 4), "bias": Tensor.arange(3, dtype=dtypes.int32)}
+    safe_save(tensors, temp("zerocopy.safetensors"))
+    with Context(DISK_ZEROCOPY=1):
+      loaded = {k:v.to(Device.DEFAULT).realize() for k,v in safe_load(temp("zerocopy.safetensors")).items()}
+    for k,v in tensors.items(): np.testing.assert_equal(loaded[k].numpy(), v.numpy())
+    # writes are copy on write, the file doesn't change
+    loaded["weight"].assign(loaded["weight"] + 1).realize()
+    np.testing.assert_equal(loaded["weight"].numpy(), tensors["weight"].numpy() + 1)
+    np.testing.assert_equal(safe_load(temp("zerocopy.safetensors"))["weight"].numpy(), tensors["weight"].numpy())
+
+  def test_save_load_bf16(self):
+    tensors = {"weight": Tensor.randn(16, 16).cast(dtypes.bfloat16), "bias": Tensor.randn(16).cast(dtypes.bfloat16)}
+    safe_save(tensors, temp("bf16.safetensors"))
+    loaded = safe_load(temp("bf16.safetensors"))
+    for k,v in tensors.items():
+      assert loaded[k].dtype == dtypes.bfloat16
+      np.testing.assert_equal(loaded[k].numpy(), v.numpy())
+      np.testing.assert_equal(loaded[k].to(Device.DEFAULT).numpy(), v.numpy())
+    import torch
+    from safetensors.torch import load_file
+    for k,v in load_file(temp("bf16.safetensors")).items(): np.testing.assert_equal(v.float().numpy(), tensors[k].numpy())
+
+  def test_save_background(self):
+    tensors = {f"weight{i}": Tensor.randn(64, 64).realize() for i in range(8)}
+    expected = {k:v.numpy().copy() for k,v in tensors.items()}
+    handle = safe_save(tensors, temp("background.safetensors"), background=True)
+    # changing the tensors doesn't change what's saved
+    for v in tensors.values(): v.assign(v+1).realize()
+    handle.result()
+    loaded = safe_load(temp("background.safetensors"))
+    for k,v in expected.items(): np.testing.assert_equal(loaded[k].numpy(), v)
+
+  def test_save_streamed(self):
+    import tinygrad.state
+    # more tensors than writers, in more than one chunk, and some of them aren't contiguous or realized
+    tensors = {**{f"weight{i}": Tensor.randn(40, 24) for i in range(tinygrad.state.SAVE_THREADS*2)}, "t": Tensor.randn(24, 40).realize().T, "s": Tensor.randn(50, 50)[3:43, 1:25]}
+    expected = {k:v.numpy() for k,v in tensors.items()}
+    chunk, tinygrad.state.SAVE_CHUNK = tinygrad.state.SAVE_CHUNK, 1000
+    try: safe_save(tensors, temp("streamed.safetensors"))
+    finally: tinygrad.state.SAVE_CHUNK = chunk
+    loaded = safe_load(temp("streamed.safetensors"))
+    for k,v in expected.items(): np.testing.assert_equal(loaded[k].numpy(), v)
+
+  @unittest.skipUnless(hasattr(os, "pwrite"), "the fallback is the only write")
+  def test_save_streamed_no_pwrite(self):
+    import tinygrad.state
+    # like on windows, the writers seek and write under a lock
+    tensors = {f"weight{i}": Tensor.randn(40, 24) for i in range(tinygrad.state.SAVE_THREADS*2)}
+    expected = {k:v.numpy() for k,v in tensors.items()}
+    pwrite, chunk, tinygrad.state.SAVE_CHUNK = os.pwrite, tinygrad.state.SAVE_CHUNK, 1000
+    del os.pwrite
+    try: safe_save(tensors, temp("streamed_no_pwrite.safetensors"))
+    finally: os.pwrite, tinygrad.state.SAVE_CHUNK = pwrite, chunk
+    loaded = safe_load(temp("streamed_no_pwrite.safetensors"))
+    for k,v in expected.items(): np.testing.assert_equal(loaded[k].numpy(), v)
+
+  def test_disk_prefetch(self):
+    tensors = {f"weight{i}": Tensor.randn(33, 65).realize() for i in range(12)}
+    safe_save(tensors, temp("prefetch.safetensors"))
+    loaded = safe_load(temp("prefetch.safetensors"))
+    # the views and the ops after the copy are done on the device, a small depth keeps reads in flight past the first ones
+    for direct in [0, 1]:
+      ins = {k:(v[3:20, 1:40] if i%3 == 1 else v.T if i%3 == 2 else v).to(Device.DEFAULT) for i,(k,v) in enumerate(loaded.items())}
+      out = list(disk_prefetch(ins, depth=3, direct=direct))
+      assert [k for k,_ in out] == list(tensors.keys())
+      for i,(k,v) in enumerate(out): np.testing.assert_equal(v.numpy(), (lambda x: x[3:20, 1:40] if i%3 == 1 else x.T if i%3 == 2 else x)(tensors[k].numpy()))
+
+  def test_sharded(self):
+    import json
+    tensors = {"wq": Tensor.randn(8, 6).realize(), "wo": Tensor.randn(6, 8).realize(), "norm": Tensor.randn(6).realize(), "tok": Tensor([1, 2, 3], dtype=dtypes.int8)}
+    pathlib.Path(temp("sharded")).mkdir(exist_ok=True)
+    # split for tensor parallelism on two shards, each rank of a world reads its slice
+    safe_save_sharded(tensors, temp("sharded/tp.safetensors.index.json"), splits={"wq": 0, "wo": 1}, parts=2)
+    index = json.loads(pathlib.Path(temp("sharded/tp.safetensors.index.json")).read_text())
+    assert index["tensors"]["wo"]["axis"] == 1 and len(index["tensors"]["wo"]["parts"]) == 2 and len(index["tensors"]["norm"]["parts"]) == 1
+    for world_size in [1, 2, 3]:
+      for rank in range(world_size):
+        loaded = safe_load_sharded(temp("sharded/tp.safetensors.index.json"), rank=rank, world_size=world_size)
+        np.testing.assert_equal(loaded["wq"].numpy(), tensors["wq"].numpy()[8*rank//world_size:8*(rank+1)//world_size])
+        np.testing.assert_equal(loaded["wo"].numpy(), tensors["wo"].numpy()[:, 8*rank//world_size:8*(rank+1)//world_size])
+        for k in ["norm", "tok"]: np.testing.assert_equal(loaded[k].numpy(), tensors[k].numpy())
+    # split by size, only the files of the keys are read. without the byte ranges it's a huggingface index
+    safe_save_sharded(tensors, temp("sharded/model.safetensors.index.json"), max_shard_size=200)
+    index = json.loads(pathlib.Path(temp("sharded/model.safetensors.index.json")).read_text())
+    assert len(set(index["weight_map"].values())) == 3
+    np.testing.assert_equal(safe_load_sharded(temp("sharded/model.safetensors.index.json"), keys=["norm"])["norm"].numpy(), tensors["norm"].numpy())
+    del index["tensors"]
+    pathlib.Path(temp("sharded/model.safetensors.index.json")).write_text(json.dumps(index))
+    for k,v in safe_load_sharded(temp("sharded/model.safetensors.index.json")).items(): np.testing.assert_equal(v.numpy(), tensors[k].numpy())
+
 class TestDiskTensor(unittest.TestCase):
   def test_empty(self):
     pathlib.Path(temp("dt1")).unlink(missing_ok=True)
@@ -126,6 +218,75 @@ class TestDiskTensor(unittest.TestCase):
     print(tst)
     np.testing.assert_allclose(tst, np.arange(10, 20))
 
+  def test_torch_load_permuted(self):
+    import torch
+    tensors = {"a": torch.randn(4, 6).T, "b": torch.randn(2, 3, 5).permute(2, 0, 1), "c": torch.randn(4, 6)}
+    torch.save(tensors, temp("permuted.pth"))
+    loaded = torch_load(temp("permuted.pth"))
+    for k,v in tensors.items():
+      np.testing.assert_equal(loaded[k].numpy(), v.numpy())
+      # the permute is done on the device
+      np.testing.assert_equal((loaded[k].to(Device.DEFAULT)[1:3]*2).numpy(), v.numpy()[1:3]*2)
+    # the storages are read concurrently by the prefetcher, the permutes are still done on the device
+    for k,x in disk_prefetch({k:v.to(Device.DEFAULT) for k,v in loaded.items()}, depth=2): np.testing.assert_equal(x.numpy(), tensors[k].numpy())
+
+  def test_torch_load_bf16(self):
+    import torch
+    tensors = {"a": torch.randn(4, 6, dtype=torch.bfloat16), "b": torch.randn(6, 4, dtype=torch.bfloat16).T}
+    torch.save(tensors, temp("bf16.pth"))
+    loaded = torch_load(temp("bf16.pth"))
+    for k,v in tensors.items():
+      assert loaded[k].dtype == dtypes.bfloat16
+      np.testing.assert_equal(loaded[k].to(Device.DEFAULT).numpy(), v.float().numpy())
+
+  def test_disk_cat(self):
+    import torch
+    shards = [{"w": torch.randn(6, 4).T, "b": torch.randn(3)} for _ in range(3)]
+    for i,x in enumerate(shards): torch.save(x, temp(f"shard{i}.pth"))
+    loaded = [torch_load(temp(f"shard{i}.pth")) for i in range(3)]
+    for k,dim in [("w", 0), ("w", 1), ("w", -1), ("b", 0)]:
+      np.testing.assert_equal(disk_cat([x[k] for x in loaded], dim, Device.DEFAULT).numpy(), np.concatenate([x[k].numpy() for x in shards], dim))
+
+  def test_strided_views(self):
+    pathlib.Path(temp("dt6")).unlink(missing_ok=True)
+    Tensor.arange(240, device="CPU").to(f"disk:{temp('dt6')}").realize()
+    t, ref = Tensor.empty(2, 10, 12, device=f"disk:{temp('dt6')}"), np.arange(240, dtype=np.float32).reshape(2, 10, 12)
+    def permute(x, *order): return x.permute(*order) if isinstance(x, Tensor) else x.transpose(*order)
+    def expand(x, *shape): return x.expand(*shape) if isinstance(x, Tensor) else np.broadcast_to(x, shape)
+    for fxn in [lambda x: x[:, 2:5, 3:9], lambda x: permute(x, 2, 0, 1)[1:4], lambda x: x[:, ::2, ::3], lambda x: permute(x[1], 1, 0).reshape(12, 5, 2),
+                lambda x: expand(x[:, :, 4:5], 2, 10, 3), lambda x: permute(x, 1, 2, 0)]:
+      np.testing.assert_equal(fxn(t).numpy(), fxn(ref))
+      np.testing.assert_equal(fxn(t).to(Device.DEFAULT).numpy(), fxn(ref))
+    t[:, 2:5, 3:9].assign(np.zeros((2, 3, 6), dtype=np.float32))
+    ref[:, 2:5, 3:9] = 0
+    np.testing.assert_equal(t.numpy(), ref)
+
+  def test_views_of_cast(self):
+    ref = np.random.rand(33, 65).astype(np.float32)
+    safe_save({"w": Tensor(ref)}, temp("views_of_cast.safetensors"))
+    # the tensors of safe_load are a CAST of the bytes of the file, the views are of the cast
+    t = safe_load(temp("views_of_cast.safetensors"))["w"]
+    for fxn in [lambda x: x[3:20, 1:40], lambda x: x.T, lambda x: x[::2, 5:]]:
+      np.testing.assert_equal(fxn(t).numpy(), fxn(ref))
+      np.testing.assert_equal(fxn(t).to(Device.DEFAULT).numpy(), fxn(ref))
+
+  def test_read_column_block(self):
+    pathlib.Path(temp("dt7")).unlink(missing_ok=True)
+    ref = np.random.rand(64, 2048).astype(np.float32)
+    Tensor(ref).to(f"disk:{temp('dt7')}").realize()
+    t = Tensor.empty(64, 2048, device=f"disk:{temp('dt7')}")
+    # 4 KB rows are read with preadv, the 512 byte ones from the mmap
+    np.testing.assert_equal(t[:, 1024:].to(Device.DEFAULT).numpy(), ref[:, 1024:])
+    np.testing.assert_equal(t[3:40, 100:228].to(Device.DEFAULT).numpy(), ref[3:40, 100:228])
+    # a short read reads the rest, without preadv (like on windows) the rows are copied from the mmap
+    preadv = os.preadv
+    try:
+      os.preadv = lambda fd, bufs, offset: preadv(fd, [bufs[0][:100]], offset)
+      np.testing.assert_equal(t[:, 1024:].to(Device.DEFAULT).numpy(), ref[:, 1024:])
+      del os.preadv
+      np.testing.assert_equal(t[:, 1024:].to(Device.DEFAULT).numpy(), ref[:, 1024:])
+    finally: os.preadv = preadv
+
   def test_assign_slice(self):
     pathlib.Path(temp("dt4")).unlink(missing_ok=True)
     cc = Tensor.arange(10, device="CPU").to(f"disk:{temp('dt4')}").realize()
@@ -49,6 +49,13 @@ class CheckingShapeTracker:
     self.st.stride(arg)
     self.t = self.t[tuple([slice(None, None, x) for x in arg])]
 
+  def window(self, arg):
+    self.st.window(arg)
+    n = len(self.shape)-len(arg)
+    o = tuple((i-d*(k-1)-1)//s+1 for i,(k,s,d) in zip(self.shape[n:], arg))
+    strides = self.t.strides[:n] + tuple(st*s for st,(_,s,_) in zip(self.t.strides[n:], arg)) + tuple(st*d for st,(_,_,d) in zip(self.t.strides[n:], arg))
+    self.t = np.lib.stride_tricks.as_strided(self.t, self.shape[:n] + o + tuple(k for k,_,_ in arg), strides)
+
   def __getitem__(self, val):
     return self.t.flatten()[val]
 
@@ -482,6 +489,49 @@ class TestShapeTracker(unittest.TestCase):
     self.test_expand()
     self.test_permute()
 
+class TestMemoizedShapeTracker(unittest.TestCase):
+  def test_shared_views_independent(self):
+    st1, st2 = ShapeTracker((4, 6)), ShapeTracker((4, 6))
+    st1.permute((1, 0)).pad(((1, 1), (0, 0)))
+    st2.permute((1, 0)).pad(((1, 1), (0, 0)))
+    assert st1.views == st2.views and st1.views is not st2.views
+    st2.shrink(((1, 7), (0, 4)))
+    assert st1.shape == (8, 4) and st2.shape == (6, 4)
+
+  def test_real_strides_after_movement(self):
+    st = ShapeTracker((4, 6))
+    st.permute((1, 0)).pad(((1, 1), (0, 0)))
+    assert st.real_strides() == st.real_strides() == (None, 6)
+    assert st.real_strides(ignore_valid=True) == (1, 6)
+    st.shrink(((1, 7), (0, 4)))
+    assert st.real_strides() == (1, 6)
+
+class TestWindowShapeTracker(unittest.TestCase):
+  def setUp(self): self.st = CheckingShapeTracker((2, 7, 9))
+  def tearDown(self): self.st.assert_same()
+
+  def test_window(self):
+    self.st.window(((3, 1, 1), (3, 1, 1)))
+    assert len(self.st.views) == 1
+
+  def test_window_stride_dilation(self):
+    self.st.window(((2, 3, 2), (3, 2, 3)))
+    assert len(self.st.views) == 1
+
+  def test_window_permuted(self):
+    self.st.permute((0, 2, 1))
+    self.st.window(((3, 2, 1),))
+    assert len(self.st.views) == 1
+
+  def test_window_padded(self):
+    self.st.pad(((0, 0), (1, 1), (2, 2)))
+    self.st.window(((3, 2, 1), (5, 1, 1)))
+
+  def test_window_pad_other_dim(self):
+    self.st.pad(((1, 1), (0, 0), (0, 0)))
+    self.st.window(((3, 2, 1),))
+    assert len(self.st.views) == 1
+
 class TestGetContraction(unittest.TestCase):
   def test_contraction(self):
     r = get_contraction((1,2,3,4), (2,3,4))
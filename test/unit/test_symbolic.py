@@ -210,6 +210,13 @@ class TestSymbolic(unittest.TestCase):
   def test_div_into_mod(self):
     self.helper_test_variable((Variable("idx", 0, 16)*4)%8//4, 0, 1, "(idx%2)")
 
+  def test_substitute(self):
+    a, b = Variable("a", 0, 7), Variable("b", 0, 3)
+    valid = Variable.ands([((a*-2)+(b*-1)) < 0, (a+b) < 9])
+    self.helper_test_variable(valid.substitute({a: Variable("a", 1, 5)}), 1, 1, "1")
+    self.helper_test_variable(valid.substitute({a: Variable.num(0)}), 0, 1, "((b*-1)<0)")
+    self.helper_test_variable(((a*3+b)//4).substitute({b: Variable.num(1)}), 0, 5, "(((a*3)+1)//4)")
+
 class TestSymbolicNumeric(unittest.TestCase):
   def helper_test_numeric(self, f):
     # TODO: why are the negative tests broken? (even if we did support negative variables)
@@ -1,8 +1,8 @@
 from typing import Final, Dict, ClassVar, List, Optional, NamedTuple, DefaultDict, Tuple, Union
 import math, collections
-from tinygrad.codegen.linearizer import Linearizer, UOps, UOp, MemOp, ConstOp
+from tinygrad.codegen.linearizer import Linearizer, UOps, UOp, MemOp, ConstOp, optimize_uops, split_border
 from tinygrad.ops import ASTRunner, UnaryOps, BinaryOps, TernaryOps
-from tinygrad.helpers import ImageDType, dtypes, colored, getenv, prod, DType
+from tinygrad.helpers import ImageDType, dtypes, colored, getenv, prod, DType, compile_stage
 from tinygrad.shape.symbolic import DivNode, AndNode, render_python, NumNode, Variable
 
 # div is different in cl than python
@@ -23,6 +23,8 @@ class CStyleLanguage(NamedTuple):
   extra_args: List[str] = []
   float4: Optional[str] = None
   half_prekernel: Optional[str] = None
+  bf16_prekernel: Optional[str] = None  # defines bf16_to_float and float_to_bf16, bfloat16 buffers are unsigned short
+  f16_prekernel: Optional[str] = None  # defines half_to_float and float_to_half, half buffers are unsigned short
   uses_vload: bool = False
   external_local_bufs: bool = False
   code_for_op: Dict = {
@@ -32,8 +34,8 @@ class CStyleLanguage(NamedTuple):
     UnaryOps.SQRT: lambda x: f"sqrt({x})",
     BinaryOps.ADD: lambda a,b: f"({a}+{b})", BinaryOps.SUB: lambda a,b: f"({a}-{b})",
     BinaryOps.MUL: lambda a,b: f"({a}*{b})", BinaryOps.DIV: lambda a,b: f"({a}/{b})",
-    BinaryOps.MAX: lambda a,b: f"max({a},{b})",
-    BinaryOps.CMPEQ: lambda a,b: f"({a}=={b})", TernaryOps.MULACC: lambda a,b,c: f"(({a}*{b})+{c})",
+    BinaryOps.MAX: lambda a,b: f"max({a},{b})", BinaryOps.MOD: lambda a,b: f"fmod({a},{b})",
+    BinaryOps.CMPEQ: lambda a,b: f"({a}=={b})", BinaryOps.CMPLT: lambda a,b: f"({a}<{b})", TernaryOps.MULACC: lambda a,b,c: f"(({a}*{b})+{c})",
     TernaryOps.WHERE: lambda a,b,c: f"({a}!=0?{b}:{c})"
   }
 
@@ -49,9 +51,16 @@ class CStyleLanguage(NamedTuple):
   def render_const(self, x:Union[float,int], var_dtype) -> str:
     if math.isnan(x): val = "NAN"
     elif math.isinf(x): val = ("-" if x < 0 else "") + "INFINITY"
+    elif dtypes.is_int(var_dtype): val = f"{int(x)}"
     else: val = f"{x}" + ("f" if isinstance(x, float) else "")
     return self.render_cast([val]*var_dtype.sz, var_dtype) if var_dtype.sz > 1 else val
 
+  # the conversions to and from float of a dtype that is stored as unsigned short
+  def storage_fxns(self, dtype:DType) -> Optional[Tuple[str, str]]:
+    if self.bf16_prekernel and dtype == dtypes.bfloat16: return ("bf16_to_float", "float_to_bf16")
+    if self.f16_prekernel and dtype == dtypes.float16: return ("half_to_float", "float_to_half")
+    return None
+
   # returns a str expression of the loaded value with the output type
   def render_load(self, output_dtype, buf_name, buf_dtype, idx, local=False) -> str:
     if isinstance(buf_dtype, ImageDType):
@@ -59,6 +68,9 @@ class CStyleLanguage(NamedTuple):
       return f"read_imagef({buf_name}, smp, (int2)({idx[0].render(render_cl)}, {idx[1].render(render_cl)}))"
     if self.uses_vload and buf_dtype == dtypes.float16:
       return f"vload_half{'' if output_dtype.sz == 1 else str(output_dtype.sz)}(0, {buf_name}+{idx.render(render_cl, strip_parens=True)})"
+    if (fxns:=self.storage_fxns(buf_dtype)) is not None:
+      if output_dtype.sz > 1: return f"{buf_dtype.name}{output_dtype.sz}_to_{output_dtype.name}({buf_name}+{idx.render(render_cl, strip_parens=True)})"
+      return f"{fxns[0]}({buf_name}[{idx.render(render_cl)}])"
     if output_dtype.sz > 1:
       return f"({output_dtype.name})(*(({self.smem_prefix if local else self.buffer_prefix}{buf_dtype.name}{output_dtype.sz}*)({buf_name}+{idx.render(render_cl, strip_parens=True)})))"
     return f"{buf_name}[{idx.render(render_cl)}]"
@@ -75,11 +87,13 @@ class CStyleLanguage(NamedTuple):
   def render_kernel(self, kernel:List[str], bufs:List[Tuple[str,DType]], global_size:List[int], local_size:List[int], prekernel:List[str]) -> Tuple[str,List[int],List[int]]:
     tmp = "const sampler_t smp = CLK_NORMALIZED_COORDS_FALSE | CLK_ADDRESS_CLAMP | CLK_FILTER_NEAREST;\n" if any(isinstance(dtype, ImageDType) for _,dtype in bufs) else ""
     buftypes = [(name,f"{'read_only' if i > 0 else 'write_only'} image2d_t" if dtype.name.startswith('image') else
-                ("const " if i > 0 else "")+self.buffer_prefix+dtype.name+"*"+self.buffer_suffix) for i,(name,dtype) in enumerate(bufs)]
+                ("const " if i > 0 else "")+self.buffer_prefix+("unsigned short" if self.storage_fxns(dtype) is not None else dtype.name)+"*"+self.buffer_suffix) for i,(name,dtype) in enumerate(bufs)]
     prg = ''.join([f"{self.kernel_prefix} void KERNEL_NAME_PLACEHOLDER(",] +
     [', '.join([f'{t} {name}' for name,t in buftypes] + self.extra_args)] +
     [") {\n" + tmp] + ['\n'.join(kernel), "\n}"])
     if self.half_prekernel and any(dtype == dtypes.float16 for _,dtype in bufs): prg = ''.join([f"{self.half_prekernel}", "\n", prg])
+    if self.bf16_prekernel and (any(dtype == dtypes.bfloat16 for _,dtype in bufs) or "float_to_bf16(" in prg): prg = ''.join([f"{self.bf16_prekernel}", "\n", prg])
+    if self.f16_prekernel and (any(dtype == dtypes.float16 for _,dtype in bufs) or "float_to_half(" in prg): prg = ''.join([f"{self.f16_prekernel}", "\n", prg])
 
     return prg, global_size[::-1], local_size[::-1]
 
@@ -90,6 +104,9 @@ class CStyleLanguage(NamedTuple):
       return f"write_imagef({buf_name}, (int2)({idx[0].render(render_cl)}, {idx[1].render(render_cl)}), {var_name});"
     if self.uses_vload and buf_dtype == dtypes.float16:
       return f"vstore_half{'' if var_dtype.sz == 1 else str(var_dtype.sz)}({var_name}, 0, {buf_name}+{idx.render(render_cl, strip_parens=True)});"
+    if (fxns:=self.storage_fxns(buf_dtype)) is not None:
+      if var_dtype.sz > 1: return f"{var_dtype.name}_to_{buf_dtype.name}{var_dtype.sz}({buf_name}+{idx.render(render_cl, strip_parens=True)}, {var_name});"
+      return f"{buf_name}[{idx.render(render_cl)}] = {fxns[1]}({var_name});"
     if var_dtype.sz > 1:
       return f"*(({self.smem_prefix if local else self.buffer_prefix}{buf_dtype.name}{var_dtype.sz}*)({buf_name}+{idx.render(render_cl, strip_parens=True)})) = ({buf_dtype.name}{var_dtype.sz}){var_name};"
     return f"{buf_name}[{idx.render(render_cl)}] = {var_name};"
@@ -107,6 +124,7 @@ def add_gl_dimension(prefix: str, args, i:int, var, local_size:List[int], xid:Li
   local_size.append(var.max+1)
   return f"{{ {prefix} {var.expr} = {xid[min(len(xid), len(args[0]))-1-i]};  /* {var.max+1} */"
 
+@compile_stage("render")
 def uops_to_cstyle(uops:List[UOp], lang:CStyleLanguage) -> Tuple[str, List[int], List[int]]:
   kernel,global_size,local_size,prekernel = [],[],[],[]
   pend_close = None
@@ -133,6 +151,8 @@ def uops_to_cstyle(uops:List[UOp], lang:CStyleLanguage) -> Tuple[str, List[int],
       depth += 1
     elif uop == UOps.BARRIER:
       kk(lang.barrier)
+    elif uop == UOps.INDEX:
+      kk(f"{lang.size_prefix} {args[0].expr} = {args[1].render(render_cl)};")
     elif uop == UOps.ENDLOOP:
       if args[1] == "local" and len(lang.lid):
         # TODO: this is a bit of a hack. the local loop isn't real on the GPU
@@ -171,8 +191,13 @@ def uops_to_cstyle(uops:List[UOp], lang:CStyleLanguage) -> Tuple[str, List[int],
       assert args.valid.min == 1 and isinstance(args, MemOp), "store must be valid and to memory"
       # TODO: instead of dtypes.float, a base type
       kk(lang.render_store(args.name, args.memory_dtype, vin[0].render(), vin[0].dtype if vin[0].offset is None else dtypes.float, args.idx, args.local))
+    elif uop == UOps.CAST and newvar is not None and args in (dtypes.bfloat16, dtypes.float16):
+      fxns = lang.storage_fxns(args)
+      kk(f"{lang.generic_var_prefix}{newvar.render(lang.generic_var_prefix == '')} = {f'{fxns[0]}({fxns[1]}({vin[0].render()}))' if fxns is not None else vin[0].render()};")
     elif uop == UOps.CAST and newvar is not None and newvar.dtype.sz > 1:
       kk(f"{newvar.render(True)} = {lang.render_cast([x.render() for x in vin], newvar.dtype)};")
+    elif uop == UOps.CAST and newvar is not None:
+      kk(f"{lang.generic_var_prefix}{newvar.render(lang.generic_var_prefix == '')} = ({newvar.dtype.name})({vin[0].render()});")
     elif uop == UOps.DEFINE_LOCAL:
       if lang.external_local_bufs:
         prekernel.append(lang.render_local(args[0], args[1]))
@@ -199,7 +224,10 @@ class CStyleCodegen(Linearizer):
     self.process()
     self.hand_coded_optimizations()
     self.limit_global_dims(len(self.lang.gid))  # NOTE: this is optional now
+    self.split_reduce_divmod()
     self.linearize()
+    if not self.lang.gid: self.uops = split_border(self.uops)
+    self.uops = optimize_uops(self.uops)
 
     prg, global_size, local_size = uops_to_cstyle(self.uops, self.lang)
 
@@ -1,19 +1,19 @@
-from typing import List, Tuple, Any, Optional, cast, DefaultDict, NamedTuple, TypeVar, Dict, Iterator, Union, Sequence
-import itertools, math
+from typing import List, Tuple, Any, Optional, cast, DefaultDict, NamedTuple, TypeVar, Dict, Iterator, Union, Sequence, Callable, Set
+import itertools, math, operator, struct
 from collections import defaultdict
 from enum import Enum, auto
 
-from tinygrad.helpers import dedup, colored, ImageDType, DEBUG, prod, dtypes, mnum, DType, all_same, partition, getenv
-from tinygrad.ops import LazyOp, FlopCounter, get_lazyop_info, UnaryOps
+from tinygrad.helpers import dedup, colored, ImageDType, DEBUG, prod, dtypes, mnum, DType, all_same, partition, getenv, flatten, compile_stage, ContextVar
+from tinygrad.ops import LazyOp, FlopCounter, get_lazyop_info, UnaryOps, Op
 from tinygrad.lazy import LazyBuffer
-from tinygrad.ops import MovementOps, ReduceOps, BinaryOps, TernaryOps
-from tinygrad.runtime.lib import RawConst, buf_is_kernel_arg
+from tinygrad.ops import MovementOps, ReduceOps, BinaryOps, TernaryOps, LoadOps
+from tinygrad.runtime.lib import RawBuffer, RawConst, buf_is_kernel_arg
 from tinygrad.shape.shapetracker import ShapeTracker, strides_for_shape, View
-from tinygrad.shape.symbolic import Variable, NumNode, Node, SumNode, MulNode
+from tinygrad.shape.symbolic import Variable, NumNode, Node, SumNode, MulNode, DivNode, ModNode, LtNode, AndNode, OpNode, RedNode
 VariableOrNum = Union[Variable, NumNode, Node]
 
 # bottom ones are asm only
-class UOps(Enum): LOOP = auto(); DEFINE_LOCAL = auto(); DEFINE_GLOBAL = auto(); LOAD = auto(); ALU = auto(); ENDLOOP = auto(); STORE = auto(); CAST = auto(); BARRIER = auto(); WMMA = auto(); \
+class UOps(Enum): LOOP = auto(); DEFINE_LOCAL = auto(); DEFINE_GLOBAL = auto(); LOAD = auto(); ALU = auto(); ENDLOOP = auto(); STORE = auto(); CAST = auto(); BARRIER = auto(); WMMA = auto(); INDEX = auto(); \
                   SPECIAL = auto(); DEFINE_REGISTER = auto(); LABEL = auto(); COND_BRANCH = auto() # noqa: E702
 
 def to_image_idx(base_shape:Tuple[int, ...], idxy:Node, valid:Node, validhacks=False) -> Tuple[Node, Node]:
@@ -36,6 +36,12 @@ def to_image_idx(base_shape:Tuple[int, ...], idxy:Node, valid:Node, validhacks=F
   if DEBUG >= 5: print("to_image_idx", base_shape, idx.min, idx.max, idy.min, idy.max, idx, idy)
   return idx, idy
 
+def divmod_nodes(x:Node) -> List[Node]:
+  if isinstance(x, (DivNode, ModNode)): return [x] + divmod_nodes(x.a)
+  if isinstance(x, OpNode): return divmod_nodes(x.a)
+  if isinstance(x, RedNode): return flatten(divmod_nodes(n) for n in x.nodes)
+  return []
+
 class LocalBuffer(NamedTuple):
   name: str
   size: int
@@ -112,19 +118,19 @@ def expand_idxs(idxs:Sequence[Node]) -> Iterator[Tuple[Node, ...]]:
 
 class MemOp(NamedTuple):
   name: str
-  idx: Variable
+  idx: Node
   local: bool
   memory_dtype: DType
 
   # shared
-  valid: Variable
+  valid: Node
   invalid_value: Union[float, int] = 0.0
 
 class ConstOp(NamedTuple):
   value: float
 
   # shared
-  valid: Variable
+  valid: Node
   invalid_value: Union[float, int] = 0.0
 
 class UOp(NamedTuple):
@@ -134,9 +140,187 @@ class UOp(NamedTuple):
   arg: Any
   def __repr__(self): return f"{str(self.uop):20s}: {str(self.out) if self.out is not None else '':25s} {str(self.vin):32s} {self.arg}"
 
+# NOTE: the idx of an image MemOp is a tuple of the x and y index
+def map_idx(fxn:Callable[[Node], Node], idx:Any) -> Any: return tuple(fxn(x) for x in idx) if isinstance(idx, tuple) else fxn(idx)
+
+# ******************** uop optimizer ********************
+
+# python versions of the ALU ops, used to fold constants at codegen time
+python_alu: Dict[Op, Callable] = {
+  UnaryOps.EXP2: lambda x: 2.0**x, UnaryOps.LOG2: math.log2, UnaryOps.SIN: math.sin, UnaryOps.SQRT: math.sqrt,
+  BinaryOps.ADD: operator.add, BinaryOps.SUB: operator.sub, BinaryOps.MUL: operator.mul, BinaryOps.DIV: operator.truediv,
+  BinaryOps.MAX: max, BinaryOps.CMPEQ: lambda x,y: float(x == y), BinaryOps.CMPLT: lambda x,y: float(x < y), BinaryOps.MOD: math.fmod,
+  TernaryOps.MULACC: lambda x,y,z: x*y+z, TernaryOps.WHERE: lambda x,y,z: y if x != 0 else z }
+commutative_ops = {BinaryOps.ADD, BinaryOps.MUL, BinaryOps.MAX, BinaryOps.CMPEQ}
+
+# the buffers and ops of a sum that are exact in int32 math
+INT32_SAFE = {dtypes.int8, dtypes.uint8, dtypes.int32}
+INT_OPS = {UnaryOps.NOOP, UnaryOps.CAST, BinaryOps.ADD, BinaryOps.SUB, BinaryOps.MUL, ReduceOps.SUM}
+
+# the value a token holds, a lane of a float4 is a float
+def token_dtype(x:Token) -> DType: return dtypes.float if x.offset is not None else x.dtype
+
+# returns a constant, a token that already holds the result, or None if the ALU op can't be simplified
+def simplify_alu(op:Op, vin:List[Token], consts:Dict[str, float]) -> Union[float, Token, None]:
+  c = [consts.get(x.name) if x.offset is None else None for x in vin]
+  if op in python_alu and all(x is not None for x in c):
+    try: return struct.unpack('f', struct.pack('f', python_alu[op](*c)))[0]   # float32 like the kernel
+    except (ValueError, ZeroDivisionError, OverflowError): return None
+  if op == BinaryOps.ADD and 0 in c: return vin[1-c.index(0)]
+  if op == BinaryOps.SUB and c[1] == 0: return vin[0]
+  if op == BinaryOps.MUL and 1 in c: return vin[1-c.index(1)]
+  # NOTE: x*0 and MULACC(0,y,acc) aren't folded, they are nan for an inf or a nan
+  if op == BinaryOps.DIV and c[1] == 1: return vin[0]
+  if op == BinaryOps.MAX and -math.inf in c: return vin[1-c.index(-math.inf)]
+  if op == TernaryOps.WHERE and c[0] is not None: return vin[1] if c[0] != 0 else vin[2]
+  return None
+
+# common subexpression elimination, constant folding and dead code elimination on linearized uops
+# NOTE: accumulators are assigned more than once, they are never folded, merged or removed
+@compile_stage("optimize_uops")
+def optimize_uops(uops:List[UOp]) -> List[UOp]:
+  if not getenv("UOPT", 1): return uops
+  defs: DefaultDict[str, int] = defaultdict(int)
+  for u in uops:
+    if u.out is not None: defs[u.out.name] += 1
+    if u.uop == UOps.WMMA:
+      for x in u.vin: defs[x.name] += 2
+  mutable = {k for k,v in defs.items() if v > 1}
+
+  replace: Dict[str, Token] = {}
+  consts: Dict[str, float] = {}
+  # available expressions, one dict per open loop. the loads are killed by STOREs and BARRIERs
+  scopes: List[Dict[Any, Token]] = [{}]
+  def rename(x:Token) -> Token:
+    if x.name not in replace: return x
+    return replace[x.name] if x.offset is None else Token(replace[x.name].name, replace[x.name].dtype, x.offset)
+  def merge(key, u:UOp) -> bool:
+    for scope in scopes:
+      if key in scope and token_dtype(scope[key]) == token_dtype(cast(Token, u.out)):
+        replace[cast(Token, u.out).name] = scope[key]
+        return True
+    scopes[-1][key] = cast(Token, u.out)
+    return False
+
+  ret: List[UOp] = []
+  for u in uops:
+    u = UOp(u.uop, u.out, [rename(x) for x in u.vin], u.arg)
+    if u.uop == UOps.LOOP: scopes.append({})
+    elif u.uop == UOps.ENDLOOP and len(scopes) > 1: scopes.pop()
+    elif u.uop in {UOps.BARRIER, UOps.STORE}:
+      for scope in scopes:
+        for k in [k for k in scope if k[0] == UOps.LOAD and isinstance(k[1], MemOp) and (u.uop == UOps.BARRIER or k[1].name == u.arg.name)]: del scope[k]
+    elif u.out is not None and u.out.name not in mutable:
+      if u.uop == UOps.ALU and not any(x.name in mutable for x in u.vin):
+        if isinstance(folded := simplify_alu(u.arg, u.vin, consts), Token) and token_dtype(folded) == token_dtype(u.out) and (u.out.dtype.sz == 1 or folded.offset is None):
+          replace[u.out.name] = folded
+          continue
+        if isinstance(folded, float) and u.out.dtype.sz == 1: u = UOp(UOps.LOAD, u.out, [], ConstOp(int(folded) if dtypes.is_int(u.out.dtype) else folded, Variable.num(1)))
+      if u.uop == UOps.LOAD:
+        # loads that are never valid are constants
+        if isinstance(u.arg, MemOp) and u.arg.valid.max == 0: u = UOp(UOps.LOAD, u.out, [], ConstOp(u.arg.invalid_value, Variable.num(1)))
+        if isinstance(u.arg, ConstOp) and u.arg.valid.min == 1 and cast(Token, u.out).dtype.sz == 1: consts[cast(Token, u.out).name] = u.arg.value
+        if merge((u.uop, u.arg), u): continue
+      elif u.uop in {UOps.ALU, UOps.CAST} and not any(x.name in mutable for x in u.vin):
+        if merge((u.uop, u.arg, tuple(sorted(u.vin, key=str) if u.arg in commutative_ops else u.vin)), u): continue
+    elif u.uop == UOps.ALU and u.out is not None and simplify_alu(u.arg, u.vin, consts) == u.out:
+      continue   # the accumulator doesn't change
+    ret.append(u)
+
+  # dead code elimination, walk backward and drop anything that isn't used
+  used: Set[str] = set()
+  live: List[UOp] = []
+  for u in reversed(ret):
+    if u.uop in {UOps.ALU, UOps.LOAD, UOps.CAST} and u.out is not None and u.out.name not in used and u.out.name not in mutable: continue
+    used.update(x.name for x in u.vin)
+    live.append(u)
+  if DEBUG >= 4: print(f"optimize_uops removed {len(uops)-len(live)} of {len(uops)} uops")
+  return hoist_index_exprs(live[::-1])
+
+# loop invariant code motion for the index math. the parts of a MemOp idx and valid that don't use the variables of the
+# innermost loop are computed once by an INDEX uop, placed after the LOOP of the deepest variable they do use
+def hoist_index_exprs(uops:List[UOp]) -> List[UOp]:
+  loops: List[Tuple[int, List[str]]] = []   # (position, variable names) of the open loops
+  hoisted: DefaultDict[int, List[UOp]] = defaultdict(list)
+  defined: Dict[Tuple[int, str], Node] = {}
+  # the index of a gather or a scatter uses a loaded token, it's never hoisted
+  tokens = {u.out.name for u in uops if u.out is not None}
+  def level(x:Node) -> int: return max([i for i,(_,l) in enumerate(loops) if any(v.expr in l for v in x.vars())] + [len(loops) for v in x.vars() if v.expr in tokens], default=-1)
+  def define(x:Node, lvl:int) -> Node:
+    x = lift(x, lvl)
+    if (key := (loops[lvl][0], x.key)) not in defined:
+      defined[key] = Variable(f"hidx{len(defined)}", x.min, x.max)
+      hoisted[loops[lvl][0]].append(UOp(UOps.INDEX, None, [], (defined[key], x)))
+    return defined[key]
+  def lift(x:Node, lvl:int) -> Node:
+    if isinstance(x, (Variable, NumNode)): return x
+    if x.min >= 0 and 0 <= (xl := level(x)) < lvl: return define(x, xl)
+    if isinstance(x, SumNode):
+      # the constant offsets stay in the loop, so loads that only differ by them share the hoisted part
+      invariant, variant = partition(x.flat_components, lambda n: n.__class__ is not NumNode and level(n) < lvl)
+      if not isinstance(inv := Variable.sum(invariant), (Variable, NumNode)) and inv.min >= 0: invariant = [define(inv, level(inv))]
+      return Variable.sum(invariant + [lift(n, lvl) for n in variant])
+    if isinstance(x, MulNode): return lift(x.a, lvl) * x.b
+    if isinstance(x, DivNode): return lift(x.a, lvl) // x.b
+    if isinstance(x, ModNode): return lift(x.a, lvl) % x.b
+    if isinstance(x, LtNode): return lift(x.a, lvl) < x.b
+    if isinstance(x, AndNode): return Variable.ands([lift(n, lvl) for n in x.nodes])
+    return x
+
+  ret: List[UOp] = []
+  for i,u in enumerate(uops):
+    if u.uop == UOps.LOOP: loops.append((i, [cast(str, v.expr) for v in u.arg[0] if isinstance(v, Variable)]))
+    elif u.uop == UOps.ENDLOOP: loops = loops[:-2] if u.arg[1] == "global+local" else loops[:-1]
+    elif isinstance(u.arg, MemOp) and loops:
+      u = UOp(u.uop, u.out, u.vin, u.arg._replace(idx=map_idx(lambda x: lift(x, len(loops)-1), u.arg.idx), valid=lift(u.arg.valid, len(loops)-1)))
+    ret.append(u)
+  return flatten([u]+hoisted[i] for i,u in enumerate(ret))
+
+# split the global and local loops into an interior where every valid is true, and the borders around it where they are checked
+# NOTE: this is only for backends where the global and local loops are real loops. the body is copied up to 5 times, it's only done with BORDER=1
+# and for the valids in a reduce loop, where a check is paid on every iteration. it adds about 75% to the compile time of a resnet18
+BORDER = ContextVar("BORDER", 0)
+@compile_stage("split_border")
+def split_border(uops:List[UOp]) -> List[UOp]:
+  if not BORDER or not (loops := [i for i,u in enumerate(uops) if u.uop == UOps.LOOP and u.arg[1] in {"global", "local"}]): return uops
+  start, end = loops[0], max(i for i,u in enumerate(uops) if u.uop == UOps.ENDLOOP and u.arg[1] in {"global", "global+local"})
+  depth = list(itertools.accumulate((u.uop == UOps.LOOP and u.arg[1] == "reduce") - (u.uop == UOps.ENDLOOP and u.arg[1] == "reduce") for u in uops[start:end]))
+  terms = dedup(flatten(u.arg.valid.nodes if isinstance(u.arg.valid, AndNode) else [u.arg.valid] for u,d in zip(uops[start:end], depth) if d > 0 and isinstance(u.arg, (MemOp, ConstOp))))
+  interior: Dict[Variable, Tuple[int, int]] = {}
+  for v in [v for i in loops for v in uops[i].arg[0] if isinstance(v, Variable) and v.max < 1024]:
+    if len(interior) == 2 or not (vterms := [t for t in terms if v in t.vars()]): continue
+    good = [all(t.substitute({v: Variable.num(x)}).min == 1 for t in vterms) for x in range(v.min, v.max+1)]
+    if True not in good: continue
+    lo, hi = good.index(True), len(good)-1-good[::-1].index(True)
+    if all(good[lo:hi+1]) and (lo, hi) != (0, len(good)-1): interior[v] = (v.min+lo, v.min+hi)
+  if not interior: return uops
+
+  # the borders of each axis keep the full range of the axes after it
+  regions: List[Dict[Variable, Node]] = []
+  inner: Dict[Variable, Node] = {}
+  for v,(lo,hi) in interior.items():
+    regions += [{**inner, v: Variable(v.expr, a, b)} for a,b in [(v.min, lo-1), (hi+1, v.max)] if a <= b]
+    inner[v] = Variable(v.expr, lo, hi)
+  if DEBUG >= 4: print(f"split_border into {len(regions)+1} regions, interior {interior}")
+
+  ret = uops[:start]
+  for k,region in enumerate([inner]+regions):
+    def tk(x:Token) -> Token: return Token(f"{x.name}_{k}", x.dtype, x.offset) if k else x
+    for u in uops[start:end+1]:
+      arg = u.arg
+      if u.uop in {UOps.LOOP, UOps.ENDLOOP}: arg = ([x.substitute(region) for x in arg[0]], arg[1])
+      # the index of a gather or a scatter uses the token of the loaded index
+      elif isinstance(arg, MemOp): arg = arg._replace(idx=map_idx(lambda i: i.substitute({**region, **{v:Variable(tk(x).name, v.min, v.max) for x in u.vin for v in i.vars() if v.expr == x.name}}), arg.idx), valid=arg.valid.substitute(region))
+      elif isinstance(arg, ConstOp): arg = arg._replace(valid=arg.valid.substitute(region))
+      ret.append(UOp(u.uop, tk(u.out) if u.out is not None else None, [tk(x) for x in u.vin], arg))
+  return ret + uops[end+1:]
+
 class Linearizer:
   supports_float4: bool = False
   supports_float4_alu: bool = False
+  supports_half4: bool = False  # half buffers are loaded and stored 4 at a time, even without float4
+  supports_int_reduce: bool = True
+  supports_serial_scatter: bool = False  # the kernel runs the rows of a scatter one after the other, without it a row that's in idx twice would race
 
   def __init__(self, ast:LazyOp, output_buffer:LazyBuffer):
     # NOTE: if there's a RESHAPE, we skip it. the output shape is set from the reduce op or a latebuf
@@ -156,6 +340,7 @@ class Linearizer:
     assert self.bufs[i].realized.__class__ is not RawConst  # constants shouldn't be loaded with memops
     return self.arg_bufs[self.bufs[i].realized]
 
+  @compile_stage("process")
   def process(self) -> None:
     if hasattr(self, "sts"): return   # already processed
 
@@ -171,6 +356,10 @@ class Linearizer:
     # get earlybufs, before the one reduce op
     self.earlybufs = dedup(self.reduceop.buffers) if self.reduceop else []
 
+    # a gather loads and a scatter stores the rows of a table at the indices loaded from an int buffer, the view of the table is its first row
+    self.gathers: Dict[LazyBuffer, LazyBuffer] = {cast(LazyBuffer, x.src[0]):cast(LazyBuffer, x.src[1]) for x in self.ast.get_lazyops() if x.op == LoadOps.GATHER}
+    self.scatter: Optional[LazyBuffer] = cast(LazyBuffer, cast(LazyOp, self.ast).src[1]) if self.ast.op == LoadOps.SCATTER else None
+
     # create new shapetrackers inside this kernel, we will permute them
     self.sts: List[ShapeTracker] = [x.st.copy() for x in self.bufs]
     for st in self.sts: st.simplify()
@@ -192,6 +381,10 @@ class Linearizer:
     self.use_tensor_cores: bool = False
     self.exclude_local_upcast: int = 0
 
+    # int32 sums, like a widened int8 matmul, are done with int32 math and accumulator. the other int sums are float math like before
+    self.int_reduce: bool = self.supports_int_reduce and self.reduceop is not None and self.reduceop.op == ReduceOps.SUM and all(b.dtype in INT32_SAFE for b in self.earlybufs) and \
+      all(x.op in INT_OPS for x in self.reduceop.get_lazyops()) and (all(b.dtype == dtypes.int32 for b in self.earlybufs) or any(x.op == UnaryOps.CAST and x.arg == dtypes.int32 for x in self.reduceop.get_lazyops()))
+
     # group simplifies
     self.simplify_ones()
     self.simplify_merge_adjacent()
@@ -215,10 +408,10 @@ class Linearizer:
     return [sum(t) for t in itertools.product(*[[y*acc_strides[i] for y in range(x[0])] for i,x in enumerate(upcasted_i[::-1])])]
 
   def get_upcast_dim(self, i) -> List[int]:
-    should_upcast = self.supports_float4 and (self.bufs[i].dtype in [dtypes.float32, dtypes.float16] or isinstance(self.bufs[i].dtype, ImageDType))
+    should_upcast = (self.supports_float4 and (self.bufs[i].dtype in [dtypes.float32, dtypes.float16] or isinstance(self.bufs[i].dtype, ImageDType))) or (self.supports_half4 and self.bufs[i].dtype == dtypes.float16)
     return [x for x in self.sts[i].unit_stride_axes() if should_upcast and x >= self.shape_len-self.upcasted and self.sts[i].shape[x] > 1]
 
-  def global_load(self, i:int, idxs:Sequence[VariableOrNum], const=None) -> List[Token]:
+  def global_load(self, i:int, idxs:Sequence[VariableOrNum], const=None, ltype:DType=dtypes.float32, gather:Optional[List[Token]]=None) -> List[Token]:
     if isinstance(self.bufs[i].realized, RawConst): const = self.bufs[i].realized._buf
 
     expanded_nodes = [expand_node(idx) for idx in idxs]
@@ -226,30 +419,48 @@ class Linearizer:
     upcast_dim = self.get_upcast_dim(i)
 
     amt = 1
-    if len(upcast_dim) == 1 and len(expanded_nodes[upcast_dim[0]]) in [4,2]:
+    if len(upcast_dim) == 1 and len(expanded_nodes[upcast_dim[0]]) in [4,2] and ltype == dtypes.float32 and gather is None:
       dim, amt = upcast_dim[0], len(expanded_nodes[upcast_dim[0]])
 
     cache: Dict[str, Token] = {}
     ret = []
-    for _idx in _idxs:
+    for k,_idx in enumerate(_idxs):
       if amt > 1:
         idx, valid = self.sts[i].expr_idxs((_idx[:dim] + (expanded_nodes[dim][0],) + _idx[dim+1:]))
         localtype = dtypes._float4 if amt == 4 else dtypes._float2
         if idx.render() != ((idx//amt)*amt).render():
           idx, valid = self.sts[i].expr_idxs(_idx)
-          localtype = dtypes.float32
+          localtype = ltype
       else:
         idx, valid = self.sts[i].expr_idxs(_idx)
-        localtype = dtypes.float32
+        localtype = ltype
+      idx, vin = self.gather_idx(i, idx, gather[k]) if gather is not None else (idx, [])
       key = f"{localtype}{idx.render()}{valid.render()}"
       if key not in cache:
         if isinstance(self.bufs[i].dtype, ImageDType): idx = to_image_idx(self.bufs[i].dtype.shape, idx, valid)
-        cache[key] = self.uop(UOps.LOAD, Token(f"val{mnum(i)}_{len(cache)}", localtype), [], MemOp(self.get_buffer_name(i), idx, self.bufs[i].__class__ is LocalBuffer, self.bufs[i].dtype, valid, 0.0 if not dtypes.is_int(self.bufs[i].dtype) else 0)) if const is None else \
-                     self.uop(UOps.LOAD, Token(f"acc{mnum(i)}_{len(cache)}", localtype), [], ConstOp(const, valid))
-      ret.append(Token(cache[key].name, cache[key].dtype, expanded_nodes[dim].index(_idx[dim])) if localtype != dtypes.float else cache[key])
+        cache[key] = self.uop(UOps.LOAD, Token(f"val{mnum(i)}_{len(cache)}", localtype), vin, MemOp(self.get_buffer_name(i), idx, self.bufs[i].__class__ is LocalBuffer, self.bufs[i].dtype, valid, 0.0 if not dtypes.is_int(self.bufs[i].dtype) else 0)) if const is None else \
+                     self.uop(UOps.LOAD, Token(f"acc{mnum(i)}_{len(cache)}", localtype), [], ConstOp(int(const) if dtypes.is_int(localtype) else const, valid))
+      ret.append(Token(cache[key].name, cache[key].dtype, expanded_nodes[dim].index(_idx[dim])) if localtype.sz > 1 else cache[key])
     return ret
 
-  def global_store(self, i, idxs:List[VariableOrNum], store:List[Token], ssa) -> None:
+  # the row of the index token is added to the index in the view of the first row. the token is in the vin of the uop if the index uses it
+  def gather_idx(self, i:int, idx:Node, tok:Token) -> Tuple[Node, List[Token]]:
+    row = prod(self.info.shape)//cast(RawBuffer, cast(LazyBuffer, self.gathers.get(self.bufs[i], self.scatter)).realized).size
+    idx = idx + Variable(tok.name, 0, cast(RawBuffer, self.bufs[i].realized).size//row-1)*row
+    return idx, [tok] if any(v.expr == tok.name for v in idx.vars()) else []
+
+  # NOTE: negative indices count from the end like python, the ones out of range are clamped to the first or the last row
+  def normalize_idx(self, i:int, toks:List[Token], ssa) -> List[Token]:
+    rows = cast(RawBuffer, self.bufs[i].realized).size//(prod(self.info.shape)//cast(RawBuffer, cast(LazyBuffer, self.gathers.get(self.bufs[i], self.scatter)).realized).size)
+    zero, last, n = [self.uop(UOps.LOAD, ssa("idx", dtypes.int32), [], ConstOp(x, Variable.num(1))) for x in (0, rows-1, rows)]
+    cache: Dict[str, Token] = {}
+    def normalize(x:Token) -> Token:
+      x = self.uop(UOps.ALU, ssa("idx", dtypes.int32), [self.uop(UOps.ALU, ssa("idx", dtypes.int32), [x, zero], BinaryOps.CMPLT), self.uop(UOps.ALU, ssa("idx", dtypes.int32), [x, n], BinaryOps.ADD), x], TernaryOps.WHERE)
+      x = self.uop(UOps.ALU, ssa("idx", dtypes.int32), [x, zero], BinaryOps.MAX)
+      return self.uop(UOps.ALU, ssa("idx", dtypes.int32), [self.uop(UOps.ALU, ssa("idx", dtypes.int32), [x, last], BinaryOps.CMPLT), x, last], TernaryOps.WHERE)
+    return [cache[x.name] if x.name in cache else cache.setdefault(x.name, normalize(x)) for x in toks]
+
+  def global_store(self, i, idxs:List[VariableOrNum], store:List[Token], ssa, gather:Optional[List[Token]]=None) -> None:
     expanded_nodes = [expand_node(idx) for idx in idxs]
     _idxs = [x[::-1] for x in itertools.product(*expanded_nodes[::-1])]
     upcast_dim = self.get_upcast_dim(i)
@@ -257,7 +468,7 @@ class Linearizer:
     store_offset = dict(zip(_idxs, store))
 
     # float4 grouping
-    if len(upcast_dim) == 1 and len(expanded_nodes[upcast_dim[0]]) in [2,4]:
+    if len(upcast_dim) == 1 and len(expanded_nodes[upcast_dim[0]]) in [2,4] and gather is None:
       grouped_store_offset = defaultdict(list)
       for k in store_offset:
         _idx = k[:upcast_dim[0]] + (expanded_nodes[upcast_dim[0]][0],) + k[upcast_dim[0]+1:]
@@ -274,11 +485,13 @@ class Linearizer:
           store_offset_new[k] = self.uop(UOps.CAST, ssa("alu", dtypes._float4 if amt == 4 else dtypes._float2), out_tokens)
       store_offset = store_offset_new
 
-    for idx, var in store_offset.items():
-      idx, valid = self.sts[i].expr_idxs(idx)
+    for j, (_idx, var) in enumerate(store_offset.items()):
+      idx, valid = self.sts[i].expr_idxs(_idx)
       if isinstance(self.bufs[i].dtype, ImageDType): idx = to_image_idx(self.bufs[i].dtype.shape, idx, valid)
-      self.uop(UOps.STORE, None, [var], MemOp(self.get_buffer_name(i), idx, self.bufs[i].__class__ is LocalBuffer, self.bufs[i].dtype, valid))
+      idx, vin = self.gather_idx(i, idx, gather[j]) if gather is not None else (idx, [])
+      self.uop(UOps.STORE, None, [var] + vin, MemOp(self.get_buffer_name(i), idx, self.bufs[i].__class__ is LocalBuffer, self.bufs[i].dtype, valid))
 
+  @compile_stage("linearize")
   def linearize(self):
     # uops
     self.uops: List[UOp] = []
@@ -310,6 +523,9 @@ class Linearizer:
     loaded_buffers = {}
     acc = []
 
+    # the local buffers and tensor cores are float, the rest of the kernel after the reduce is too
+    acc_type = dtypes.int32 if self.int_reduce and not self.group_for_reduce and not self.use_tensor_cores else dtypes.float32
+
     # ssa
     _ssa:DefaultDict[str,int] = defaultdict(int)
     def ssa(name, ltype=dtypes.float) -> Token:
@@ -336,10 +552,10 @@ class Linearizer:
       fake_reduce_idxs = [x*0 for x in reduce_idxs]
 
       # define accumulator
-      acc = self.global_load(0, global_idxs+local_idxs+fake_reduce_idxs+upcast_idxs, {ReduceOps.SUM: 0.0, ReduceOps.MAX: -math.inf}[cast(ReduceOps, self.reduceop.op)])
+      acc = self.global_load(0, global_idxs+local_idxs+fake_reduce_idxs+upcast_idxs, {ReduceOps.SUM: 0.0, ReduceOps.MAX: -math.inf}[cast(ReduceOps, self.reduceop.op)], acc_type)
 
-      # reduce loop
-      self.uop(UOps.LOOP, None, [], (reduce_idxs, "reduce"))
+      # reduce loop, one for each axis so the index math can be hoisted out of the inner ones
+      for ridx in reduce_idxs: self.uop(UOps.LOOP, None, [], ([ridx], "reduce"))
 
       # barrier for fast GEMM
       if self.use_tensor_cores: self.uop(UOps.BARRIER, None, [], ())
@@ -390,13 +606,13 @@ class Linearizer:
           self.uop(UOps.BARRIER, None, [], ())
 
         # load earlybufs
-        loaded_buffers.update({b:self.global_load(self.bufs.index(self.local_alias[i]) if i in self.local_alias else i, global_idxs+local_idxs+reduce_idxs+full_upcast_idxs) for i,b in enumerate(self.bufs) if b in self.earlybufs and i != 0})
+        loaded_buffers.update({b:self.global_load(self.bufs.index(self.local_alias[i]) if i in self.local_alias else i, global_idxs+local_idxs+reduce_idxs+full_upcast_idxs, ltype=acc_type) for i,b in enumerate(self.bufs) if b in self.earlybufs and i != 0})
 
         # run early AST (with reduce)
         self.ast_parse(self.reduceop, [acc[off] for off in self.acc_offsets(self.full_buf_index)], loaded_buffers, ssa, do_reduce=True)
 
       # end the reduce loop
-      self.uop(UOps.ENDLOOP, None, [], (reduce_idxs, "reduce"))
+      for ridx in reduce_idxs[::-1]: self.uop(UOps.ENDLOOP, None, [], ([ridx], "reduce"))
 
       # end the local loop, do the local reduce
       if self.group_for_reduce:
@@ -435,14 +651,26 @@ class Linearizer:
         # end the late reduce loop
         self.uop(UOps.ENDLOOP, None, [], (end_local_idxs, "late_reduce"))
 
-    # load latebufs
-    loaded_buffers.update({b:self.global_load(i, global_idxs+local_idxs+fake_reduce_idxs+upcast_idxs) for i,b in enumerate(self.bufs) if b not in self.earlybufs and i != 0 and b.__class__ is not LocalBuffer})
+    # load latebufs, the indices of the gathers are ints and their rows are loaded after them
+    loaded_buffers.update({b:self.global_load(i, global_idxs+local_idxs+fake_reduce_idxs+upcast_idxs, ltype=dtypes.int32 if b in self.gathers.values() or b is self.scatter else dtypes.float32) for i,b in enumerate(self.bufs) if b not in self.earlybufs and i != 0 and b.__class__ is not LocalBuffer and b not in self.gathers})
+    loaded_buffers.update({b:self.global_load(self.bufs.index(b), global_idxs+local_idxs+fake_reduce_idxs+upcast_idxs, gather=self.normalize_idx(self.bufs.index(b), loaded_buffers[idx], ssa)) for b,idx in self.gathers.items()})
+
+    # the int accumulators are stored as they are to an int output, else the late AST is float
+    late_ast = self.ast
+    while isinstance(late_ast, LazyOp) and late_ast is not self.reduceop and late_ast.op in {UnaryOps.NOOP, UnaryOps.CAST}: late_ast = late_ast.src[0]
+    if acc_type != dtypes.float32 and not (dtypes.is_int(self.bufs[0].dtype) and late_ast is self.reduceop):
+      acc = [self.uop(UOps.CAST, ssa("acc"), [x]) for x in acc]
 
     # run late AST
     val = self.ast_parse(self.ast, acc, loaded_buffers, ssa)
 
+    # a scatter with an ADD adds to the rows of the output
+    scatter = self.normalize_idx(0, loaded_buffers[self.scatter], ssa) if self.scatter is not None else None
+    if scatter is not None and cast(LazyOp, self.ast).arg == BinaryOps.ADD:
+      val = [self.uop(UOps.ALU, ssa('alu'), [old, x], BinaryOps.ADD) for old,x in zip(self.global_load(0, global_idxs+local_idxs+fake_reduce_idxs+upcast_idxs, gather=scatter), val)]
+
     # store
-    self.global_store(0, global_idxs+local_idxs+fake_reduce_idxs+upcast_idxs, val, ssa)
+    self.global_store(0, global_idxs+local_idxs+fake_reduce_idxs+upcast_idxs, val, ssa, gather=scatter)
 
     if not self.group_for_reduce:
       # end the global+local loop
@@ -459,6 +687,11 @@ class Linearizer:
 
   def ast_parse(self, x, acc, loaded_buffers, ssa, do_reduce=False) -> List[Token]:
     if x.__class__ is not LazyOp: return loaded_buffers[x]
+    if x.op in {LoadOps.GATHER, LoadOps.SCATTER}: return loaded_buffers[x.src[0]]
+    # a cast to bfloat16 or half inside the kernel rounds the float32 value, the store to a bfloat16 or half buffer does that itself
+    if x.op == UnaryOps.CAST and x.arg in (dtypes.bfloat16, dtypes.float16) and x is not self.ast:
+      if x not in self.saved_exprs: self.saved_exprs[x] = [self.uop(UOps.CAST, ssa("alu"), [v], x.arg) if v.offset is None and v.dtype == dtypes.float32 else v for v in self.ast_parse(x.src[0], acc, loaded_buffers, ssa)]
+      return self.saved_exprs[x]
     if x.op in [UnaryOps.NOOP, UnaryOps.CAST]: return self.ast_parse(x.src[0], acc, loaded_buffers, ssa)  # cast isn't an ALU op
     if x.op in ReduceOps and not do_reduce: return acc
     # MULACC fusion. TODO: this is copied from Interpreted
@@ -476,7 +709,7 @@ class Linearizer:
       if x.op in ops:
         ret = [(idx, self.uop(UOps.ALU, val[-1], list(val), ops[x.op])) for idx, val in get_grouped_maybe_float4(*values, acc, grouping_allowed=self.supports_float4_alu)]
       else:
-        ret = [(idx, self.uop(UOps.ALU, ssa('alu', dtypes._float4) if any(x.dtype == dtypes._float4 and x.offset is None for x in val) else ssa('alu'), list(val), x.op)) for idx, val in get_grouped_maybe_float4(*values, grouping_allowed=self.supports_float4_alu and x.op not in {BinaryOps.CMPEQ, TernaryOps.WHERE})]
+        ret = [(idx, self.uop(UOps.ALU, ssa('alu', dtypes._float4) if any(x.dtype == dtypes._float4 and x.offset is None for x in val) else ssa('alu', token_dtype(val[0]) if all_same([token_dtype(v) for v in val]) else dtypes.float32), list(val), x.op)) for idx, val in get_grouped_maybe_float4(*values, grouping_allowed=self.supports_float4_alu and x.op not in {BinaryOps.CMPEQ, BinaryOps.MOD, TernaryOps.WHERE})]
       ordered_ret: List[Optional[Token]] = [None]*len(values[0])
       # scatter
       for i,j in ret:
@@ -592,6 +825,26 @@ class Linearizer:
     # do the reshapes
     for i,x in enumerate(rets): self.sts[i].reshape(tuple([y[0] for y in x]))
 
+  # strength reduction: if the indexes div or mod a reduce loop variable, split that loop so the loop variables are the quotient and remainder
+  def split_reduce_divmod(self):
+    if getenv("NOOPT"): return
+    def divmods() -> List[Node]:
+      idxs = [Variable(f"idx{i}", 0, s-1) for i,s in enumerate(self.full_shape)]
+      return flatten(divmod_nodes(x) for st in self.sts for x in st.expr_idxs([idx if s != 1 else Variable.num(0) for idx,s in zip(idxs, st.shape)]))
+    axis = self.first_reduce + len(self.group_for_reduce)
+    while axis < self.shape_len-self.upcasted:
+      nodes, best, sts = divmods(), None, [st.copy() for st in self.sts]
+      for amt in sorted(set(x.b for x in nodes if f"idx{axis}" in [v.expr for v in x.vars()] and 1 < x.b < self.full_shape[axis] and self.full_shape[axis]%x.b == 0)):
+        self.reshape_and_permute(lambda x: list(x[0:axis]) + ([x[axis]//amt, amt] if x[axis] > 1 else [1,1]) + list(x[axis+1:]), None)
+        if (cnt := len(divmods())) < (len(nodes) if best is None else best[0]): best = (cnt, amt)
+        self.sts = [st.copy() for st in sts]
+      if best is None:
+        axis += 1
+        continue
+      if DEBUG >= 4: print(f"splitting reduce axis {axis} by {best[1]}, {len(nodes)} -> {best[0]} divs and mods")
+      amt = best[1]
+      self.reshape_and_permute(lambda x: list(x[0:axis]) + ([x[axis]//amt, amt] if x[axis] > 1 else [1,1]) + list(x[axis+1:]), None)
+
   # ******************** GPU simplifiers ********************
 
   def required_optimizations(self, early_only=False):
@@ -629,8 +882,10 @@ class Linearizer:
     if DEBUG >= 4: print("aliasing buffer", self.sts[i])
     self.local_alias[i] = self.bufs[-1]
 
+  @compile_stage("hand_coded_optimizations")
   def hand_coded_optimizations(self):
-    if getenv("NOOPT"): return
+    # the rows of a scatter are stored in order, with an upcast a row that's in it twice could be loaded before it's stored
+    if getenv("NOOPT") or self.scatter is not None: return
 
     # if there's images in the earlybufs, we have to make an axis the 4 loading one
     self.required_optimizations(early_only=True)
@@ -695,8 +950,8 @@ class Linearizer:
         # early exit
         return
 
-    # are we grouping? (requires local shape support)
-    if not self.float4_axis(0) and self.first_reduce <= 2 and self.first_reduce + 1 <= self.shape_len and prod(self.sts[0].shape[:self.first_reduce]) <= 2048:
+    # are we grouping? (requires local shape support, the local buffer is float so not for an int reduce)
+    if not self.int_reduce and not self.float4_axis(0) and self.first_reduce <= 2 and self.first_reduce + 1 <= self.shape_len and prod(self.sts[0].shape[:self.first_reduce]) <= 2048:
       # TODO: use 1024 if it's allowed in a smarter way
       for sz in (([256, 16]) if prod(self.sts[0].shape[:self.first_reduce]) <= 32 else [16]):
         if all(st.shape[self.first_reduce] % sz == 0 or st.shape[self.first_reduce] == 1 for st in self.sts):
@@ -726,6 +981,12 @@ class Linearizer:
         self.reshape_and_permute(lambda x: [base_shape[0], x[0]//base_shape[0]]+list(x[1:]), None)
         self.simplify_ones()
 
+    # the loads of half are 4 at a time, so the contiguous reduce of a grouped reduce over half is upcasted. this is a matvec with half weights
+    if self.supports_half4 and self.group_for_reduce and self.first_reduce+len(self.group_for_reduce) < self.shape_len-self.upcasted and self.full_unupcasted_shape[-1]%4 == 0 and \
+       any(b.dtype == dtypes.float16 and self.sts[i].views[-1].strides[self.shape_len-self.upcasted-1] == 1 for i,b in enumerate(self.bufs) if b in self.earlybufs):
+      self.shift_to(len(self.full_unupcasted_shape)-1, 4, insert_before=len(self.full_unupcasted_shape))
+      self.upcast()
+
     # no more opt if we are grouping
     if self.group_for_reduce: return
 
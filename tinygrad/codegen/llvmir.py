@@ -1,8 +1,8 @@
-from typing import Final, Dict, Callable, Any, List, Optional
-import functools
+from typing import Final, Dict, Callable, Any, List, Optional, Union, cast
+import functools, struct
 from llvmlite import ir  # type: ignore
-from tinygrad.codegen.linearizer import Linearizer, UOps, UOp, Token, MemOp, ConstOp
-from tinygrad.helpers import dtypes
+from tinygrad.codegen.linearizer import Linearizer, UOps, UOp, Token, MemOp, ConstOp, optimize_uops, split_border
+from tinygrad.helpers import dtypes, compile_stage
 from tinygrad.ops import Op, ASTRunner, UnaryOps, BinaryOps, TernaryOps
 
 from tinygrad.shape.symbolic import Variable, NumNode, MulNode, DivNode, ModNode, LtNode, SumNode, AndNode
@@ -17,6 +17,21 @@ render_llvm = {
   AndNode: lambda self,ops,ctx: functools.reduce(lambda a,b: ctx.and_(a,b.render(ops,ctx)), self.nodes[1:], self.nodes[0].render(ops,ctx))
 }
 
+# NOTE: frem is a call to fmodf, this is inline and exact while the quotient fits in an i64. fptosi of a bigger (or nan) quotient is poison, those are frem
+def llvm_mod(builder, x, y):
+  dx, dy = builder.fpext(x, ir.DoubleType()), builder.fpext(y, ir.DoubleType())
+  dq = builder.fdiv(dx, dy)
+  q = builder.sitofp(builder.fptosi(dq, ir.IntType(64)), ir.DoubleType())
+  fits = builder.fcmp_ordered("<", builder.call(builder._block.module.declare_intrinsic('llvm.fabs', [ir.DoubleType()]), [dq]), ir.Constant(ir.DoubleType(), 9.2e18))
+  return builder.select(fits, builder.fptrunc(builder.fsub(dx, builder.fmul(dy, q)), ir.FloatType()), builder.frem(x, y))
+
+# the bits of the float rounded to nearest even in the upper half, NaNs stay quiet NaNs
+def llvm_bf16_round(builder, x):
+  bits = builder.bitcast(x, ir.IntType(32))
+  odd = builder.and_(builder.lshr(bits, ir.Constant(ir.IntType(32), 16)), ir.Constant(ir.IntType(32), 1))
+  rounded = builder.and_(builder.add(bits, builder.add(odd, ir.Constant(ir.IntType(32), 0x7fff))), ir.Constant(ir.IntType(32), 0xffff0000))
+  return builder.select(builder.fcmp_unordered('uno', x, x), ir.Constant(ir.IntType(32), 0x7fc00000), rounded)
+
 code_for_op: Final[Dict[Op, Callable]] = {
   UnaryOps.EXP2: lambda builder,x: builder.call(builder._block.module.declare_intrinsic('llvm.exp2', [ir.FloatType()]), [x], fastmath=('fast',)),
   UnaryOps.LOG2: lambda builder,x: builder.call(builder._block.module.declare_intrinsic('llvm.log2', [ir.FloatType()]), [x], fastmath=('fast',)),
@@ -26,12 +41,22 @@ code_for_op: Final[Dict[Op, Callable]] = {
   BinaryOps.SUB: lambda builder,x,y: builder.fsub(x,y, flags=('fast',)),
   BinaryOps.MUL: lambda builder,x,y: builder.fmul(x,y, flags=('fast',)),
   BinaryOps.DIV: lambda builder,x,y: builder.fdiv(x,y, flags=('fast',)),
+  BinaryOps.MOD: lambda builder,x,y: llvm_mod(builder, x, y),
   BinaryOps.CMPEQ: lambda builder,x,y: builder.uitofp(builder.fcmp_ordered("==", x, y, flags=('fast',)), ir.FloatType()),
   BinaryOps.MAX: lambda builder,x,y: builder.select(builder.fcmp_unordered(">", x, y, flags=('fast',)), x, y, flags=('fast',)),
   TernaryOps.MULACC: lambda builder,x,y,z: builder.fadd(builder.fmul(x,y, flags=('fast',)), z, flags=('fast',)),
   TernaryOps.WHERE: lambda builder,x,y,z: builder.select(builder.fcmp_unordered("!=", x, ir.Constant(ir.FloatType(), 0), flags=('fast',)), y, z, flags=('fast',)),
 }
 
+# the ops of an int32 reduce, see INT_OPS in the linearizer, and of the normalization of the gather indices
+int_code_for_op: Final[Dict[Op, Callable]] = {
+  BinaryOps.ADD: lambda builder,x,y: builder.add(x,y), BinaryOps.SUB: lambda builder,x,y: builder.sub(x,y), BinaryOps.MUL: lambda builder,x,y: builder.mul(x,y),
+  BinaryOps.MAX: lambda builder,x,y: builder.select(builder.icmp_signed(">", x, y), x, y), BinaryOps.CMPLT: lambda builder,x,y: builder.zext(builder.icmp_signed("<", x, y), ir.IntType(32)),
+  TernaryOps.MULACC: lambda builder,x,y,z: builder.add(builder.mul(x,y), z),
+  TernaryOps.WHERE: lambda builder,x,y,z: builder.select(builder.icmp_signed("!=", x, ir.Constant(ir.IntType(32), 0)), y, z),
+}
+
+@compile_stage("render")
 def uops_to_llvm_ir(uops:List[UOp]) -> str:
   # all llvm stuff goes into a module
   module = ir.Module(name=__file__)
@@ -41,7 +66,7 @@ def uops_to_llvm_ir(uops:List[UOp]) -> str:
   buf_index = {x:i for i,x in enumerate(buf_to_dtype.keys())}
 
   # create llvm function
-  dtype_to_llvm_dtype = {dtypes.float16:ir.HalfType(), dtypes.bfloat16:ir.IntType(16), dtypes.float32:ir.FloatType(), dtypes.int8:ir.IntType(8), dtypes.uint8:ir.IntType(8), dtypes.bool: ir.IntType(1), dtypes.int64: ir.IntType(64), dtypes.int32: ir.IntType(32)}
+  dtype_to_llvm_dtype = {dtypes.float16:ir.HalfType(), dtypes.bfloat16:ir.IntType(16), dtypes.float32:ir.FloatType(), dtypes.int8:ir.IntType(8), dtypes.uint8:ir.IntType(8), dtypes.uint16:ir.IntType(16), dtypes.bool: ir.IntType(1), dtypes.int64: ir.IntType(64), dtypes.int32: ir.IntType(32)}
   func_dtypes = [dtype_to_llvm_dtype[dtype] for dtype in buf_to_dtype.values()]
   func = ir.Function(module, ir.FunctionType(ir.VoidType(), [x.as_pointer() for x in func_dtypes]), name='exec')
 
@@ -53,7 +78,7 @@ def uops_to_llvm_ir(uops:List[UOp]) -> str:
   loop_blocks = []
   reduce_phis: List = []
   # TODO: newvar probably shouldn't be optional
-  lvars: Dict[Optional[Token], Any] = {}  # this Any is an llvm type
+  lvars: Dict[Union[Optional[Token], str], Any] = {}  # this Any is an llvm type, the str keys are the loop vars and the gather indices
   render_llvm[Variable] = lambda self,ops,ctx: lvars[self.expr]
 
   for uop,newvar,vin,args in uops:
@@ -66,7 +91,7 @@ def uops_to_llvm_ir(uops:List[UOp]) -> str:
         phis = []
         for rp in reduce_phis:
           incoming = lvars[rp]
-          lvars[rp] = bb[-1].phi(ir.FloatType())
+          lvars[rp] = bb[-1].phi(incoming.type)
           lvars[rp].add_incoming(incoming, bb[-2]._block)
           phis.append((rp, lvars[rp]))
         loop_blocks.append((bb[-1], phis))
@@ -82,27 +107,32 @@ def uops_to_llvm_ir(uops:List[UOp]) -> str:
         for n,phi in phis: phi.add_incoming(lvars[n], bb[-1]._block)
         bb.append(ir.IRBuilder(func.append_basic_block(f"loop_exit_{var.expr}")))
         bb[-2].cbranch(bb[-2].icmp_unsigned("==", idx_p1, int_const(var.max+1)), bb[-1]._block, block._block)
+    if uop == UOps.INDEX:
+      lvars[args[0].expr] = args[1].render(render_llvm, bb[-1])
     if uop == UOps.LOAD:
       assert newvar is not None and isinstance(args, (MemOp, ConstOp))
-      assert newvar.dtype == dtypes.float, "newvar must be float"
+      assert newvar.dtype in [dtypes.float, dtypes.int32], "newvar must be float or int32"
       valid = args.valid.render(render_llvm, bb[-1])
+      ltype = dtype_to_llvm_dtype[newvar.dtype]
       if isinstance(args, ConstOp):
         if args.valid.min == 0 and args.valid.max == 1:
-          val = bb[-1].select(valid, ir.Constant(ir.FloatType(), args.value), ir.Constant(ir.FloatType(), args.invalid_value))
+          val = bb[-1].select(valid, ir.Constant(ltype, args.value), ir.Constant(ltype, args.invalid_value))
         else:
-          val = ir.Constant(ir.FloatType(), args.value if args.valid.min == 1 else args.invalid_value)
+          val = ir.Constant(ltype, args.value if args.valid.min == 1 else args.invalid_value)
         # TODO: this is a hack. it shouldn't be const that signals this
         reduce_phis.append(newvar)
       else:
         idx = args.idx.render(render_llvm, bb[-1])
         if args.valid.min == 0:
           aug_idx = bb[-1].select(valid, idx, int_const(0))
-          val = bb[-1].select(valid, bb[-1].load(bb[-1].gep(func.args[buf_index[args.name]], [aug_idx], inbounds=True)), ir.Constant(dtype_to_llvm_dtype[args.memory_dtype], args.invalid_value))
+          val = bb[-1].select(valid, bb[-1].load(bb[-1].gep(func.args[buf_index[args.name]], [aug_idx], inbounds=True)), ir.Constant(dtype_to_llvm_dtype[args.memory_dtype], args.invalid_value if args.memory_dtype != dtypes.bfloat16 else struct.unpack("<I", struct.pack("<f", args.invalid_value))[0] >> 16))
         else:
           val = bb[-1].load(bb[-1].gep(func.args[buf_index[args.name]], [idx], inbounds=True))
 
         if args.memory_dtype != newvar.dtype:
-          if dtypes.is_int(args.memory_dtype):
+          if newvar.dtype == dtypes.int32:
+            val = bb[-1].zext(val, ltype) if dtypes.is_unsigned(args.memory_dtype) else bb[-1].sext(val, ltype)
+          elif dtypes.is_int(args.memory_dtype):
             val = bb[-1].uitofp(val, ir.FloatType()) if dtypes.is_unsigned(args.memory_dtype) else bb[-1].sitofp(val, ir.FloatType())
           elif args.memory_dtype == dtypes.bfloat16:
             val = bb[-1].sext(val, ir.IntType(32))
@@ -111,29 +141,44 @@ def uops_to_llvm_ir(uops:List[UOp]) -> str:
           else:
             val = bb[-1].fpext(val, ir.FloatType())
       lvars[newvar] = val
+      # an int can be the index of a gather
+      if newvar.dtype == dtypes.int32: lvars[newvar.name] = bb[-1].sext(val, ir.IntType(64))
     if uop == UOps.STORE:
       assert args.valid.min == 1 and isinstance(args, MemOp), "store must be valid and to memory"
       idx = args.idx.render(render_llvm, bb[-1])
       element = lvars[vin[0]]
-      if args.memory_dtype != vin[0].dtype:
+      if vin[0].dtype == dtypes.int32 and args.memory_dtype != vin[0].dtype:
+        if dtypes.is_int(args.memory_dtype):
+          element = bb[-1].sext(element, dtype_to_llvm_dtype[args.memory_dtype]) if args.memory_dtype.itemsize > 4 else bb[-1].trunc(element, dtype_to_llvm_dtype[args.memory_dtype])
+        else:
+          element = bb[-1].sitofp(element, ir.FloatType())
+          if args.memory_dtype != dtypes.float32: element = bb[-1].fptrunc(element, dtype_to_llvm_dtype[args.memory_dtype])
+      elif args.memory_dtype != vin[0].dtype:
         if dtypes.is_int(args.memory_dtype):
           element = bb[-1].fptoui(element, dtype_to_llvm_dtype[args.memory_dtype]) if dtypes.is_unsigned(args.memory_dtype) else bb[-1].fptosi(element, dtype_to_llvm_dtype[args.memory_dtype])
         elif args.memory_dtype == dtypes.bfloat16:
-          element = bb[-1].bitcast(element, ir.IntType(32))
-          element = bb[-1].lshr(element, ir.Constant(ir.IntType(32), 16))
+          element = bb[-1].lshr(llvm_bf16_round(bb[-1], element), ir.Constant(ir.IntType(32), 16))
           element = bb[-1].trunc(element, ir.IntType(16))
         else:
           element = bb[-1].fptrunc(element, dtype_to_llvm_dtype[args.memory_dtype])
       bb[-1].store(element, bb[-1].gep(func.args[buf_index[args.name]], [idx], inbounds=True))
     if uop == UOps.ALU:
-      lvars[newvar] = code_for_op[args](bb[-1], *[lvars[x] for x in vin])
+      lvars[newvar] = (int_code_for_op if cast(Token, newvar).dtype == dtypes.int32 else code_for_op)[args](bb[-1], *[lvars[x] for x in vin])
+      if cast(Token, newvar).dtype == dtypes.int32: lvars[cast(Token, newvar).name] = bb[-1].sext(lvars[newvar], ir.IntType(64))
+    if uop == UOps.CAST:
+      if args == dtypes.bfloat16: lvars[newvar] = bb[-1].bitcast(llvm_bf16_round(bb[-1], lvars[vin[0]]), ir.FloatType())
+      elif args == dtypes.float16: lvars[newvar] = bb[-1].fpext(bb[-1].fptrunc(lvars[vin[0]], ir.HalfType()), ir.FloatType())
+      else: lvars[newvar] = bb[-1].sitofp(lvars[vin[0]], ir.FloatType())
 
   bb[-1].ret_void()
   return str(module)
 
 class LLVMIRCodegen(Linearizer):
+  supports_serial_scatter: bool = True
   def codegen(self):
     self.process()
     # no optimize, this doesn't support local
+    self.split_reduce_divmod()
     self.linearize()
+    self.uops = optimize_uops(split_border(self.uops))
     return ASTRunner('exec', uops_to_llvm_ir(self.uops), op_estimate=self.info.flops, mem_estimate=self.mem_estimate, display_name=self.display_name)
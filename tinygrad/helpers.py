@@ -1,9 +1,10 @@
 from __future__ import annotations
-import os, functools, platform, time, re
+import os, functools, platform, time, re, json
+from collections import defaultdict
 from weakref import KeyedRef, ref
 from _weakref import _remove_dead_weakref # type: ignore
 import numpy as np
-from typing import Dict, Tuple, Union, List, NamedTuple, Final, Iterator, ClassVar, Optional, Callable, Any
+from typing import Dict, Tuple, Union, List, NamedTuple, Final, Iterator, ClassVar, Optional, Callable, Any, DefaultDict
 from math import prod # noqa: F401 # pylint:disable=unused-import
 
 ShapeType = Tuple[int, ...]
@@ -48,7 +49,7 @@ class ContextVar:
   @property
   def value(self): return ContextVar.ctx_stack[-1][self.key] if self.key in ContextVar.ctx_stack[-1] else self.initial_value
 
-DEBUG, IMAGE = ContextVar("DEBUG", 0), ContextVar("IMAGE", 0)
+DEBUG, IMAGE, WINO, INT32_ACC = ContextVar("DEBUG", 0), ContextVar("IMAGE", 0), ContextVar("WINO", 0), ContextVar("INT32_ACC", 0)
 GRAPH, PRUNEGRAPH, GRAPHPATH = getenv("GRAPH", 0), getenv("PRUNEGRAPH", 0), getenv("GRAPHPATH", "/tmp/net")
 
 class Timing(object):
@@ -58,13 +59,42 @@ class Timing(object):
     self.et = time.perf_counter_ns() - self.st
     if self.enabled: print(f"{self.prefix}{self.et*1e-6:.2f} ms"+(self.on_exit(self.et) if self.on_exit else ""))
 
+# **** compile profiling, COMPILE_LOG=<file> appends a json line per compiled kernel with the time spent in each stage *****
+
+COMPILE_LOG = getenv("COMPILE_LOG", "")
+
+class CompileStats:
+  stages: ClassVar[DefaultDict[str, float]] = defaultdict(float)
+  stack: ClassVar[List[float]] = []
+  @staticmethod
+  def flush(total:float, **kwargs):
+    with open(COMPILE_LOG, "a") as f:
+      f.write(json.dumps({**kwargs, "total_ms": round(total*1e3, 3), "stages_ms": {k:round(v*1e3, 3) for k,v in CompileStats.stages.items()}})+"\n")
+    CompileStats.stages.clear()
+
+# NOTE: the stage times are exclusive, the time of a stage called inside another one isn't counted twice
+def compile_stage(name:str):
+  def decorator(fxn):
+    @functools.wraps(fxn)
+    def wrapper(*args, **kwargs):
+      if not COMPILE_LOG: return fxn(*args, **kwargs)
+      CompileStats.stack.append(0.0)
+      st = time.perf_counter()
+      try: return fxn(*args, **kwargs)
+      finally:
+        et = time.perf_counter() - st
+        CompileStats.stages[name] += et - CompileStats.stack.pop()
+        if CompileStats.stack: CompileStats.stack[-1] += et
+    return wrapper
+  return decorator
+
 # **** tinygrad now supports dtypes! *****
 
 class DType(NamedTuple):
   priority: int  # this determines when things get upcasted
   itemsize: int
   name: str
-  np: Optional[type]  # TODO: someday this will be removed with the "remove numpy" project
+  np: Optional[Union[type, np.dtype]]  # TODO: someday this will be removed with the "remove numpy" project
   sz: int = 1
   def __repr__(self): return f"dtypes.{self.name}"
   @property
@@ -81,13 +111,13 @@ class ImageDType(DType):
 
 class dtypes:
   @staticmethod # static methds on top, or bool in the type info will refer to dtypes.bool
-  def is_int(x: DType)-> bool: return x in (dtypes.int8, dtypes.uint8, dtypes.int32, dtypes.int64)
+  def is_int(x: DType)-> bool: return x in (dtypes.int8, dtypes.uint8, dtypes.uint16, dtypes.int32, dtypes.int64)
   @staticmethod
-  def is_float(x: DType) -> bool: return x in (dtypes.float16, dtypes.float32, dtypes._half4, dtypes._float4)
+  def is_float(x: DType) -> bool: return x in (dtypes.float16, dtypes.bfloat16, dtypes.float32, dtypes._half4, dtypes._float4)
   @staticmethod
-  def is_unsigned(x: DType) -> bool: return x in (dtypes.uint8, dtypes.uint32, dtypes.uint64)
+  def is_unsigned(x: DType) -> bool: return x in (dtypes.uint8, dtypes.uint16, dtypes.uint32, dtypes.uint64)
   @staticmethod
-  def from_np(x) -> DType: return DTYPES_DICT[np.dtype(x).name]
+  def from_np(x) -> DType: return DTYPES_DICT[np.dtype(x).name] if np.dtype(x) != dtypes.bfloat16.np else dtypes.bfloat16
   @staticmethod
   def fields() -> Dict[str, DType]: return DTYPES_DICT
   bool: Final[DType] = DType(0, 1, "bool", bool)
@@ -99,11 +129,12 @@ class dtypes:
   int32: Final[DType] = DType(1, 4, "int", np.int32)
   int64: Final[DType] = DType(2, 8, "long", np.int64)
   uint8: Final[DType] = DType(0, 1, "unsigned char", np.uint8)
+  uint16: Final[DType] = DType(0, 2, "unsigned short", np.uint16)
   uint32: Final[DType] = DType(1, 4, "unsigned int", np.uint32)
   uint64: Final[DType] = DType(2, 8, "unsigned long", np.uint64)
 
-  # NOTE: bfloat16 isn't supported in numpy
-  bfloat16: Final[DType] = DType(0, 2, "__bf16", None)
+  # NOTE: bfloat16 isn't supported in numpy, on the host it's the bits in a 2 byte void so it's never taken for a uint16
+  bfloat16: Final[DType] = DType(0, 2, "__bf16", np.dtype("V2"))
 
   # NOTE: these are internal dtypes, should probably check for that
   _half4: Final[DType] = DType(0, 2*4, "half4", None, 4)
@@ -113,6 +144,12 @@ class dtypes:
 # HACK: staticmethods are not callable in 3.8 so we have to compare the class
 DTYPES_DICT = {k: v for k, v in dtypes.__dict__.items() if not k.startswith('__') and not callable(v) and not v.__class__ == staticmethod}
 
+# bfloat16 is the upper half of a float32, the conversion from float32 rounds to nearest even and keeps NaNs quiet
+def bf16_to_float(x:np.ndarray) -> np.ndarray: return (x.view(np.uint16).astype(np.uint32) << 16).view(np.float32)
+def float_to_bf16(x:np.ndarray) -> np.ndarray:
+  u = np.asarray(x, dtype=np.float32).view(np.uint32)
+  return np.where(np.isnan(x), 0x7fc0, (u + 0x7fff + ((u >> 16) & 1)) >> 16).astype(np.uint16).view("V2")
+
 class GlobalCounters:
   global_ops: ClassVar[int] = 0
   global_mem: ClassVar[int] = 0
@@ -1,53 +1,158 @@
-from typing import Callable, List, Tuple, Any, Dict, cast, Union
-import functools, itertools
-from tinygrad.helpers import DEBUG, DType
+from __future__ import annotations
+from typing import Callable, List, Tuple, Any, Dict, cast, Union, Optional
+import functools, itertools, json
+from collections import OrderedDict
+import numpy as np
+from tinygrad.helpers import DEBUG, DType, dtypes, getenv
 
-from tinygrad.lazy import Device
+from tinygrad.lazy import Device, LazyBuffer
 from tinygrad.tensor import Tensor
-from tinygrad.ops import GlobalCounters, RawBuffer
+from tinygrad.ops import GlobalCounters, RawBuffer, ASTRunner, LazyOp, LoadOps, Compiled
+from tinygrad.shape.shapetracker import ShapeTracker
 
-JIT_SUPPORTED_DEVICE = ["GPU", "CLANG", "METAL", "CUDA", "HIP", "WEBGPU"]
+JIT_GRAPH = getenv("JIT_GRAPH", 1)
+JIT_SUPPORTED_DEVICE = ["GPU", "CLANG", "METAL", "CUDA", "HIP", "WEBGPU", "LLVM", "CPU", "TORCH"]
 
-class TinyJit:
-  def __init__(self, fxn:Callable):
-    self.fxn: Callable = fxn
+def make_graph(jit_cache:List[Tuple[Callable, Any]], input_replace) -> Optional[Callable]:
+  graph = cast(Compiled, Device[Device.DEFAULT]).graph if JIT_GRAPH and isinstance(Device[Device.DEFAULT], Compiled) else None
+  return graph(jit_cache, input_replace) if graph is not None else None
+
+# one capture of the function, TinyJit keeps one for every signature (shape and dtype) of the input tensors
+class JitEntry:
+  def __init__(self):
     self.cnt: int = 0
+    self.hits: int = 0
     self.jit_cache: List[Tuple[Callable, Any]] = []  # TODO: Any should be List[RawBuffer], but this fails
     self.ret: Any = None
     self.input_replace: Dict[Tuple[int, int], Tuple[Union[int, str], int, DType]]= {}   # (kernel_number, buffer_number) -> (input_name, expected_size, expected_type)
+    self.graph: Optional[Callable] = None
+
+def _entry_property(name): return property(lambda self: getattr(self.entry, name), lambda self,x: setattr(self.entry, name, x))
+
+class TinyJit:
+  def __init__(self, fxn:Callable, max_entries:int=getenv("JIT_MAX_ENTRIES", 8), warmup:int=1):
+    self.fxn: Callable = fxn
+    # the function runs warmup times for every signature before it's captured, the least recently used capture is dropped past max_entries
+    self.max_entries, self.warmup = max_entries, warmup
+    self.entries: OrderedDict[Tuple, JitEntry] = OrderedDict()
+    self.entry: JitEntry = JitEntry()   # the most recently used
+    self.misses, self.evictions = 0, 0
+
+  # the most recently used capture
+  cnt, jit_cache, ret, input_replace, graph = (_entry_property(x) for x in ("cnt", "jit_cache", "ret", "input_replace", "graph"))
 
   # add support for instance methods
   def __get__(self, obj, objtype): return functools.partial(self.__call__, obj)
 
+  def stats(self) -> Dict[str, Any]: return {"hits": sum(e.hits for e in self.entries.values()), "misses": self.misses, "evictions": self.evictions, "entries": {k:e.hits for k,e in self.entries.items()}}
+
   def __call__(self, *args, **kwargs) -> Any:
     if Device.DEFAULT not in JIT_SUPPORTED_DEVICE: return self.fxn(*args, **kwargs)  # only jit on supported device
+    input_tensors: Dict[Union[int, str], Tensor] = {cast(Union[int, str], k):v for k,v in itertools.chain(enumerate(args), kwargs.items()) if isinstance(v, Tensor)}
+    key = tuple((k, v.shape, v.dtype) for k,v in input_tensors.items())
+    if key not in self.entries:
+      self.misses += 1
+      if len(self.entries) >= self.max_entries:
+        evicted, _ = self.entries.popitem(last=False)
+        self.evictions += 1
+        if DEBUG >= 1: print(f"JIT evicted {evicted}")
+      self.entries[key] = JitEntry()
+    self.entries.move_to_end(key)
+    self.entry = e = self.entries[key]
     # NOTE: this cast is needed since although we know realize will create a ".realized" DeviceBuffer, the type checker doesn't
-    input_rawbuffers: Dict[Union[int, str], RawBuffer] = {cast(Union[int, str], k):cast(RawBuffer, v.realize().lazydata.realized) for k,v in itertools.chain(enumerate(args), kwargs.items()) if isinstance(v, Tensor)}
+    input_rawbuffers: Dict[Union[int, str], RawBuffer] = {k:cast(RawBuffer, v.realize().lazydata.realized) for k,v in input_tensors.items()}
     assert len(input_rawbuffers) != 0, "no inputs to JIT"
     assert len(set(input_rawbuffers.values())) == len(input_rawbuffers), "duplicate inputs to JIT"
-    if self.cnt >= 2:
-      for (j,i),(input_name, expected_size, expected_type) in self.input_replace.items():
+    if e.cnt > self.warmup:
+      e.hits += 1
+      # the graph runs everything in one call, the kernel by kernel replay is kept for DEBUG
+      use_graph = e.graph is not None and DEBUG < 2
+      for (j,i),(input_name, expected_size, expected_type) in e.input_replace.items():
         assert input_rawbuffers[input_name].size == expected_size and input_rawbuffers[input_name].dtype == expected_type, f"size or type mismatch in JIT, {input_rawbuffers[input_name]} != <{expected_size}, {expected_type}>"
-        self.jit_cache[j][1][i] = input_rawbuffers[input_name]
-      for prg, args in self.jit_cache: prg(args, jit=True)
-      for (j,i) in self.input_replace.keys(): self.jit_cache[j][1][i] = None
-    elif self.cnt == 1:
+        if not use_graph: e.jit_cache[j][1][i] = input_rawbuffers[input_name]
+      if use_graph: cast(Callable, e.graph)(input_rawbuffers)
+      else:
+        for prg, args in e.jit_cache: prg(args, jit=True)
+        for (j,i) in e.input_replace.keys(): e.jit_cache[j][1][i] = None
+    elif e.cnt == self.warmup:
       GlobalCounters.cache = []
-      self.ret = self.fxn(*args, **kwargs)
-      self.jit_cache = GlobalCounters.cache
+      e.ret = self.fxn(*args, **kwargs)
+      e.jit_cache = GlobalCounters.cache
       GlobalCounters.cache = None
-      assert len(self.jit_cache) != 0, "didn't JIT anything!"
-      if DEBUG >= 1: print(f"JIT captured {len(self.jit_cache)} kernels with {len(input_rawbuffers)} inputs")
+      assert len(e.jit_cache) != 0, "didn't JIT anything!"
+      if DEBUG >= 1: print(f"JIT captured {len(e.jit_cache)} kernels with {len(input_rawbuffers)} inputs, {len(self.entries)}/{self.max_entries} entries")
 
       # get the inputs for replacement
-      for j,(prg,args) in enumerate(self.jit_cache):  # pylint: disable=E1133
+      for j,(prg,args) in enumerate(e.jit_cache):  # pylint: disable=E1133
         for i,a in enumerate(args):
           if a in input_rawbuffers.values():
-            self.input_replace[(j,i)] = [(k, v.size, v.dtype) for k,v in input_rawbuffers.items() if v == a][0]
+            e.input_replace[(j,i)] = [(k, v.size, v.dtype) for k,v in input_rawbuffers.items() if v == a][0]
         #if prg.local_size is None: prg.local_size = prg.optimize_local_size(args, preserve_output=True)  # the JIT can optimize local
-      assert set([x[0] for x in self.input_replace.values()]) == set(input_rawbuffers.keys()), "some input tensors not found"
-      for (j,i) in self.input_replace.keys(): self.jit_cache[j][1][i] = None
-    elif self.cnt == 0:
-      self.ret = self.fxn(*args, **kwargs)
-    self.cnt += 1
-    return self.ret
+      assert set([x[0] for x in e.input_replace.values()]) == set(input_rawbuffers.keys()), "some input tensors not found"
+      for (j,i) in e.input_replace.keys(): e.jit_cache[j][1][i] = None
+      e.graph = make_graph(e.jit_cache, e.input_replace)
+    else:
+      e.ret = self.fxn(*args, **kwargs)
+    e.cnt += 1
+    return e.ret
+
+  # *** save and load a captured JIT, the file is safetensors with the weights (and binaries) and the kernels in the metadata ***
+  # NOTE: only the most recently used capture is saved
+
+  def save(self, fn:str):
+    from tinygrad.state import safe_save
+    assert self.cnt > self.warmup, "JIT has to capture before it can be saved"
+    assert all(prg.__class__ is ASTRunner for prg,_ in self.jit_cache), "only compiled programs can be saved"
+    bufs: Dict[int, int] = {}   # id(rawbuffer) -> buffer number
+    prgs: Dict[int, int] = {}   # id(ASTRunner) -> program number
+    buffers: List[Tuple[int, str]] = []
+    programs: List[Dict[str, Any]] = []
+    kernels: List[Tuple[int, List[Optional[int]]]] = []
+    tensors: Dict[str, Tensor] = {}
+    for j,(prg,args) in enumerate(self.jit_cache):
+      if id(prg) not in prgs:
+        prgs[id(prg)] = len(programs)
+        # save the binary if the runtime has one, else the source has to be compiled on load
+        binary = hasattr(prg.clprg, "binary")
+        if binary: tensors[f"prg_{len(programs)}"] = Tensor(np.frombuffer(prg.clprg.binary(), dtype=np.uint8))
+        programs.append({"name": prg.name, "prg": None if binary else prg.prg, "global_size": prg.global_size, "local_size": prg.local_size, "op_estimate": prg.op_estimate,
+                         "mem_estimate": prg.mem_estimate, "display_name": prg.display_name, "runtime_args": {**prg.runtime_args, **({"binary": True} if binary else {})}})
+      kargs: List[Optional[int]] = []
+      for i,a in enumerate(args):
+        if (j,i) in self.input_replace:
+          kargs.append(None)
+          continue
+        if id(a) not in bufs:
+          bufs[id(a)] = len(buffers)
+          buffers.append((a.size, a.dtype.name))
+          # if the first usage of a buffer is not an output, it's a weight
+          if i > 0: tensors[f"buf_{bufs[id(a)]}"] = Tensor(a.toCPU().view(np.uint8))
+        kargs.append(bufs[id(a)])
+      kernels.append((prgs[id(prg)], kargs))
+    def describe(x):
+      if isinstance(x, Tensor):
+        assert id(x.lazydata.realized) in bufs and x.lazydata.st.contiguous, "JIT can only save outputs that are kernel outputs"
+        return {"buf": bufs[id(x.lazydata.realized)], "shape": x.shape}
+      assert isinstance(x, (tuple, list)), f"JIT can't save output {x}"
+      return [describe(y) for y in x]
+    key = [(k, shape, dtype.name) for k,shape,dtype in next(k for k,v in self.entries.items() if v is self.entry)]
+    jit = {"device": Device.DEFAULT, "key": key, "buffers": buffers, "programs": programs, "kernels": kernels, "ret": describe(self.ret),
+           "input_replace": [(j, i, name, size, dtype.name) for (j,i),(name,size,dtype) in self.input_replace.items()]}
+    safe_save(tensors, fn, {"jit": json.dumps(jit)})
+
+  @staticmethod
+  def load(fn:str) -> TinyJit:
+    from tinygrad.state import safe_load_metadata, safe_load
+    t, _, metadata = safe_load_metadata(fn)
+    jit, tensors, dtype_names = json.loads(metadata["__metadata__"]["jit"]), safe_load(t), {v.name:v for v in dtypes.fields().values()}
+    device = cast(Compiled, Device[jit["device"]])
+    bufs = [device.buffer.fromCPU(tensors[f"buf_{n}"].numpy().view(cast(type, dtype_names[dtype].np))) if f"buf_{n}" in tensors else device.buffer(size, dtype_names[dtype]) for n,(size,dtype) in enumerate(jit["buffers"])]
+    prgs = [ASTRunner(p["name"], tensors[f"prg_{n}"].numpy().tobytes() if p["prg"] is None else p["prg"], p["global_size"], p["local_size"], p["op_estimate"], p["mem_estimate"], p["display_name"], p["runtime_args"]).build(device.runtime) for n,p in enumerate(jit["programs"])]
+    def loaded(*args, **kwargs): raise RuntimeError(f"{fn} is a loaded JIT, it has no python function")
+    ret = TinyJit(loaded)
+    ret.jit_cache = [(prgs[p], [bufs[a] if a is not None else None for a in args]) for p,args in jit["kernels"]]
+    ret.input_replace = {(j,i):(name, size, dtype_names[dtype]) for j,i,name,size,dtype in jit["input_replace"]}
+    def build(x): return Tensor(LazyBuffer(jit["device"], ShapeTracker(tuple(x["shape"])), LoadOps, LazyOp(LoadOps.EMPTY, (), None), bufs[x["buf"]].dtype, bufs[x["buf"]])) if isinstance(x, dict) else tuple(build(y) for y in x)
+    ret.ret, ret.cnt, ret.graph = build(jit["ret"]), ret.warmup+1, make_graph(ret.jit_cache, ret.input_replace)
+    ret.entries[tuple((k, tuple(shape), dtype_names[dtype]) for k,shape,dtype in jit["key"])] = ret.entry
+    return ret
@@ -2,15 +2,15 @@ from __future__ import annotations
 import operator
 from typing import Callable, Optional, Tuple, Union, List, Dict, Any, cast
 import sys, importlib, inspect, functools, pathlib
-from weakref import ref
+from weakref import ref, WeakKeyDictionary
 
 import numpy as np
-from tinygrad.helpers import GRAPH, DEBUG, prod, getenv, DType, dtypes, flatten, ImageDType, LightWeakSet, LightWeakValueDictionary
+from tinygrad.helpers import GRAPH, DEBUG, prod, getenv, DType, dtypes, flatten, ImageDType, LightWeakSet, LightWeakValueDictionary, ContextVar, float_to_bf16
 from tinygrad.runtime.ops_cpu import RawNumpyBuffer
 from tinygrad.runtime.ops_disk import RawDiskBuffer
 from tinygrad.shape.shapetracker import MovementOps, ShapeTracker, View, get_contraction
 from tinygrad.ops import Compiled, Interpreted, UnaryOps, BinaryOps, TernaryOps, ReduceOps, LoadOps, OpType, LazyOp
-from tinygrad.runtime.lib import RawBufferMapped, RawConst, RawBuffer
+from tinygrad.runtime.lib import RawBufferMapped, RawConst, RawBuffer, RawMallocBuffer
 
 # lazy can recurse a lot
 sys.setrecursionlimit(10000)
@@ -18,6 +18,7 @@ sys.setrecursionlimit(10000)
 OPT = getenv("OPT", 2)
 LAZY = getenv("LAZY", 1)
 LAZYCACHE = getenv("LAZYCACHE", 1)
+DISK_ZEROCOPY = ContextVar("DISK_ZEROCOPY", 0)
 
 # TODO: movement ops that only change shape are really nops. treat them as such
 REMOVE_MOVEMENT_NOPS, MERGE_ELEMENTWISE_INTO_REDUCE, SHUFFLE_MOVEMENT_OPS, MERGE_ELEMENTWISE_OPS = OPT>=1, OPT>=1, OPT>=1, OPT>=1
@@ -89,6 +90,9 @@ def _ast_binaryops(self:LazyBuffer) -> LazyOp:
 # **** lazy operations ****
 
 def get_single_root(root:LazyBuffer) -> LazyBuffer: return get_single_root(cast(LazyBuffer, root.op.src[0])) if getattr(root, 'op', None) and len(root.op.src) == 1 else root
+def _disk_view_supported(x:LazyBuffer) -> bool: return x.realized is not None or x.optype is not MovementOps or (x.op.op in {MovementOps.RESHAPE, MovementOps.SHRINK, MovementOps.PERMUTE, MovementOps.STRIDE, MovementOps.EXPAND} and _disk_view_supported(cast(LazyBuffer, x.op.src[0])))
+# the movement ops that don't read less of a DISK buffer are done on the device after the copy
+def _disk_move_to_device(x:LazyBuffer) -> bool: return x.realized is None and x.optype is MovementOps and (x.op.op in {MovementOps.PERMUTE, MovementOps.EXPAND} or (x.op.op == MovementOps.RESHAPE and _disk_move_to_device(cast(LazyBuffer, x.op.src[0]))) or not _disk_view_supported(x))
 def get_movementroot(root:LazyBuffer, allow_contiguous=False) -> LazyBuffer: return get_movementroot(cast(LazyBuffer, root.op.src[0]), allow_contiguous) if not root.realized and (root.optype == MovementOps or (root.op.op == LoadOps.CONTIGUOUS and allow_contiguous and root.op.src[0].st.contiguous)) else root
 def get_movementroot_contiguous(x:LazyBuffer) -> LazyBuffer: return get_movementroot_contiguous(cast(LazyBuffer, x.op.src[0])) if not x.realized and x.op.op == LoadOps.CONTIGUOUS else (get_movementroot(x, True) if x.optype == MovementOps and x.st.contiguous else x)
 
@@ -184,11 +188,18 @@ class LazyBuffer:
     return self.loadop(LoadOps.CONST, tuple(), dtypes.from_np(self.dtype.np), self.device, arg=val).reshape((1,)*len(self.shape)).expand(self.shape)
 
   # NOTE: we also have to copy the numpy array on the way out...otherwise the underlying Tensor could be freed and use after free. improve this?
-  def toCPU(self):
+  # DISK reads the view it can do, the rest of the movement ops are replayed on the device after the copy
+  def copy_to_device(self, device:str) -> LazyBuffer:
+    if self.device.startswith("DISK") and _disk_move_to_device(self): return MOVEMENT_OPS_DISPATCHER[cast(MovementOps, self.op.op)](cast(LazyBuffer, self.op.src[0]).copy_to_device(device), self.op.arg)
+    return LazyBuffer.loadop(LoadOps.FROM, self.shape, self.dtype, device, src=self)
+
+  def toCPU(self): return self.storage().toCPU().reshape(self.shape)
+
+  # the contiguous buffer toCPU copies out of, the kernels run here and the copy to the host can be done later
+  def storage(self) -> RawBuffer:
     assert self.dtype.np, "numpy dtype is required for toCPU"
-    realized = self.cast(dtypes.from_np(self.dtype.np)).contiguous().realize().realized
-    ret = cast(RawBuffer, realized).toCPU().reshape(self.shape)
-    return ret
+    if self.device.startswith("DISK") and not _disk_view_supported(self): return self.copy_to_device("CPU").storage()
+    return cast(RawBuffer, self.cast(dtypes.from_np(self.dtype.np)).contiguous().realize().realized)
 
   def cast(self:LazyBuffer, arg:DType) -> LazyBuffer: return elementwise_op(UnaryOps.CAST, self, arg=arg) if self.dtype != arg else self
   def unary_op(self:LazyBuffer, op:UnaryOps) -> LazyBuffer: return elementwise_op(op, self)
@@ -198,8 +209,22 @@ class LazyBuffer:
     if not self.realized and self.op.op == LoadOps.CONTIGUOUS: return self  # two CONTIGUOUS in a row is one
     return create_lazybuffer(self.device, ShapeTracker(self.shape), LoadOps, LazyOp(LoadOps.CONTIGUOUS, (self,), None), self.dtype)
 
-  def shuffle_and_prune_movement_ops(self, st: ShapeTracker, op: MovementOps, arg: Union[Tuple[int, ...], Tuple[Tuple[int, int], ...]]) -> LazyBuffer:
-    if SHUFFLE_MOVEMENT_OPS and self.optype == BinaryOps and not self.realized and (op in {MovementOps.SHRINK, MovementOps.STRIDE, MovementOps.PERMUTE} or (op == MovementOps.RESHAPE and self.op.op in UnaryOps)) and len(self.children) == 0:
+  # the rows of self at the int indices in idx, the shape is idx.shape + self.shape[1:]. only the rows that are used are loaded
+  def gather(self:LazyBuffer, idx:LazyBuffer) -> LazyBuffer:
+    assert prod(idx.shape) != 0, f"can't gather with an empty index {idx.shape}, zeros aren't allowed in a shape"
+    shape = idx.shape + self.shape[1:]
+    return create_lazybuffer(self.device, ShapeTracker(shape), LoadOps, LazyOp(LoadOps.GATHER, (self.contiguous(), idx.cast(dtypes.int32).contiguous()), shape), self.dtype)
+
+  # a copy of self with the rows at the int indices in idx replaced by (UnaryOps.NOOP) or added to (BinaryOps.ADD) the rows of src
+  # NOTE: the rows are done in order, so an index that's in idx more than once adds all of its rows or keeps the last one
+  def scatter(self:LazyBuffer, idx:LazyBuffer, src:LazyBuffer, op:Union[UnaryOps, BinaryOps]=UnaryOps.NOOP) -> LazyBuffer:
+    assert src.shape == idx.shape + self.shape[1:] and op in {UnaryOps.NOOP, BinaryOps.ADD}, f"can't scatter {src.shape} at {idx.shape} into {self.shape} with {op}"
+    assert prod(idx.shape) != 0, f"can't scatter with an empty index {idx.shape}, zeros aren't allowed in a shape"
+    return create_lazybuffer(self.device, ShapeTracker(self.shape), LoadOps, LazyOp(LoadOps.SCATTER, (self, idx.cast(dtypes.int32).contiguous(), src.cast(self.dtype).contiguous()), op), self.dtype)
+
+  def shuffle_and_prune_movement_ops(self, st: ShapeTracker, op: MovementOps, arg: Union[Tuple[int, ...], Tuple[Tuple[int, int], ...], Tuple[Tuple[int, int, int], ...]]) -> LazyBuffer:
+    # NOTE: a CAST on DISK reinterprets the bytes, the movement ops can't go under it
+    if SHUFFLE_MOVEMENT_OPS and self.optype == BinaryOps and not self.realized and not self.device.startswith("DISK") and (op in {MovementOps.SHRINK, MovementOps.STRIDE, MovementOps.PERMUTE} or (op == MovementOps.RESHAPE and self.op.op in UnaryOps)) and len(self.children) == 0:
       return self.op.replace_with_movement_ops([(op, arg)])
     ret = create_lazybuffer(self.device, st, MovementOps, LazyOp(op, (self,), arg), self.dtype)
     if REMOVE_MOVEMENT_NOPS and not self.realized and not ret.realized and ret.st.contiguous:
@@ -211,6 +236,7 @@ class LazyBuffer:
 
   def reduce_op(self:LazyBuffer, op:ReduceOps, new_shape:Tuple[int, ...]) -> LazyBuffer:
     if self.shape == tuple(new_shape): return self
+    if self.dtype in Device[self.device].storage_dtypes: return (_unrounded[self] if not self.realized and self in _unrounded else self.cast(dtypes.float32)).reduce_op(op, new_shape).cast(self.dtype)
     srcs = _push_movement_ops((self,)) if SHUFFLE_MOVEMENT_OPS else (self,)
     return create_lazybuffer(self.device, ShapeTracker(new_shape), ReduceOps, LazyOp(op, srcs, new_shape), self.dtype)
 
@@ -266,6 +292,9 @@ class LazyBuffer:
     if not self.realized and self.op.op == MovementOps.STRIDE: return self.op.src[0].stride(tuple(map(operator.mul, arg, self.op.arg)))
     return self.shuffle_and_prune_movement_ops(ShapeTracker(self.st).stride(arg), MovementOps.STRIDE, arg)
 
+  def window(self:LazyBuffer, arg:Tuple[Tuple[int, int, int], ...]) -> LazyBuffer:
+    return self.shuffle_and_prune_movement_ops(ShapeTracker(self.st).window(arg), MovementOps.WINDOW, arg)
+
   @property
   def buffers(self) -> Tuple[LazyBuffer, ...]: return (self,)
   def map_buffers(self, real_srcs: Dict[Any, Any]): return real_srcs.get(self, self)
@@ -280,20 +309,31 @@ def _push_movement_ops(srcs:Tuple[LazyBuffer, ...]) -> Tuple[LazyBuffer, ...]:
   for x in srcs:
     mops: List[Tuple[MovementOps, Any]] = []
     bx = x
-    # backwalk all the movement ops. don't push PAD or EXPAND
-    while not bx.realized and bx.optype == MovementOps and bx.op.op != MovementOps.EXPAND and (SHUFFLE_PAD_OPS or bx.op.op != MovementOps.PAD) and len(bx.children) <= 1:
+    # backwalk all the movement ops. don't push PAD, EXPAND or WINDOW (they would recompute the binary ops)
+    while not bx.realized and bx.optype == MovementOps and bx.op.op not in {MovementOps.EXPAND, MovementOps.WINDOW} and (SHUFFLE_PAD_OPS or bx.op.op != MovementOps.PAD) and len(bx.children) <= 1:
       assert isinstance(bx.op.op, MovementOps)
       mops.append((bx.op.op, bx.op.arg))
       bx = cast(LazyBuffer, bx.op.src[0])
     # NOTE: can't push pads past anything where f(0, 0) != 0 or f(0) != 0
-    unsafe_pad_ops = {BinaryOps.DIV, BinaryOps.CMPEQ, UnaryOps.LOG2, UnaryOps.EXP2, UnaryOps.RECIP}
+    unsafe_pad_ops = {BinaryOps.DIV, BinaryOps.MOD, BinaryOps.CMPEQ, UnaryOps.LOG2, UnaryOps.EXP2, UnaryOps.RECIP}
     if not bx.realized and bx.optype == BinaryOps and len(bx.children) <= 1 and len(mops) and (all(x[0] != MovementOps.PAD for x in mops) or all(x.op not in unsafe_pad_ops for x in bx.op.get_lazyops())):
       new_srcs.append(bx.op.replace_with_movement_ops(mops[::-1]))
     else:
       new_srcs.append(x)
   return tuple(new_srcs)
 
+# the float32 results of the ops on storage dtypes before they are rounded. a reduce uses them, so a matmul accumulates the float32 products
+_unrounded: WeakKeyDictionary[LazyBuffer, LazyBuffer] = WeakKeyDictionary()
+
 def elementwise_op(op:Union[UnaryOps, BinaryOps, TernaryOps], *srcs:LazyBuffer, arg:Optional[Any]=None) -> LazyBuffer:
+  # the storage dtypes of the device (bfloat16, and half on CPU) are only for storage, the math is in float32 and the result is rounded back
+  if op != UnaryOps.CAST and any(x.dtype in (storage_dtypes:=Device[srcs[0].device].storage_dtypes) for x in srcs):
+    ret = elementwise_op(op, *[x.cast(dtypes.float32) if x.dtype in storage_dtypes else x for x in srcs], arg=arg)
+    if (out_dtype:=max([x.dtype for x in srcs])) not in storage_dtypes: return ret
+    rounded = ret.cast(out_dtype)
+    _unrounded[rounded] = ret
+    return rounded
+
   # if we are separated from other binary ops by movement ops, we push those movement ops above those binaryops
   if SHUFFLE_MOVEMENT_OPS: srcs = _push_movement_ops(srcs)
 
@@ -348,10 +388,67 @@ def _realize_custom(buffer: LazyBuffer) -> None:
   # this needs to immediately realize
   buffer.realized = buffer.op.arg(buffer, *[x.realize() for x in buffer.op.src])
 
+# the Compiled backends load from a view of the first row expanded to the output shape, the kernel adds the offset of the row from the loaded index
+def _realize_gather(buffer: LazyBuffer) -> None:
+  weight, idx = [cast(LazyBuffer, x).realize() for x in buffer.op.src]
+  if isinstance(Device[buffer.device], Compiled):
+    row = prod(weight.shape[1:])
+    first_row = weight.reshape((weight.shape[0], row)).shrink(((0, 1), (0, row))).reshape((1,)*len(idx.shape) + weight.shape[1:])
+    buffer.op = LazyOp(LoadOps.GATHER, (first_row.expand(buffer.shape), idx.reshape(idx.shape + (1,)*(len(weight.shape)-1)).expand(buffer.shape)), buffer.op.arg)
+
+def _arange(start:int, stop:int, device:str) -> LazyBuffer: return LazyBuffer.fromCPU(np.arange(start, stop, dtype=np.float32)).copy_to_device(device)
+
+# a parallel backend would race on a row that's in idx twice, the rows are a one-hot of the indices reduced over them instead
+# NOTE: the indices are floats here, they are exact up to 2**24 rows
+def _scatter_one_hot(table:LazyBuffer, idx:LazyBuffer, src:LazyBuffer, op:Union[UnaryOps, BinaryOps]) -> LazyBuffer:
+  n, rows, row = prod(idx.shape), table.shape[0], table.shape[1:]
+  idx = idx.reshape((n, 1)).cast(dtypes.float32)
+  idx = idx.binary_op(BinaryOps.CMPLT, idx.const_like(0)).ternary_op(TernaryOps.WHERE, idx.binary_op(BinaryOps.ADD, idx.const_like(rows)), idx).binary_op(BinaryOps.MAX, idx.const_like(0))
+  idx = idx.binary_op(BinaryOps.CMPLT, idx.const_like(rows-1)).ternary_op(TernaryOps.WHERE, idx, idx.const_like(rows-1)).expand((n, rows))
+  hit = idx.binary_op(BinaryOps.CMPEQ, _arange(0, rows, table.device).reshape((1, rows)).expand((n, rows)))
+  if op == UnaryOps.NOOP:
+    # only the last of the indices of a row is kept, it's the one with the biggest position
+    pos = _arange(1, n+1, table.device).reshape((n, 1)).expand((n, rows))
+    last = hit.binary_op(BinaryOps.MUL, pos).reduce_op(ReduceOps.MAX, (1, rows))
+    hit = hit.binary_op(BinaryOps.MUL, pos.binary_op(BinaryOps.CMPEQ, last.expand((n, rows))))
+  full = (n, rows, *row)
+  ret = hit.cast(table.dtype).reshape((n, rows, *[1]*len(row))).expand(full).binary_op(BinaryOps.MUL, src.reshape((n, 1, *row)).expand(full)).reduce_op(ReduceOps.SUM, (1, *full[1:])).reshape(table.shape)
+  if op == BinaryOps.ADD: return table.binary_op(BinaryOps.ADD, ret)
+  return last.reshape((rows, *[1]*len(row))).expand(table.shape).ternary_op(TernaryOps.WHERE, ret, table).cast(table.dtype)
+
+# the Compiled backends store in place to the table when it's assigned to, else to a copy of it. like a gather the kernel stores
+# to a view of the first row, it's never upcast so the rows are done in order. that's only on the backends with supports_serial_scatter
+def _realize_scatter(buffer: LazyBuffer) -> None:
+  table, idx, src = [cast(LazyBuffer, x) for x in buffer.op.src]
+  for x in (idx, src): x.realize()
+  if not isinstance(Device[buffer.device], Compiled): return
+  if not getattr(Device[buffer.device].codegen, 'supports_serial_scatter', False):
+    ret = _scatter_one_hot(table, idx, src, buffer.op.arg)
+    ret.output_buffer = buffer.output_buffer
+    buffer.realized = ret.realize().realized
+    return
+  if table.realized is None or table.realized is not buffer.output_buffer or not table.st.contiguous:
+    # NOTE: the copy is the kernel of the table, a scatter to zeros is one fill and the rows
+    table = LazyBuffer(buffer.device, ShapeTracker(buffer.shape), BinaryOps, LazyOp(UnaryOps.NOOP, (table,)), buffer.dtype)
+    table.output_buffer = buffer.output_buffer
+    table.realize()
+  row = prod(buffer.shape[1:])
+  st = ShapeTracker((buffer.shape[0], row)).shrink(((0, 1), (0, row))).reshape((1,)*len(idx.shape) + buffer.shape[1:]).expand(src.shape)
+  rows = LazyBuffer(buffer.device, st, LoadOps, LazyOp(LoadOps.SCATTER, (src, idx.reshape(idx.shape + (1,)*(len(buffer.shape)-1)).expand(src.shape)), buffer.op.arg), buffer.dtype)
+  rows.output_buffer = table.realized
+  for x in rows.op.buffers: x.realize()
+  buffer.realized = Device[buffer.device].exec_ast(rows.op, output=rows, **buffer._device_extra_args())
+
 def _realize_from(buffer: LazyBuffer) -> None:
   rawbuf = buffer.op.src[0].realize()
+  # with DISK_ZEROCOPY the host memory backends use a copy on write mapping of the file instead of reading it
+  zerocopy = DISK_ZEROCOPY and isinstance(rawbuf.realized, RawDiskBuffer) and rawbuf.realized.st is None and rawbuf.realized.offset % buffer.dtype.itemsize == 0
+  if zerocopy and Device[buffer.device].buffer is RawMallocBuffer:
+    buffer.realized = RawMallocBuffer(prod(buffer.shape), buffer.dtype, cast(RawDiskBuffer, rawbuf.realized).mmap_cow())
+  elif zerocopy and Device[buffer.device].buffer is RawNumpyBuffer and buffer.dtype.np is not None:
+    buffer.realized = RawNumpyBuffer.fromCPU(np.frombuffer(cast(RawDiskBuffer, rawbuf.realized).mmap_cow(), buffer.dtype.np).reshape(buffer.shape))
   # TODO: make this generic
-  if isinstance(rawbuf.realized, RawDiskBuffer) and issubclass(Device[buffer.device].buffer, RawBufferMapped):
+  elif isinstance(rawbuf.realized, RawDiskBuffer) and issubclass(Device[buffer.device].buffer, RawBufferMapped):
     buffer.realized = Device[buffer.device].buffer(prod(buffer.shape), buffer.dtype, **buffer._device_extra_args())
     rawbuf.realized.readinto(cast(RawBufferMapped, buffer.realized)._buffer())
   else:
@@ -362,17 +459,21 @@ def _realize_empty(buffer: LazyBuffer) -> None:
 
 def _realize_rand(buffer: LazyBuffer) -> None:
   rng = np.random.default_rng(buffer.op.arg)
-  buffer.realized = Device[buffer.device].buffer.fromCPU(rng.random(size=buffer.shape, dtype=np.float32).astype(dtype=buffer.dtype.np, copy=False), **buffer._device_extra_args()) # type: ignore
+  x = rng.random(size=buffer.shape, dtype=np.float32)
+  buffer.realized = Device[buffer.device].buffer.fromCPU(float_to_bf16(x) if buffer.dtype == dtypes.bfloat16 else x.astype(dtype=buffer.dtype.np, copy=False), **buffer._device_extra_args()) # type: ignore
 
 def _realize_const(buffer: LazyBuffer) -> None:
   if hasattr(Device[buffer.device].codegen, 'supports_constant_folding'):
     buffer.realized = RawConst(1, buffer.dtype, float(buffer.op.arg))
   else:
-    buffer.realized = Device[buffer.device].buffer.fromCPU(np.array(buffer.op.arg, dtype=buffer.dtype.np), **buffer._device_extra_args())
+    x = np.array(buffer.op.arg, dtype=np.float32 if buffer.dtype == dtypes.bfloat16 else buffer.dtype.np)
+    buffer.realized = Device[buffer.device].buffer.fromCPU(float_to_bf16(x) if buffer.dtype == dtypes.bfloat16 else x, **buffer._device_extra_args())
 
 LOAD_OPS_DISPATCHER: Dict[LoadOps, Callable] = {
   LoadOps.CONTIGUOUS: _realize_contiguous,
   LoadOps.CUSTOM: _realize_custom,
+  LoadOps.GATHER: _realize_gather,
+  LoadOps.SCATTER: _realize_scatter,
   LoadOps.FROM: _realize_from,
   LoadOps.EMPTY: _realize_empty,
   LoadOps.RAND: _realize_rand,
@@ -386,4 +487,5 @@ MOVEMENT_OPS_DISPATCHER: Dict[MovementOps, Callable] = {
   MovementOps.PERMUTE: LazyBuffer.permute,
   MovementOps.PAD: LazyBuffer.pad,
   MovementOps.STRIDE: LazyBuffer.stride,
+  MovementOps.WINDOW: LazyBuffer.window,
 }
\ No newline at end of file
@@ -1,7 +1,7 @@
-from typing import Tuple, Optional
-from tinygrad.helpers import argsort, ShapeType
-from tinygrad.ops import UnaryOps, BinaryOps, TernaryOps, ReduceOps
-from tinygrad.tensor import Function
+from typing import Tuple, Optional, Union
+from tinygrad.helpers import argsort, flatten, prod, dtypes, ShapeType
+from tinygrad.ops import UnaryOps, BinaryOps, TernaryOps, ReduceOps, LoadOps
+from tinygrad.tensor import Function, SparseGrad
 from tinygrad.lazy import LazyBuffer
 import math
 
@@ -110,6 +110,17 @@ class Equal(Function):
   def forward(self, x:LazyBuffer, y:LazyBuffer) -> LazyBuffer:
     return x.binary_op(BinaryOps.CMPEQ, y)
 
+# NOTE: this is fmod, x - fmod(x, y) is y times the truncated quotient
+class Mod(Function):
+  __slots__ = 'x', 'y', 'ret'
+  def forward(self, x:LazyBuffer, y:LazyBuffer) -> LazyBuffer:
+    self.x, self.y, self.ret = x, y, x.binary_op(BinaryOps.MOD, y)
+    return self.ret
+
+  def backward(self, grad_output:LazyBuffer) -> Tuple[Optional[LazyBuffer], Optional[LazyBuffer]]:
+    return grad_output if self.needs_input_grad[0] else None, \
+           grad_output.binary_op(BinaryOps.MUL, self.ret.binary_op(BinaryOps.SUB, self.x)).binary_op(BinaryOps.DIV, self.y) if self.needs_input_grad[1] else None
+
 class Maximum(Function):
   __slots__ = "x", "y", "ret"
   def forward(self, x:LazyBuffer, y:LazyBuffer) -> LazyBuffer:
@@ -230,3 +241,84 @@ class Flip(Function):
 
   def backward(self, grad_output:LazyBuffer) -> LazyBuffer:
     return grad_output.stride(self.arg)
+
+# NOTE: the grad of x.window(arg) is a sum of the windows in reverse. Conv uses it for the input grad of a strided conv
+def _window_backward(grad_output:LazyBuffer, input_shape:Tuple[int, ...], arg:Tuple[Tuple[int, int, int], ...]) -> LazyBuffer:
+  n, m = len(input_shape)-len(arg), len(arg)
+  prefix, i_, o_ = input_shape[:n], input_shape[n:], grad_output.shape[n:n+m]
+  if all(k <= s and d == 1 for k,s,d in arg):
+    # the windows don't overlap, put every one back in place
+    ret = grad_output.permute((*range(n), *flatten((n+j, n+m+j) for j in range(m))))
+    ret = ret.pad(((0,0),)*n + tuple(flatten(((0,0), (0,s-k)) for k,s,_ in arg))).reshape((*prefix, *[o*s for o,(_,s,_) in zip(o_, arg)]))
+    ret = ret.shrink(tuple([(0,s) for s in prefix] + [(0,min(i,o*s)) for i,o,(_,s,_) in zip(i_, o_, arg)]))
+    return ret.pad(((0,0),)*n + tuple([(0,max(0,i-o*s)) for i,o,(_,s,_) in zip(i_, o_, arg)]))
+  # the windows overlap, [o, k] goes back to [o*s + k*d]. the grad is (*prefix, k, o, ...) with o dilated by the stride, and the row of kernel position k
+  # is shifted by k*d: a row of length L read as rows of length L-d is shifted by d more on every row. this is O(k*o), the sum over k is one reduce
+  g = grad_output.permute((*range(n), *flatten((n+m+j, n+j) for j in range(m))))
+  for j,(o,(k,s,d)) in enumerate(zip(o_, arg)):
+    a, sh = n+2*j, g.shape
+    L = (o-1)*s+1+k*d
+    g = g.reshape((*sh[:a+1], o, 1, *sh[a+2:])).pad(((0,0),)*(a+2) + ((0,s-1),) + ((0,0),)*(len(sh)-a-2)).reshape((*sh[:a+1], o*s, *sh[a+2:]))
+    g = g.pad(((0,0),)*(a+1) + ((0,L-o*s),) + ((0,0),)*(len(sh)-a-2)) if L >= o*s else g.shrink(tuple((0,x) for x in sh[:a+1]) + ((0,L),) + tuple((0,x) for x in sh[a+2:]))
+    g = g.reshape((*sh[:a], k*L, *sh[a+2:])).shrink(tuple((0,x) for x in sh[:a]) + ((0,k*(L-d)),) + tuple((0,x) for x in sh[a+2:])).reshape((*sh[:a], k, L-d, *sh[a+2:]))
+  e_ = [(o-1)*s+1+(k-1)*d for o,(k,s,d) in zip(o_, arg)]
+  g = g.reduce_op(ReduceOps.SUM, (*prefix, *flatten((1,e) for e in e_))).reshape((*prefix, *e_))
+  return g.pad(((0,0),)*n + tuple((0,i-e) for i,e in zip(i_, e_)))
+
+class Window(Function):
+  __slots__ = 'input_shape', 'arg'
+  def forward(self, x:LazyBuffer, arg:Tuple[Tuple[int, int, int], ...]) -> LazyBuffer:
+    self.input_shape, self.arg = x.shape, arg
+    return x.window(arg)
+
+  def backward(self, grad_output:LazyBuffer) -> LazyBuffer: return _window_backward(grad_output, self.input_shape, self.arg)
+
+# ************* processing ops *************
+
+# NOTE: this is for the depthwise and grouped convs, the input stays in place and the reduce is over the windows and the channels of a group
+# without a stride the input grad is a conv of the grad with the flipped weights, and not a sum of the windows in reverse that copies the windows of the grad
+class Conv(Function):
+  __slots__ = 'x', 'w', 'xw', 'groups', 'arg'
+  def forward(self, x:LazyBuffer, w:LazyBuffer, groups:int, stride:Tuple[int, ...], dilation:Tuple[int, ...]) -> LazyBuffer:
+    (bs, (cout, cin), HW), n = (x.shape[0], w.shape[:2], w.shape[2:]), len(w.shape)-2
+    self.x, self.w, self.groups, self.arg = x, w, groups, tuple(zip(HW, stride, dilation))
+    xw = x.window(self.arg)   # (bs, groups*cin, *oyx, *HW)
+    self.xw = xw.reshape((bs, groups, 1, cin, *xw.shape[2:]))
+    full = (bs, groups, cout//groups, cin, *xw.shape[2:])
+    ret = self.xw.expand(full).binary_op(BinaryOps.MUL, w.reshape((1, groups, cout//groups, cin, *[1]*n, *HW)).expand(full))
+    return ret.reduce_op(ReduceOps.SUM, (bs, groups, cout//groups, 1, *xw.shape[2:2+n], *[1]*n)).reshape((bs, cout, *xw.shape[2:2+n]))
+
+  def backward(self, grad_output:LazyBuffer) -> Tuple[Optional[LazyBuffer], Optional[LazyBuffer]]:
+    (bs, (cout, cin), HW), n, i_, o_ = (self.x.shape[0], self.w.shape[:2], self.w.shape[2:]), len(self.arg), self.x.shape[2:], grad_output.shape[2:]
+    prefix, grad_input, grad_weight = (bs, self.groups, cout//self.groups), None, None
+    if self.needs_input_grad[0] and any(s > 1 for _,s,_ in self.arg):
+      # NOTE: with a stride most of the grad strided back into place is zeros, the windows of the grad are summed in reverse
+      full = (*prefix, cin, *o_, *HW)
+      g = grad_output.reshape((*prefix, 1, *o_, *[1]*n)).expand(full).binary_op(BinaryOps.MUL, self.w.reshape((1, *prefix[1:], cin, *[1]*n, *HW)).expand(full))
+      grad_input = _window_backward(g.reduce_op(ReduceOps.SUM, (bs, self.groups, 1, cin, *o_, *HW)).reshape((bs, self.groups*cin, *o_, *HW)), self.x.shape, self.arg)
+    elif self.needs_input_grad[0]:
+      # the grad padded so the window of the flipped kernel at every input is all the outputs it's in
+      g = grad_output.reshape((*prefix, *o_)).pad(((0,0),)*3 + tuple(((k-1)*d, i-o) for i,o,(k,_,d) in zip(i_, o_, self.arg))).window(tuple((k,1,d) for k,_,d in self.arg))
+      full = (*prefix, cin, *i_, *HW)
+      w = self.w.stride((1, 1, *[-1]*n)).reshape((1, *prefix[1:], cin, *[1]*n, *HW))
+      grad_input = g.reshape((*prefix, 1, *i_, *HW)).expand(full).binary_op(BinaryOps.MUL, w.expand(full)).reduce_op(ReduceOps.SUM, (bs, self.groups, 1, cin, *i_, *[1]*n)).reshape(self.x.shape)
+    if self.needs_input_grad[1]:
+      full = (*prefix, cin, *o_, *HW)
+      g = grad_output.reshape((*prefix, 1, *o_, *[1]*n)).expand(full).binary_op(BinaryOps.MUL, self.xw.expand(full))
+      grad_weight = g.reduce_op(ReduceOps.SUM, (1, *prefix[1:], cin, *[1]*n, *HW)).reshape(self.w.shape)
+    return grad_input, grad_weight
+
+# ************* index ops *************
+
+class Gather(Function):
+  __slots__ = 'idx', 'input_shape', 'sparse'
+  def forward(self, x:LazyBuffer, idx:LazyBuffer, sparse:bool=False) -> LazyBuffer:
+    self.idx, self.input_shape, self.sparse = idx.cast(dtypes.int32), x.shape, sparse
+    return x.gather(self.idx)
+
+  # the rows of the grad are added to the rows they were gathered from
+  def backward(self, grad_output:LazyBuffer) -> Tuple[Union[LazyBuffer, SparseGrad], None]:
+    n = prod(self.idx.shape)
+    if self.sparse: return SparseGrad(self.idx.reshape((n,)), grad_output.reshape((n, *self.input_shape[1:])), self.input_shape), None
+    zeros = LazyBuffer.loadop(LoadOps.CONST, tuple(), grad_output.dtype, grad_output.device, arg=0).reshape((1,)*len(self.input_shape)).expand(self.input_shape)
+    return zeros.scatter(self.idx, grad_output, BinaryOps.ADD), None
@@ -115,10 +115,9 @@ class LayerNorm2d(LayerNorm):
   def __call__(self, x): return super().__call__(x.permute(0, 2, 3, 1)).permute(0, 3, 1, 2)
 
 class Embedding:
-  def __init__(self, vocab_size:int, embed_size:int):
-    self.vocab_size = vocab_size
+  def __init__(self, vocab_size:int, embed_size:int, sparse=False):
+    self.vocab_size, self.sparse = vocab_size, sparse
     self.weight = Tensor.glorot_uniform(vocab_size, embed_size)
 
-  def __call__(self, idx:Tensor) -> Tensor:
-    vocab_counter = Tensor.arange(self.vocab_size, requires_grad=False).reshape(1, 1, self.vocab_size).expand(*idx.shape, self.vocab_size)
-    return (vocab_counter == idx.unsqueeze(2).expand(*idx.shape, self.vocab_size)) @ self.weight
+  # with sparse=True the grad of the weight is a SparseGrad of the rows in idx, and the optimizers only update those rows
+  def __call__(self, idx:Tensor) -> Tensor: return self.weight.index_select(idx, sparse=self.sparse)
@@ -1,10 +1,12 @@
 # sorted in order of increasing complexity
-from typing import List
-from tinygrad.helpers import dedup
-from tinygrad.tensor import Tensor
+import functools
+import numpy as np
+from typing import List, Optional, Tuple, Dict, Union
+from tinygrad.helpers import dedup, dtypes
+from tinygrad.tensor import Tensor, SparseGrad
 
 class Optimizer:
-  def __init__(self, params: List[Tensor], lr: float):
+  def __init__(self, params: List[Tensor], lr: float, loss_scale: Optional[float]=None, growth_interval=2000):
     # if it's None, but being put into an optimizer, set it to True
     for x in params:
       if x.requires_grad is None: x.requires_grad = True
@@ -13,58 +15,163 @@ class Optimizer:
     self.buffers: List[Tensor] = dedup([x for x in params if not x.requires_grad])   # buffers are still realized
     self.lr = Tensor([lr], requires_grad=False).contiguous()
 
+    # mixed precision: a param that isn't float32 is the compute copy of a float32 master, the optimizer state and the update are float32
+    self.master: List[Tensor] = [t.detach().cast(dtypes.float32).contiguous().realize() if t.dtype != dtypes.float32 else t for t in self.params]
+    # dynamic loss scaling: backward is on scale(loss). a step with an inf or a nan in the grads is skipped and halves the scale,
+    # growth_interval steps in a row without one double it. it's all done on the device, so it works in the jit
+    self.loss_scale = Tensor([loss_scale], requires_grad=False).contiguous().realize() if loss_scale is not None else None
+    self.growth_interval, self.good_steps = growth_interval, Tensor([0.], requires_grad=False).contiguous().realize()
+    # for the params with a SparseGrad: a slot per row to coalesce its indices, and the step each row was last updated
+    self.slots: Dict[int, Tensor] = {}
+    self.last: Dict[int, Tensor] = {}
+
   def zero_grad(self):
     for param in self.params: param.grad = None
 
+  def scale(self, loss:Tensor) -> Tensor: return (loss * self.loss_scale).reshape(loss.shape) if self.loss_scale is not None else loss
+
   def realize(self, extra=None):
     # TODO: corealize
     # NOTE: in extra is too late for most of the params due to issues with assign
-    for p in extra + self.params + self.buffers if extra is not None else self.params + self.buffers:
+    # NOTE: the params are computed from the loss scale, so it's last
+    scale = [self.loss_scale, self.good_steps] if self.loss_scale is not None else []
+    for p in (extra if extra is not None else []) + self.params + self.buffers + scale:
       p.realize()
 
+  # the float32 grads without the loss scale. with loss scaling, finite is 1 if they are all finite and 0 if the step is skipped
+  # NOTE: a SparseGrad is float32 rows too, the finite check is on its rows before they are coalesced
+  def _grads(self) -> Tuple[List[Union[Tensor, SparseGrad]], Optional[Tensor]]:
+    assert all(t.grad is not None for t in self.params)
+    def rows(g, fxn): return SparseGrad(g.idx, fxn(g.values), g.shape) if isinstance(g, SparseGrad) else fxn(g)
+    grads = [rows(t.grad.realize(), lambda x: x.cast(dtypes.float32)) for t in self.params]  # type: ignore
+    if self.loss_scale is None: return grads, None
+    grads = [rows(g, lambda x: x / self.loss_scale) for g in grads]
+    # NOTE: not abs, relu drops nans in C. and max with a nan isn't the same on every backend, one of the two orders catches it
+    s = functools.reduce(Tensor.add, [(x * x).sum() for x in [g.values if isinstance(g, SparseGrad) else g for g in grads]]).reshape(1)
+    finite = (s <= 3e38) * Tensor.full_like(s, 3e38).maximum(s).eq(3e38)
+    return grads, finite.realize()
+
+  def _keep(self, finite:Optional[Tensor], new:Tensor, old:Tensor) -> Tensor: return new if finite is None else finite.where(new, old)
+
+  def _assign(self, i:int, new:Tensor, finite:Optional[Tensor]):
+    t, master = self.params[i], self.master[i]
+    new = self._keep(finite, new, master.detach())
+    if master is t: return t.assign(new)
+    # NOTE: the master is realized first, else the cast merges the update into the param's kernel and it runs on the updated master
+    master.assign(new).realize()
+    t.assign(master.cast(t.dtype))
+
+  # a SparseGrad only updates the rows in it, they are coalesced in O(len(idx)) with the slots: the position of every index is written
+  # to its slot, the last one is kept, so pos is the same for all the positions of an index and G is the sum of their rows at each of them
+  # first is 1 at one position of each index. the new rows at the positions of an index are the same, so it doesn't matter which is written
+  def _coalesce(self, i:int, g:SparseGrad) -> Tuple[Tensor, Tensor]:
+    if i not in self.slots: self.slots[i] = Tensor.zeros(g.shape[0], dtype=dtypes.int32, device=g.device, requires_grad=False).contiguous().realize()
+    n = g.idx.shape[0]
+    arange = Tensor(np.arange(n, dtype=np.int32), device=g.device, requires_grad=False)
+    self.slots[i].assign(self.slots[i].index_copy(g.idx, arange)).realize()
+    pos = self.slots[i][g.idx].realize()
+    G = Tensor.zeros(n, *g.shape[1:], device=g.device).index_add(pos, g.values)[pos].realize()
+    return G, pos.eq(arange).cast(dtypes.float32).reshape(n, *[1]*(len(g.shape)-1))
+
+  # the steps since each of the rows in idx was last updated, with a SparseGrad the moments of a row are decayed when it's in one
+  def _steps(self, i:int, idx:Tensor, t:Tensor, finite:Optional[Tensor]) -> Tensor:
+    if i not in self.last: self.last[i] = Tensor.zeros(self.params[i].shape[0], device=idx.device, requires_grad=False).contiguous().realize()
+    k = (t - self.last[i][idx]).reshape(idx.shape[0], *[1]*(len(self.params[i].shape)-1)).realize()
+    self._assign_rows(self.last[i], idx, t.expand(idx.shape[0]), finite)
+    return k
+
+  def _assign_rows(self, t:Tensor, idx:Tensor, new:Tensor, finite:Optional[Tensor]):
+    t.assign(t.index_copy(idx, self._keep(finite, new, t.detach()[idx]))).realize()
+
+  # the sparse _assign, the rows of the float32 master and then the ones of the param
+  def _assign_sparse(self, i:int, idx:Tensor, new:Tensor, finite:Optional[Tensor]):
+    t, master = self.params[i], self.master[i]
+    self._assign_rows(master, idx, new, finite)
+    if master is not t: t.assign(t.index_copy(idx, master.detach()[idx].cast(t.dtype))).realize()
+
+  def _update_scale(self, finite:Optional[Tensor]):
+    if finite is None or self.loss_scale is None: return
+    grow = (self.good_steps + 1).eq(self.growth_interval)
+    self.loss_scale.assign(finite.where(grow.where(self.loss_scale * 2, self.loss_scale), self.loss_scale * 0.5))
+    self.good_steps.assign(finite.where(grow.where(0.0, self.good_steps + 1), 0.0))
+
 class SGD(Optimizer):
-  def __init__(self, params: List[Tensor], lr=0.001, momentum=0, weight_decay=0.0, nesterov=False):
-    super().__init__(params, lr)
+  def __init__(self, params: List[Tensor], lr=0.001, momentum=0, weight_decay=0.0, nesterov=False, loss_scale=None):
+    super().__init__(params, lr, loss_scale)
     self.momentum, self.wd, self.nesterov = momentum, weight_decay, nesterov
     self.b = [Tensor.zeros(*t.shape, device=t.device, requires_grad=False) for t in self.params] if self.momentum else []
+    self.t = Tensor([0], requires_grad=False).realize()   # the steps are only counted for the momentum of a SparseGrad
 
   # https://pytorch.org/docs/stable/generated/torch.optim.SGD.html
   def step(self) -> None:
-    for i, t in enumerate(self.params):
-      assert t.grad is not None
-      g = t.grad.realize() + self.wd * t.detach()
+    grads, finite = self._grads()
+    if self.momentum and any(isinstance(g, SparseGrad) for g in grads): self.t.assign(self.t + (finite if finite is not None else 1)).realize()
+    for i, g in enumerate(grads):
+      if isinstance(g, SparseGrad):
+        self._sparse_step(i, g, finite)
+        continue
+      g = g + self.wd * self.master[i].detach()
       if self.momentum:
-        self.b[i].assign(self.momentum * self.b[i] + g).realize()  # NOTE: self.b[i] is zero on the first run, no if required
+        self.b[i].assign(self._keep(finite, self.momentum * self.b[i] + g, self.b[i])).realize()  # NOTE: self.b[i] is zero on the first run, no if required
         g = (g + self.momentum * self.b[i]) if self.nesterov else self.b[i]
-      t.assign(t.detach() - g * self.lr)
+      self._assign(i, self.master[i].detach() - g * self.lr, finite)
+    self._update_scale(finite)
     self.realize(self.b)
 
+  # the momentum of a row is decayed by momentum**k for the k steps since it was last in a SparseGrad, the weight decay is on its rows
+  def _sparse_step(self, i:int, g:SparseGrad, finite:Optional[Tensor]):
+    G, _ = self._coalesce(i, g)
+    p = self.master[i].detach()[g.idx]
+    G = G + self.wd * p
+    if self.momentum:
+      b = self.momentum ** self._steps(i, g.idx, self.t, finite) * self.b[i][g.idx] + G
+      self._assign_rows(self.b[i], g.idx, b, finite)
+      G = (G + self.momentum * b) if self.nesterov else b
+    self._assign_sparse(i, g.idx, p - G * self.lr, finite)
+
 # LAMB is essentially just the trust ratio part of LARS applied to Adam/W so if we just set the trust ratio to 1.0 its just Adam/W.
-def AdamW(params: List[Tensor], lr=0.001, b1=0.9, b2=0.999, eps=1e-8, wd=0.01): return LAMB(params, lr, b1, b2, eps, wd, adam=True)
-def Adam(params: List[Tensor], lr=0.001, b1=0.9, b2=0.999, eps=1e-8): return LAMB(params, lr, b1, b2, eps, 0.0, adam=True)
+def AdamW(params: List[Tensor], lr=0.001, b1=0.9, b2=0.999, eps=1e-8, wd=0.01, loss_scale=None): return LAMB(params, lr, b1, b2, eps, wd, adam=True, loss_scale=loss_scale)
+def Adam(params: List[Tensor], lr=0.001, b1=0.9, b2=0.999, eps=1e-8, loss_scale=None): return LAMB(params, lr, b1, b2, eps, 0.0, adam=True, loss_scale=loss_scale)
 
 class LAMB(Optimizer):
-  def __init__(self, params: List[Tensor], lr=0.001, b1=0.9, b2=0.999, eps=1e-6, wd=0.0, adam=False):
-    super().__init__(params, lr)
+  def __init__(self, params: List[Tensor], lr=0.001, b1=0.9, b2=0.999, eps=1e-6, wd=0.0, adam=False, loss_scale=None):
+    super().__init__(params, lr, loss_scale)
     self.b1, self.b2, self.eps, self.wd, self.adam, self.t = b1, b2, eps, wd, adam, Tensor([0], requires_grad=False).realize()
     self.m = [Tensor.zeros(*t.shape, device=t.device, requires_grad=False) for t in self.params]
     self.v = [Tensor.zeros(*t.shape, device=t.device, requires_grad=False) for t in self.params]
 
   def step(self) -> None:
-    self.t.assign(self.t + 1).realize()
-    for i, t in enumerate(self.params):
-      assert t.grad is not None
-      g = t.grad.realize()
-      self.m[i].assign(self.b1 * self.m[i] + (1.0 - self.b1) * g).realize()
-      self.v[i].assign(self.b2 * self.v[i] + (1.0 - self.b2) * (g * g)).realize()
+    grads, finite = self._grads()
+    # NOTE: a skipped step isn't counted for the bias correction
+    self.t.assign(self.t + (finite if finite is not None else 1)).realize()
+    for i, g in enumerate(grads):
+      if isinstance(g, SparseGrad):
+        self._sparse_step(i, g, finite)
+        continue
+      self.m[i].assign(self._keep(finite, self.b1 * self.m[i] + (1.0 - self.b1) * g, self.m[i])).realize()
+      self.v[i].assign(self._keep(finite, self.b2 * self.v[i] + (1.0 - self.b2) * (g * g), self.v[i])).realize()
       m_hat = self.m[i] / (1.0 - self.b1**self.t)
       v_hat = self.v[i] / (1.0 - self.b2**self.t)
-      up = (m_hat / (v_hat.sqrt() + self.eps)) + self.wd * t.detach()
-      if not self.adam:
-        r1 = t.detach().square().sum().sqrt()
-        r2 = up.square().sum().sqrt()
-        r = Tensor.where(r1 > 0, Tensor.where(r2 > 0, r1 / r2, 1.0), 1.0)
-      else:
-        r = 1.0
-      t.assign(t.detach() - self.lr * r * up)
+      up = (m_hat / (v_hat.sqrt() + self.eps)) + self.wd * self.master[i].detach()
+      r = 1.0 if self.adam else self._trust_ratio(self.master[i].detach(), up)
+      self._assign(i, self.master[i].detach() - self.lr * r * up, finite)
+    self._update_scale(finite)
     self.realize([self.t] + self.m + self.v)
+
+  def _trust_ratio(self, p:Tensor, up:Tensor) -> Tensor:
+    r1, r2 = p.square().sum().sqrt(), up.square().sum().sqrt()
+    return Tensor.where(r1 > 0, Tensor.where(r2 > 0, r1 / r2, 1.0), 1.0)
+
+  # the moments of a row are decayed by b1**k and b2**k for the k steps since it was last in a SparseGrad, the bias correction is the
+  # dense one. the trust ratio is over the rows that are updated, each of them is counted once
+  def _sparse_step(self, i:int, g:SparseGrad, finite:Optional[Tensor]):
+    G, first = self._coalesce(i, g)
+    k = self._steps(i, g.idx, self.t, finite)
+    m = self.b1**k * self.m[i][g.idx] + (1.0 - self.b1) * G
+    v = self.b2**k * self.v[i][g.idx] + (1.0 - self.b2) * (G * G)
+    self._assign_rows(self.m[i], g.idx, m, finite)
+    self._assign_rows(self.v[i], g.idx, v, finite)
+    p = self.master[i].detach()[g.idx]
+    up = (m / (1.0 - self.b1**self.t)) / ((v / (1.0 - self.b2**self.t)).sqrt() + self.eps) + self.wd * p
+    r = 1.0 if self.adam else self._trust_ratio(p * first, up * first)
+    self._assign_sparse(i, g.idx, p - self.lr * r * up, finite)
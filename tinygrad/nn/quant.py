@@ -0,0 +1,62 @@
+import json
+import numpy as np
+from typing import Dict, Tuple, Union
+from tinygrad.tensor import Tensor
+from tinygrad.helpers import dtypes, getenv, DType
+from tinygrad.state import get_state_dict, safe_load_metadata
+
+# block quantized weights: every block of QBLOCK values along the input axis shares a float32 scale
+# the int8 payload is one value per byte, int4 packs two values per byte with the first one in the low nibble
+QBLOCK = getenv("QBLOCK", 32)
+qtypes: Dict[str, Tuple[DType, int, int]] = {"int8": (dtypes.int8, 1, 127), "int4": (dtypes.uint8, 2, 7)}  # payload dtype, values per byte, max value
+
+def quantize(w:np.ndarray, qtype:str="int8", block:int=QBLOCK) -> Tuple[np.ndarray, np.ndarray]:
+  _, pack, qmax = qtypes[qtype]
+  assert w.shape[-1] % block == 0 and block % pack == 0, f"can't quantize {w.shape} in blocks of {block}"
+  blocks = w.astype(np.float32).reshape(*w.shape[:-1], -1, block)
+  scale = np.abs(blocks).max(axis=-1, keepdims=True) / qmax
+  q: np.ndarray = np.round(blocks / np.where(scale == 0, 1, scale)).astype(np.int8).reshape(*w.shape[:-1], -1)
+  if qtype == "int4": q = (q[..., 1::2]+8).astype(np.uint8)*16 + (q[..., 0::2]+8).astype(np.uint8)
+  return q, scale.reshape(*w.shape[:-1], -1)
+
+# NOTE: the payload and the scales are expanded to the shape of the weight before any ALU op, so this fuses into the kernel that uses the weight
+def dequantize(q:Tensor, scale:Tensor, qtype:str, block:int=QBLOCK) -> Tensor:
+  _, pack, qmax = qtypes[qtype]
+  shape = (*q.shape[:-1], q.shape[-1]*pack)
+  s = scale.reshape(*scale.shape, 1).expand(*scale.shape, block).reshape(shape)
+  if qtype == "int8": return q.cast(dtypes.float32) * s
+  # the nibble is floor(p/shift) % 16, with a shift of 1 for the low nibble and 16 for the high one
+  p = q.reshape(*q.shape, 1).expand(*q.shape, 2).reshape(shape).cast(dtypes.float32)
+  shift = Tensor([1., 16.], device=q.device).reshape(*[1]*len(q.shape), 2).expand(*q.shape, 2).reshape(shape)
+  return ((p - p % shift) / shift % 16 - (qmax+1)) * s
+
+# the int32 result of an int8 matmul or conv (with INT32_ACC=1) back to int8, scale is a float or per output channel. the cast truncates, so this rounds half away from zero
+def requantize(acc:Tensor, scale:Union[Tensor, float], qmax:int=127) -> Tensor:
+  x = (acc.cast(dtypes.float32) * scale).clip(-qmax, qmax)
+  return (x + (x >= 0).where(0.5, -0.5)).cast(dtypes.int8)
+
+class QuantizedLinear:
+  def __init__(self, in_features, out_features, bias=True, qtype="int8", block=QBLOCK):
+    dtype, pack, _ = qtypes[qtype]
+    self.qtype, self.block = qtype, block
+    self.weight, self.scale = Tensor.empty(out_features, in_features//pack, dtype=dtype), Tensor.empty(out_features, in_features//block)
+    self.bias = Tensor.zeros(out_features) if bias else None
+
+  def __call__(self, x:Tensor) -> Tensor:
+    return x.linear(dequantize(self.weight, self.scale, self.qtype, self.block).transpose(), self.bias)
+
+# replaces the float weights of the QuantizedLinear layers of the model in the state dict with their payload and scales
+def quantize_state_dict(model, state_dict:Dict[str, Tensor]) -> Dict[str, Tensor]:
+  ret = dict(state_dict)
+  for name,layer in get_state_dict(model, tensor_type=QuantizedLinear).items():
+    if (w:=state_dict.get(f"{name}.weight")) is None or not dtypes.is_float(w.dtype): continue
+    q, s = quantize(w.numpy(), layer.qtype, layer.block)
+    ret[f"{name}.weight"], ret[f"{name}.scale"] = Tensor(q), Tensor(s)
+  return ret
+
+# safetensors extension: the qtype and block of each QuantizedLinear are in the metadata, the payloads and scales are U8, I8 and F32 tensors
+def quantization_metadata(model) -> Dict[str, str]:
+  return {"quantization": json.dumps({name:{"qtype": layer.qtype, "block": layer.block} for name,layer in get_state_dict(model, tensor_type=QuantizedLinear).items()})}
+
+def safe_load_quantization(fn:Union[Tensor,str]) -> Dict[str, Dict[str, Union[str, int]]]:
+  return json.loads(safe_load_metadata(fn)[2].get("__metadata__", {}).get("quantization", "{}"))
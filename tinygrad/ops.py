@@ -2,7 +2,7 @@ from __future__ import annotations
 import functools, time
 from enum import Enum, auto
 from typing import TYPE_CHECKING, Union, Type, Tuple, Any, List, Optional, Dict, Callable, cast
-from tinygrad.helpers import ansilen, prod, DEBUG, getenv, GlobalCounters, DType, colored, dedup
+from tinygrad.helpers import ansilen, prod, DEBUG, getenv, GlobalCounters, DType, dtypes, colored, dedup, COMPILE_LOG, CompileStats, compile_stage
 from tinygrad.shape.shapetracker import MovementOps
 from tinygrad.runtime.lib import RawBuffer, RawConst, buf_is_kernel_arg
 if TYPE_CHECKING:
@@ -16,7 +16,7 @@ class UnaryOps(Enum): NOOP = auto(); EXP2 = auto(); LOG2 = auto(); CAST = auto()
 class BinaryOps(Enum): ADD = auto(); SUB = auto(); MUL = auto(); DIV = auto(); CMPEQ = auto(); MAX = auto(); MOD = auto(); CMPLT = auto() # noqa: E702
 class ReduceOps(Enum): SUM = auto(); MAX = auto() # noqa: E702
 class TernaryOps(Enum): MULACC = auto(); WHERE = auto() # noqa: E702
-class LoadOps(Enum): EMPTY = auto(); RAND = auto(); CONST = auto(); FROM = auto(); CONTIGUOUS = auto(); CUSTOM = auto() # noqa: E702
+class LoadOps(Enum): EMPTY = auto(); RAND = auto(); CONST = auto(); FROM = auto(); CONTIGUOUS = auto(); CUSTOM = auto(); GATHER = auto(); SCATTER = auto() # noqa: E702
 
 Op = Union[UnaryOps, BinaryOps, ReduceOps, MovementOps, LoadOps, TernaryOps]
 OpType = Union[Type[UnaryOps], Type[BinaryOps], Type[ReduceOps], Type[MovementOps], Type[LoadOps], Type[TernaryOps]]
@@ -80,8 +80,9 @@ class LazyOp:
 # **************** for Interpreted Buffers ****************
 
 class Interpreted:
-  def __init__(self, buffer, fxn_for_op: Dict[Op, Callable], from_lazybuffer=lambda x: x.realized, to_underlying=lambda x: x._buf, from_underlying=None):
-    self.buffer = buffer
+  # NOTE: the storage_dtypes of a device are only loaded and stored, the math on them is in float32
+  def __init__(self, buffer, fxn_for_op: Dict[Op, Callable], from_lazybuffer=lambda x: x.realized, to_underlying=lambda x: x._buf, from_underlying=None, storage_dtypes:Tuple[DType, ...]=(dtypes.bfloat16,)):
+    self.buffer, self.storage_dtypes = buffer, storage_dtypes
     self.fxn_for_op = fxn_for_op
     self.from_lazybuffer = from_lazybuffer
     self.from_underlying = buffer if from_underlying is None else from_underlying
@@ -89,9 +90,13 @@ class Interpreted:
     self.synchronize = lambda: None
     self.codegen = None
 
-  def exec_ast(self, ast:LazyOp, output=None, context=None, **kwargs):
+  def fuse_ast(self, ast:LazyOp) -> LazyOp:
     if TernaryOps.MULACC in self.fxn_for_op and ast.op == ReduceOps.SUM and ast.src[0].__class__ is LazyOp and ast.src[0].op == BinaryOps.MUL:
-      ast = LazyOp(TernaryOps.MULACC, cast(LazyOp, ast.src[0]).src, ast.arg)
+      return LazyOp(TernaryOps.MULACC, cast(LazyOp, ast.src[0]).src, ast.arg)
+    return ast
+
+  def exec_ast(self, ast:LazyOp, output=None, context=None, **kwargs):
+    ast = self.fuse_ast(ast)
     created_context = context is None
     if context is None: context = dict()
     if not created_context and ast in context: return context[ast]
@@ -103,9 +108,34 @@ class Interpreted:
     if output is not None and output.output_buffer is not None:
       assert output.output_buffer.size == ret.size, output.output_buffer.dtype == ret.dtype
       output.output_buffer._buf = ret._buf
-      return output.output_buffer
+      ret = output.output_buffer
+    if output is not None and GlobalCounters.cache is not None:
+      rawbufs = [ret] + dedup([x.realized for x in ast.buffers])
+      GlobalCounters.cache.append((InterpretedPlan(self, ast, rawbufs), rawbufs))
     return ret
 
+# replays an ast on an Interpreted backend without the lazy graph, the first rawbuf is the output and the rest are the inputs
+class InterpretedPlan:
+  def __init__(self, interpreted:Interpreted, ast:LazyOp, rawbufs:List[RawBuffer]):
+    self.interpreted, self.plan = interpreted, cast(List[Tuple[Callable, List[int], List[Any]]], [])
+    slots: Dict[LazyOp, int] = {}
+    def build(x:Union[LazyOp, LazyBuffer]) -> int:
+      if x.__class__ is not LazyOp: return rawbufs.index(cast(RawBuffer, cast('LazyBuffer', x).realized), 1)
+      x = interpreted.fuse_ast(cast(LazyOp, x))
+      if x not in slots:
+        srcs = [build(y) for y in x.src]
+        self.plan.append((interpreted.fxn_for_op[x.op], srcs, [x.arg] if x.arg is not None else []))
+        slots[x] = len(rawbufs) + len(self.plan) - 1
+      return slots[x]
+    build(ast)
+
+  def __call__(self, rawbufs:List[RawBuffer], jit=False, force_wait=False) -> Optional[float]:
+    vals = [self.interpreted.to_underlying(x) for x in rawbufs]
+    for fxn, srcs, arg in self.plan: vals.append(fxn(*[vals[i] for i in srcs], *arg))
+    rawbufs[0]._buf = self.interpreted.from_underlying(vals[-1])._buf
+    GlobalCounters.kernel_count += 1
+    return None
+
 class FlopCounter:
   def __init__(self, tup:Tuple[Tuple[int, ...], DType, int]): self.shape, self.dtype, self.flops, self._buf = *tup, self
   def consume_flops(self):
@@ -118,8 +148,11 @@ shape_fxn_for_op: Dict[Op, Callable] = {
   **{op:lambda self,y: (self.shape, max(self.dtype, y.dtype), self.consume_flops() + y.consume_flops() + prod(self.shape)) for op in BinaryOps},
   **{op:lambda self,new_shape: (new_shape, self.dtype, self.consume_flops() + prod(self.shape)) for op in ReduceOps},
   **{op:functools.partial(lambda mop,self,arg: (ShapeTracker(self.shape).movement_op(mop, arg).shape, self.dtype, self.consume_flops()), op) for op in MovementOps},
-  TernaryOps.WHERE: lambda self,y,z: (self.shape, self.dtype, self.consume_flops() + y.consume_flops() + z.consume_flops() + prod(self.shape))}
+  TernaryOps.WHERE: lambda self,y,z: (self.shape, self.dtype, self.consume_flops() + y.consume_flops() + z.consume_flops() + prod(self.shape)),
+  LoadOps.GATHER: lambda self,idx,shape: (shape, self.dtype, self.consume_flops() + idx.consume_flops()),
+  LoadOps.SCATTER: lambda self,idx,op: (self.shape, self.dtype, self.consume_flops() + idx.consume_flops() + (prod(self.shape) if op == BinaryOps.ADD else 0))}
 InterpretedFlopCounter = Interpreted(FlopCounter, shape_fxn_for_op, lambda x: FlopCounter((x.shape, x.dtype, 0)), lambda x: x)
+@compile_stage("get_lazyop_info")
 def get_lazyop_info(ast:LazyOp) -> FlopCounter: return InterpretedFlopCounter.exec_ast(ast)
 
 # **************** for Compiled Buffers ****************
@@ -129,6 +162,7 @@ class ASTRunner:
     if DEBUG >= 4 and (runtime_args is None or 'binary' not in runtime_args): print(prg)
     self.name, self.prg, self.global_size, self.local_size, self.op_estimate, self.mem_estimate, self.display_name, self.runtime_args = name, prg, global_size, local_size, op_estimate, mem_estimate, display_name, runtime_args if runtime_args is not None else {}
 
+  @compile_stage("build")
   def build(self, runtime):
     self.clprg = runtime(self.name, self.prg, **self.runtime_args)
     return self
@@ -152,10 +186,16 @@ class ASTRunner:
     return et
 
 class Compiled:
-  def __init__(self, buffer: Type[RawBuffer], codegen, runtime, synchronize=lambda: None):
-    self.buffer, self.codegen, self.runtime, self.synchronize = buffer, codegen, runtime, synchronize
+  def __init__(self, buffer: Type[RawBuffer], codegen, runtime, synchronize=lambda: None, graph=None, storage_dtypes:Tuple[DType, ...]=(dtypes.bfloat16,)):
+    self.buffer, self.codegen, self.runtime, self.synchronize, self.graph, self.storage_dtypes = buffer, codegen, runtime, synchronize, graph, storage_dtypes
     self.method_cache: Dict[str, ASTRunner] = {}
 
+  def to_program(self, k) -> ASTRunner:
+    st = time.perf_counter()
+    prg = k.codegen().build(self.runtime)
+    if COMPILE_LOG: CompileStats.flush(time.perf_counter()-st, name=prg.name, codegen=k.__class__.__name__, op_estimate=prg.op_estimate, mem_estimate=prg.mem_estimate)
+    return prg
+
   def exec_ast(self, ast:LazyOp, output, **kwargs):
     # all movementops do nothing in a Compiled buffer!
     if ast.op in MovementOps and ast.src[0].__class__ is not LazyOp and ast.src[0].realized: return ast.src[0].realized
@@ -180,11 +220,11 @@ class Compiled:
 
     # this is the default now
     if hasattr(k, 'key') and getenv("ENABLE_METHOD_CACHE", 1):
-      if k.key not in self.method_cache: self.method_cache[k.key] = k.codegen().build(self.runtime)
+      if k.key not in self.method_cache: self.method_cache[k.key] = self.to_program(k)
       elif DEBUG >= 5: print(f"method cache hit : {k.key}")
       prg = self.method_cache[k.key]
     else:
-      prg = k.codegen().build(self.runtime)
+      prg = self.to_program(k)
 
     if prg.name == getenv("PRINT_PRG", ''): print(prg.prg)
 
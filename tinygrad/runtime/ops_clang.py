@@ -1,6 +1,8 @@
-import os, time, ctypes, hashlib, subprocess, platform, tempfile
-from tinygrad.ops import Compiled
-from tinygrad.runtime.lib import RawMallocBuffer
+import os, time, ctypes, hashlib, subprocess, platform, tempfile, pathlib
+from typing import List, Tuple, Dict, Union, Optional, Any
+from tinygrad.ops import Compiled, GlobalCounters, BinaryOps
+from tinygrad.helpers import DType, dedup
+from tinygrad.runtime.lib import RawMallocBuffer, RawBuffer
 from tinygrad.codegen.cstyle import CStyleCodegen, CStyleLanguage
 
 args = {
@@ -8,25 +10,105 @@ args = {
   'Linux': {'cflags':'-lm -fPIC --rtlib=compiler-rt ', 'ext':'so', 'exp':''},
   'Darwin': {'cflags':'-lm -fPIC --rtlib=compiler-rt ', 'ext':'dylib', 'exp':''}
 }[platform.system()]
+# NOTE: half is stored as unsigned short and converted on load and store, with the f16c instructions where the cpu has them
+F16C = platform.machine() in ("x86_64", "AMD64") and os.path.exists("/proc/cpuinfo") and "f16c" in pathlib.Path("/proc/cpuinfo").read_text().split()
 
 class ClangProgram:
-  def __init__(self, name:str, prg:str):
-    prg = '#include <math.h>\n#define max(x,y) ((x>y)?x:y)\n#define int64 long\n#define half __fp16\n#define uchar unsigned char\n#define bool uchar\n' + prg
+  def __init__(self, name:str, prg:str, binary=False):
+    # NOTE: a binary prg is the bytes of the shared library
+    if not binary: prg = '#include <math.h>\n#define max(x,y) ((x>y)?x:y)\n#define int64 long\n#define uchar unsigned char\n#define bool uchar\n' + prg
     # TODO: is there a way to not write this to disk?
-    fn = f"{tempfile.gettempdir()}/clang_{hashlib.md5(prg.encode('utf-8')).hexdigest()}.{args['ext']}"
-    if not os.path.exists(fn):
-      subprocess.check_output(args=('clang -shared -O2 -Wall -Werror -x c '+args['cflags']+' - -o '+fn+'.tmp').split(), input=prg.encode('utf-8'))
-      os.rename(fn+'.tmp', fn)
-    self.lib = ctypes.CDLL(fn)
+    self.fn = f"{tempfile.gettempdir()}/clang_{hashlib.md5(prg if binary else prg.encode('utf-8')).hexdigest()}.{args['ext']}"  # type: ignore
+    if not os.path.exists(self.fn):
+      if binary: pathlib.Path(self.fn+'.tmp').write_bytes(prg)  # type: ignore
+      else: subprocess.check_output(args=('clang -shared -O2 -Wall -Werror -x c '+args['cflags']+('-mf16c ' if F16C else '')+' - -o '+self.fn+'.tmp').split(), input=prg.encode('utf-8'))
+      os.rename(self.fn+'.tmp', self.fn)
+    self.lib = ctypes.CDLL(self.fn)
     self.fxn = self.lib[name]
 
+  def binary(self) -> bytes: return pathlib.Path(self.fn).read_bytes()
+
   def __call__(self, global_size, local_size, *args, wait=False):
     if wait: st = time.monotonic()
     self.fxn(*[x._buf for x in args])
     if wait: return time.monotonic()-st
 
+# replays a whole jit_cache with one call. the kernel functions and the buffers that aren't inputs are passed in two arrays, so the
+# source only has the shape of the graph and a jit_cache with the same kernels and arguments reuses the compiled library
+class ClangGraph:
+  def __init__(self, jit_cache:List[Tuple[Any, List[Any]]], input_replace:Dict[Tuple[int, int], Tuple[Union[int, str], int, DType]]):
+    self.inputs = dedup([name for name,_,_ in input_replace.values()])
+    bufs: Dict[int, int] = {}
+    calls = []
+    for j,(prg,args) in enumerate(jit_cache):
+      cargs = [f"in{self.inputs.index(input_replace[(j,i)][0])}" if (j,i) in input_replace else f"b[{bufs.setdefault(ctypes.addressof(x._buf), len(bufs))}]" for i,x in enumerate(args)]
+      calls.append(f"  ((void (*)({', '.join(['void*']*len(args))}))f[{j}])({', '.join(cargs)});")
+    self.prg = ClangProgram("graph", f"void graph(void **f, void **b{''.join(f', void *in{i}' for i in range(len(self.inputs)))}) {{\n" + '\n'.join(calls) + "\n}")
+    self.fxns = (ctypes.c_void_p * len(jit_cache))(*[ctypes.cast(prg.clprg.fxn, ctypes.c_void_p) for prg,_ in jit_cache])
+    self.bufs = (ctypes.c_void_p * len(bufs))(*bufs.keys())
+    # keep the kernels (and their libraries) and the buffers alive
+    self.jit_cache, self.op_estimate, self.mem_estimate = jit_cache, sum(prg.op_estimate for prg,_ in jit_cache), sum(prg.mem_estimate for prg,_ in jit_cache)
+
+  def __call__(self, input_rawbuffers:Dict[Union[int, str], RawBuffer], force_wait=False) -> Optional[float]:
+    if force_wait: st = time.monotonic()
+    self.prg.fxn(self.fxns, self.bufs, *[input_rawbuffers[name]._buf for name in self.inputs])
+    et = time.monotonic()-st if force_wait else None
+    if et is not None: GlobalCounters.time_sum_s += et
+    GlobalCounters.kernel_count += len(self.jit_cache)
+    GlobalCounters.global_ops += self.op_estimate
+    GlobalCounters.global_mem += self.mem_estimate
+    return et
+
+# bfloat16 is the upper half of a float32, the store rounds to nearest even and keeps NaNs quiet
+bf16_prekernel = """static inline float bf16_to_float(unsigned short x) { union { unsigned int u; float f; } v = { .u = (unsigned int)x << 16 }; return v.f; }
+static inline unsigned short float_to_bf16(float x) { union { float f; unsigned int u; } v = { .f = x }; return x != x ? 0x7fc0 : (unsigned short)((v.u + 0x7fff + ((v.u >> 16) & 1)) >> 16); }"""
+
+# half is IEEE binary16, the store rounds to nearest even. without f16c this is the branchless conversion from https://gist.github.com/rygorous/2156668
+f16_prekernel = """#ifdef __F16C__
+#include <immintrin.h>
+static inline float half_to_float(unsigned short x) { return _cvtsh_ss(x); }
+static inline unsigned short float_to_half(float x) { return _cvtss_sh(x, 0); }
+#else
+static inline float half_to_float(unsigned short x) {
+  union { unsigned int u; float f; } v = { .u = (unsigned int)(x & 0x7fff) << 13 }, magic = { .u = 113 << 23 };
+  unsigned int exp = v.u & (0x7c00 << 13);
+  v.u += (127 - 15) << 23;
+  if (exp == 0x7c00 << 13) v.u += (128 - 16) << 23;
+  else if (exp == 0) { v.u += 1 << 23; v.f -= magic.f; }
+  v.u |= (unsigned int)(x & 0x8000) << 16;
+  return v.f;
+}
+static inline unsigned short float_to_half(float x) {
+  union { float f; unsigned int u; } v = { .f = x }, denorm = { .u = ((127 - 15) + (23 - 10) + 1) << 23 };
+  unsigned int sign = v.u & 0x80000000, o;
+  v.u ^= sign;
+  if (v.u >= (127 + 16) << 23) o = v.u > 255 << 23 ? 0x7e00 : 0x7c00;
+  else if (v.u < 113 << 23) { v.f += denorm.f; o = v.u - denorm.u; }
+  else { unsigned int odd = (v.u >> 13) & 1; v.u += ((15 - 127) << 23) + 0xfff + odd; o = v.u >> 13; }
+  return (unsigned short)(o | (sign >> 16));
+}
+#endif
+// the loads and stores of 2 or 4 halfs convert them with one instruction
+typedef struct { float x, y; } float2;
+typedef struct { float x, y, z, w; } float4;
+static inline float2 make_float2(float x, float y) { float2 r = { x, y }; return r; }
+static inline float4 make_float4(float x, float y, float z, float w) { float4 r = { x, y, z, w }; return r; }
+#ifdef __F16C__
+static inline float4 half4_to_float4(const unsigned short* p) { float4 r; _mm_storeu_ps(&r.x, _mm_cvtph_ps(_mm_loadl_epi64((const __m128i*)p))); return r; }
+static inline void float4_to_half4(unsigned short* p, float4 v) { _mm_storel_epi64((__m128i*)p, _mm_cvtps_ph(_mm_loadu_ps(&v.x), 0)); }
+#else
+static inline float4 half4_to_float4(const unsigned short* p) { return make_float4(half_to_float(p[0]), half_to_float(p[1]), half_to_float(p[2]), half_to_float(p[3])); }
+static inline void float4_to_half4(unsigned short* p, float4 v) { p[0] = float_to_half(v.x); p[1] = float_to_half(v.y); p[2] = float_to_half(v.z); p[3] = float_to_half(v.w); }
+#endif
+static inline float2 half2_to_float2(const unsigned short* p) { return make_float2(half_to_float(p[0]), half_to_float(p[1])); }
+static inline void float2_to_half2(unsigned short* p, float2 v) { p[0] = float_to_half(v.x); p[1] = float_to_half(v.y); }"""
+
 class ClangCodegen(CStyleCodegen):
-  lang = CStyleLanguage(kernel_prefix=args['exp'], buffer_suffix=" restrict")
+  # NOTE: fmodf is a call into libm, this is inline and exact while the quotient fits in a long. the cast of a bigger (or nan) quotient is UB, those are fmodf
+  lang = CStyleLanguage(kernel_prefix=args['exp'], buffer_suffix=" restrict", bf16_prekernel=bf16_prekernel, f16_prekernel=f16_prekernel, float4="make_float4", code_for_op={**CStyleLanguage().code_for_op, BinaryOps.MOD: lambda a,b: f"(fabs((double){a}/{b}) < 9.2e18 ? (float)((double){a}-(double){b}*(long)((double){a}/{b})) : fmodf({a},{b}))"})
   supports_float4: bool = False
+  supports_float4_alu: bool = False
+  supports_half4: bool = True
+  supports_serial_scatter: bool = True
 
-ClangBuffer = Compiled(RawMallocBuffer, ClangCodegen, ClangProgram)
+ClangBuffer = Compiled(RawMallocBuffer, ClangCodegen, ClangProgram, graph=ClangGraph)
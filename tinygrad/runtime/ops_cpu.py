@@ -1,8 +1,9 @@
 import numpy as np
 import operator
 from typing import Callable, Dict, Tuple, Optional
-from tinygrad.helpers import dtypes, DType
-from tinygrad.ops import UnaryOps, BinaryOps, MovementOps, ReduceOps, TernaryOps, Op, Interpreted
+from tinygrad.helpers import dtypes, DType, prod, bf16_to_float, float_to_bf16
+from tinygrad.ops import UnaryOps, BinaryOps, MovementOps, ReduceOps, TernaryOps, LoadOps, Op, Interpreted
+from tinygrad.shape.shapetracker import window_shape_strides
 from tinygrad.runtime.lib import RawBuffer
 
 def shape_to_axis(old_shape:Tuple[int, ...], new_shape:Tuple[int, ...]) -> Tuple[int, ...]:
@@ -27,18 +28,43 @@ def einsum_mulacc(einsum, get_strides, expand):
     (a_axes, a_slices), (b_axes, b_slices) = axes_slice(get_strides(a)), axes_slice(get_strides(b))
     out = [i for i in range(len(new_shape)) if a.shape[i] == new_shape[i] and (i in a_axes or i in b_axes)]
     ret = einsum(f"{einscripts(a_axes)}, {einscripts(b_axes)} -> {einscripts(out)}", a[a_slices], b[b_slices])
+    # a reduced axis that is expanded in both isn't in the einsum, every element of the sum is the same
+    if (cnt:=prod(a.shape[i] for i in range(len(new_shape)) if a.shape[i] != new_shape[i] and i not in a_axes and i not in b_axes)) != 1: ret = ret * cnt
     return expand(ret.reshape([(1 if i not in a_axes and i not in b_axes else s) for i,s in enumerate(new_shape)]), new_shape)
   return mulacc
 
+# a cast of an expanded array is done before the expand, so an int matmul doesn't copy its broadcasted inputs
+def expanded_cast(cast, get_strides, expand):
+  def _cast(x, y):
+    if 0 not in get_strides(x): return cast(x, y)
+    return expand(cast(x[tuple(slice(None) if st != 0 else slice(0, 1) for st in get_strides(x))], y), x.shape)
+  return _cast
+
+def numpy_cast(x:np.ndarray, y:DType) -> np.ndarray:
+  if x.dtype == dtypes.bfloat16.np: x = bf16_to_float(x)
+  return float_to_bf16(x) if y == dtypes.bfloat16 else x.astype(y.np, copy=False)
+
+# NOTE: negative indices count from the end like python, the ones out of range are clamped to the first or the last row. this is for numpy and torch
+def normalize_idx(idx, rows:int): return (idx + (idx < 0) * rows).clip(0, rows-1)
+
+# NOTE: np.add.at adds the rows of an index that's in idx more than once, the bfloat16 rows are added in float32
+def numpy_scatter(x:np.ndarray, idx:np.ndarray, src:np.ndarray, op:Op) -> np.ndarray:
+  ret = (bf16_to_float(x) if x.dtype == dtypes.bfloat16.np and op == BinaryOps.ADD else x).reshape(-1, src.size//max(idx.size, 1)).copy()
+  idx = normalize_idx(idx, ret.shape[0])
+  if op == BinaryOps.ADD: np.add.at(ret, idx.reshape(-1), (bf16_to_float(src) if src.dtype == dtypes.bfloat16.np else src).reshape(idx.size, -1))
+  else: ret[idx.reshape(-1)] = src.reshape(idx.size, -1)
+  return (float_to_bf16(ret) if x.dtype == dtypes.bfloat16.np and op == BinaryOps.ADD else ret).reshape(x.shape)
+
 numpy_fxn_for_op: Dict[Op, Callable] = {**base_fxn_for_op, **{
-  UnaryOps.NOOP: lambda x: np.require(x, requirements='C'), UnaryOps.EXP2: np.exp2, UnaryOps.LOG2: np.log2, UnaryOps.CAST: lambda x,y: x.astype(y.np, copy=False), UnaryOps.SIN: np.sin,
+  UnaryOps.NOOP: lambda x: np.require(x, requirements='C'), UnaryOps.EXP2: np.exp2, UnaryOps.LOG2: np.log2, UnaryOps.CAST: expanded_cast(numpy_cast, lambda x: x.strides, np.broadcast_to), UnaryOps.SIN: np.sin,
   BinaryOps.MAX: np.maximum, BinaryOps.CMPEQ: lambda x,y: (x==y).astype(np.promote_types(x.dtype,y.dtype)), BinaryOps.ADD: lambda x, y: np.add(*match_types(x, y)),
   BinaryOps.SUB: lambda x, y: np.subtract(*match_types(x, y)), BinaryOps.MUL: lambda x, y: np.multiply(*match_types(x, y)),
-  BinaryOps.DIV: lambda x, y: np.divide(*match_types(x, y)), UnaryOps.SQRT: np.sqrt,
+  BinaryOps.DIV: lambda x, y: np.divide(*match_types(x, y)), BinaryOps.MOD: lambda x, y: np.fmod(*match_types(x, y)), UnaryOps.SQRT: np.sqrt,
   MovementOps.PERMUTE: lambda x, order: x.transpose(order), MovementOps.PAD: np.pad, MovementOps.EXPAND: np.broadcast_to,
   MovementOps.STRIDE: lambda x, arg: x[tuple(slice(None, None, i) for i in arg)],
+  MovementOps.WINDOW: lambda x, arg: np.lib.stride_tricks.as_strided(x, *window_shape_strides(x.shape, x.strides, arg), writeable=False),
   TernaryOps.MULACC: einsum_mulacc(lambda s,a,b: np.einsum(s, *match_types(a.copy(), b.copy()), optimize=True), lambda x: x.strides, np.broadcast_to),
-  TernaryOps.WHERE: np.where,
+  TernaryOps.WHERE: np.where, LoadOps.GATHER: lambda w, idx, shape: w.reshape(-1, prod(shape)//idx.size)[normalize_idx(idx.reshape(-1), w.size*idx.size//prod(shape))].reshape(shape), LoadOps.SCATTER: numpy_scatter,
 }}
 
 class RawNumpyBuffer(RawBuffer):
@@ -46,4 +72,5 @@ class RawNumpyBuffer(RawBuffer):
   @classmethod
   def fromCPU(cls, x): return cls(x.size, dtypes.from_np(x.dtype), x)
   def toCPU(self): return self._buf
-CPUBuffer = Interpreted(RawNumpyBuffer, numpy_fxn_for_op, from_underlying=RawNumpyBuffer.fromCPU)
+# NOTE: numpy has no float16 BLAS and sums half in half, so half is only stored and the math is in float32
+CPUBuffer = Interpreted(RawNumpyBuffer, numpy_fxn_for_op, from_underlying=RawNumpyBuffer.fromCPU, storage_dtypes=(dtypes.bfloat16, dtypes.float16))
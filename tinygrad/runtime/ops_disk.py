@@ -1,14 +1,20 @@
 import os, mmap
-from typing import Optional
+import numpy as np
+from typing import Optional, List, Tuple
 from typing import Callable, Dict
-from tinygrad.helpers import prod, DType
+from tinygrad.helpers import prod, DType, getenv
 from tinygrad.runtime.lib import RawBufferMapped
 from tinygrad.ops import Interpreted, Op, MovementOps, UnaryOps
+from tinygrad.shape.shapetracker import ShapeTracker, is_contiguous
+
+# a view with contiguous runs of at least this many bytes is read with preadv, a finer one is gathered from the mmap
+DISK_RUN = getenv("DISK_RUN", 4096)
 
 class RawDiskBuffer(RawBufferMapped):
-  def __init__(self, size, dtype:DType, device:Optional[str]=None, buf=None, shape=None, offset=0):  # pylint: disable=super-init-not-called
+  def __init__(self, size, dtype:DType, device:Optional[str]=None, buf=None, shape=None, offset=0, st:Optional[ShapeTracker]=None):  # pylint: disable=super-init-not-called
     self.shape = (size, ) if shape is None else shape
     self.offset = offset  # this is an offset in bytes
+    self.st = st  # NOTE: a view of the elements from offset on, only if the buffer isn't contiguous
     assert device is not None or buf is not None, "disk tensor needs a path or a buf"
     if device is not None:
       f = open(device, "a+b")
@@ -21,18 +27,71 @@ class RawDiskBuffer(RawBufferMapped):
   def __del__(self):
     self._buf[2] -= 1
     if self._buf[2] == 0: self._buf[0].close()
-  def cast(self, new_dtype:DType): return RawDiskBuffer(self.size, new_dtype, buf=self._buf, shape=self.shape, offset=self.offset)
-  def reshape(self, arg): return RawDiskBuffer(self.size, self.dtype, buf=self._buf, shape=arg, offset=self.offset)
+  def cast(self, new_dtype:DType):
+    assert self.st is None, "can't cast a view of a disk tensor"
+    return RawDiskBuffer(self.size, new_dtype, buf=self._buf, shape=self.shape, offset=self.offset)
+  def reshape(self, arg): return RawDiskBuffer(self.size, self.dtype, buf=self._buf, shape=arg, offset=self.offset) if self.st is None else self.view(MovementOps.RESHAPE, arg)
   def shrink(self, arg):
-    assert arg[1:] == tuple([(0,x) for x in self.shape[1:]]), f"can only slice the first dim of disk tensor {arg}"
+    if self.st is not None or arg[1:] != tuple([(0,x) for x in self.shape[1:]]): return self.view(MovementOps.SHRINK, arg)
     offset = arg[0][0]*prod(self.shape[1:])*self.dtype.itemsize
     size = (arg[0][1]-arg[0][0]) * prod(self.shape[1:])
     return RawDiskBuffer(size, self.dtype, buf=self._buf, offset=self.offset+offset, shape=(arg[0][1]-arg[0][0],)+self.shape[1:])
-  def _buffer(self): return memoryview(self._buf[1])[self.offset:self.offset+self.size*self.dtype.itemsize]
+  def view(self, op:MovementOps, arg):
+    st = (self.st.copy() if self.st is not None else ShapeTracker(self.shape)).movement_op(op, arg)
+    assert all(v.mask is None for v in st.views), f"can't {op} a disk tensor"
+    # a view that is only an offset is a contiguous disk tensor again
+    if len(st.views) == 1 and is_contiguous(st.shape, st.views[0].strides):
+      return RawDiskBuffer(prod(st.shape), self.dtype, buf=self._buf, offset=self.offset+st.views[0].offset*self.dtype.itemsize, shape=st.shape)
+    return RawDiskBuffer(prod(st.shape), self.dtype, buf=self._buf, offset=self.offset, shape=st.shape, st=st)
+  def _buffer(self):
+    assert self.st is None, "a view of a disk tensor isn't a buffer"
+    return memoryview(self._buf[1])[self.offset:self.offset+self.size*self.dtype.itemsize]
+  # a private copy on write mapping of this buffer, the pages are shared with the page cache until they are written to
+  def mmap_cow(self) -> memoryview:
+    start = self.offset - self.offset % mmap.ALLOCATIONGRANULARITY
+    return memoryview(mmap.mmap(self._buf[0].fileno(), self.offset+self.size*self.dtype.itemsize-start, access=mmap.ACCESS_COPY, offset=start))[self.offset-start:]
+  # the elements of the view, strided over the mmap if it's one view, else gathered
+  def _view_array(self) -> np.ndarray:
+    assert self.st is not None
+    base = np.frombuffer(self._buf[1], self.dtype.np, count=(len(self._buf[1])-self.offset)//self.dtype.itemsize, offset=self.offset)
+    if len(self.st.views) == 1: return np.lib.stride_tricks.as_strided(base[self.st.views[0].offset:], self.shape, [st*self.dtype.itemsize for st in self.st.views[0].strides], writeable=False)
+    idx = np.arange(prod(self.shape))
+    for v in reversed(self.st.views): idx = np.asarray(v.offset + sum(c*st for c,st in zip(np.unravel_index(idx, v.shape), v.strides)))
+    return base[idx].reshape(self.shape)
+  def toCPU(self): return super().toCPU() if self.st is None else self._view_array().copy()
+  def _copyin(self, x:np.ndarray):
+    if self.st is None: return super()._copyin(x)
+    assert len(self.st.views) == 1, "can only assign to a single view of a disk tensor"
+    base = np.frombuffer(self._buf[1], self.dtype.np, count=(len(self._buf[1])-self.offset)//self.dtype.itemsize, offset=self.offset)
+    np.copyto(np.lib.stride_tricks.as_strided(base[self.st.views[0].offset:], self.shape, [st*self.dtype.itemsize for st in self.st.views[0].strides]), x.reshape(self.shape))
+  # fill buf from the file at offset, a short read reads the rest. windows has no preadv, there it's a copy from the mmap
+  def pread(self, buf:memoryview, offset:int):
+    if not hasattr(os, "preadv"):
+      buf[:] = memoryview(self._buf[1])[offset:offset+len(buf)]
+      return
+    while len(buf):
+      read = os.preadv(self._buf[0].fileno(), [buf], offset)
+      assert read != 0, "unexpected end of file"
+      buf, offset = buf[read:], offset+read
   def readinto(self, buf):
-    self._buf[0].seek(self.offset)
-    self._buf[0].readinto(buf)
+    if self.st is None:
+      self._buf[0].seek(self.offset)
+      self._buf[0].readinto(buf)
+    elif hasattr(os, "preadv") and (runs:=contiguous_runs(self.st)) is not None and runs[1]*self.dtype.itemsize >= DISK_RUN:
+      offsets, sz, mv = runs[0], runs[1]*self.dtype.itemsize, memoryview(buf).cast("B")
+      for i,off in enumerate(offsets.tolist()): self.pread(mv[i*sz:(i+1)*sz], self.offset+off*self.dtype.itemsize)
+    else:
+      np.copyto(np.frombuffer(buf, self.dtype.np).reshape(self.shape), self._view_array())
+
+# the element offsets of the contiguous runs of a single view and their length
+def contiguous_runs(st:ShapeTracker) -> Optional[Tuple[np.ndarray, int]]:
+  if len(st.views) != 1: return None
+  shape, strides, run = list(st.views[0].shape), list(st.views[0].strides), 1
+  while shape and (shape[-1] == 1 or strides[-1] == run): run, _ = run*shape.pop(), strides.pop()
+  offsets: List[np.ndarray] = [np.arange(s).reshape((-1,)+(1,)*(len(shape)-i-1))*st for i,(s,st) in enumerate(zip(shape, strides))]
+  return (st.views[0].offset + sum(offsets, np.zeros((1,)*len(shape), dtype=np.int64))).reshape(-1), run
 
-disk_fxn_for_op: Dict[Op, Callable] = { UnaryOps.NOOP: lambda x: x, UnaryOps.CAST: RawDiskBuffer.cast, MovementOps.RESHAPE: RawDiskBuffer.reshape, MovementOps.SHRINK: RawDiskBuffer.shrink }
+disk_fxn_for_op: Dict[Op, Callable] = { UnaryOps.NOOP: lambda x: x, UnaryOps.CAST: RawDiskBuffer.cast, MovementOps.RESHAPE: RawDiskBuffer.reshape, MovementOps.SHRINK: RawDiskBuffer.shrink,
+                                       **{op:lambda x,arg,op=op: x.view(op, arg) for op in [MovementOps.PERMUTE, MovementOps.STRIDE, MovementOps.EXPAND]} }
 
-DiskBuffer = Interpreted(RawDiskBuffer, disk_fxn_for_op, to_underlying=lambda x:x, from_underlying=lambda x:x)
\ No newline at end of file
+DiskBuffer = Interpreted(RawDiskBuffer, disk_fxn_for_op, to_underlying=lambda x:x, from_underlying=lambda x:x)
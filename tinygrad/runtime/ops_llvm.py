@@ -21,7 +21,8 @@ class LLVM:
     llvm.initialize_native_asmparser()
     target = llvm.Target.from_triple(llvm.get_process_triple())
     LLVM.optimizer = llvm.create_module_pass_manager()
-    LLVM.target_machine = target.create_target_machine(opt=2)  # this opt actually can change things. ex: opt=3 means no FMA, opt=2 means FMA
+    # NOTE: without f16c, the half conversions are calls into compiler-rt that the jit can't find
+    LLVM.target_machine = target.create_target_machine(features="+f16c" if llvm.get_host_cpu_features().get("f16c") else "", opt=2)  # this opt actually can change things. ex: opt=3 means no FMA, opt=2 means FMA
     LLVM.target_machine.add_analysis_passes(LLVM.optimizer)
 
     # TODO: this makes compile times so much faster
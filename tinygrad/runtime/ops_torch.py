@@ -1,8 +1,9 @@
 import torch
 from typing import Dict, Callable, Optional
-from tinygrad.ops import UnaryOps, BinaryOps, MovementOps, TernaryOps, Op, Interpreted
+from tinygrad.ops import UnaryOps, BinaryOps, MovementOps, TernaryOps, LoadOps, Op, Interpreted
 from tinygrad.helpers import getenv, dtypes, prod, DType
-from tinygrad.runtime.ops_cpu import base_fxn_for_op, einsum_mulacc
+from tinygrad.runtime.ops_cpu import base_fxn_for_op, einsum_mulacc, expanded_cast, normalize_idx
+from tinygrad.shape.shapetracker import window_shape_strides
 from tinygrad.runtime.lib import RawBuffer
 
 device = torch.device("cuda:0" if torch.cuda.is_available() else ("mps" if getenv("MPS", 0) else "cpu"))
@@ -10,13 +11,15 @@ type_map = {torch.float16: dtypes.float16, torch.float32: dtypes.float32, torch.
 inverse_type_map = {v:k for k,v in type_map.items()}
 
 torch_fxn_for_op: Dict[Op, Callable] = {**base_fxn_for_op, **{
-  UnaryOps.NOOP: lambda x: x.contiguous(), UnaryOps.SQRT: lambda x: x.sqrt(), UnaryOps.EXP2: lambda x: x.exp2(), UnaryOps.LOG2: lambda x: x.log2(), UnaryOps.CAST: lambda x,y: x.type(next(k for k,v in type_map.items() if v==y)), UnaryOps.SIN: torch.sin,
-  BinaryOps.MAX: torch.maximum, BinaryOps.CMPEQ: lambda x,y: (x==y).type(torch.promote_types(x.dtype, y.dtype)),
+  UnaryOps.NOOP: lambda x: x.contiguous(), UnaryOps.SQRT: lambda x: x.sqrt(), UnaryOps.EXP2: lambda x: x.exp2(), UnaryOps.LOG2: lambda x: x.log2(), UnaryOps.CAST: expanded_cast(lambda x,y: x.type(next(k for k,v in type_map.items() if v==y)), lambda x: x.stride(), lambda x,s: x.expand(s)), UnaryOps.SIN: torch.sin,
+  BinaryOps.MAX: torch.maximum, BinaryOps.MOD: torch.fmod, BinaryOps.CMPEQ: lambda x,y: (x==y).type(torch.promote_types(x.dtype, y.dtype)),
   MovementOps.PAD: lambda x, padding: torch.nn.functional.pad(x, [item for sublist in padding[::-1] for item in sublist]),
-  TernaryOps.MULACC: einsum_mulacc(lambda s,a,b: torch.einsum(s, a.float(), b.float()).type(torch.promote_types(a.dtype, b.dtype)), lambda x: x.stride(), lambda x,s: x.expand(s)),
-  TernaryOps.WHERE: lambda x, y, z: torch.where(x != 0, y, z),
+  TernaryOps.MULACC: einsum_mulacc(lambda s,a,b: torch.einsum(s, *[x.float() if a.is_floating_point() or b.is_floating_point() else x.double() for x in (a, b)]).type(torch.promote_types(a.dtype, b.dtype)), lambda x: x.stride(), lambda x,s: x.expand(s)),
+  TernaryOps.WHERE: lambda x, y, z: torch.where(x != 0, y, z), LoadOps.GATHER: lambda w, idx, shape: w.reshape(-1, prod(shape)//idx.numel())[normalize_idx(idx.reshape(-1).long(), w.numel()*idx.numel()//prod(shape))].reshape(shape),
+  LoadOps.SCATTER: lambda x, idx, src, op: (x.reshape(-1, src.numel()//max(idx.numel(), 1)).index_add if op == BinaryOps.ADD else x.reshape(-1, src.numel()//max(idx.numel(), 1)).index_copy)(0, normalize_idx(idx.reshape(-1).long(), x.numel()*max(idx.numel(), 1)//max(src.numel(), 1)), src.reshape(idx.numel(), -1)).reshape(x.shape),
   MovementOps.STRIDE: lambda x, arg: x[tuple(slice(None, None, abs(i)) for i in arg)].flip([i for i,a in enumerate(arg) if a < 0]),
-  MovementOps.EXPAND: lambda x, arg: x.expand(arg), MovementOps.PERMUTE: lambda x, arg: x.permute(arg)
+  MovementOps.EXPAND: lambda x, arg: x.expand(arg), MovementOps.PERMUTE: lambda x, arg: x.permute(arg),
+  MovementOps.WINDOW: lambda x, arg: x.as_strided(*window_shape_strides(tuple(x.shape), x.stride(), arg), x.storage_offset()),
 }}
 
 class RawTorchBuffer(RawBuffer):
@@ -29,6 +29,7 @@ class WebGPUProgram:
 class WGSLCodegen(CStyleCodegen):
   lang = WGSLLanguage()
   supports_float4: bool = False
+  supports_int_reduce: bool = False
 
 class RawWebGPUBuffer(RawBufferCopyIn):
   def __init__(self, size:int, dtype:DType):
@@ -7,7 +7,7 @@ from tinygrad.helpers import prod, DEBUG
 from tinygrad.shape.symbolic import Variable, MulNode, NumNode, Node, SumNode
 
 # these ops live here
-class MovementOps(Enum): RESHAPE = auto(); PERMUTE = auto(); EXPAND = auto(); PAD = auto(); SHRINK = auto(); STRIDE = auto() # noqa: E702
+class MovementOps(Enum): RESHAPE = auto(); PERMUTE = auto(); EXPAND = auto(); PAD = auto(); SHRINK = auto(); STRIDE = auto(); WINDOW = auto() # noqa: E702
 
 @functools.lru_cache(maxsize=None)
 def to_shape_strides(shape:Tuple[int, ...], strides:Tuple[int, ...]) -> Tuple[Tuple[int, int], ...]:
@@ -160,19 +160,7 @@ class ShapeTracker:
   # NOTE: if a stride is not always valid, it will be None
   def real_strides(self, ignore_valid=False) -> Tuple[Optional[int], ...]:
     if len(self.views) == 1 and self.views[-1].mask is None: return self.views[-1].strides
-    idxs = [Variable(f"idx{i}", 0, s-1) for i,s in enumerate(self.shape)]
-    idx, valid = self.expr_idxs(idxs)
-    ret: List[Optional[int]] = [None] * len(self.views[-1].shape)
-    for this_dim in (idx.nodes if isinstance(idx, SumNode) else [idx]):
-      if isinstance(this_dim, MulNode) and isinstance(this_dim.a, Variable):
-        ret[idxs.index(this_dim.a)] = this_dim.b
-      elif isinstance(this_dim, Variable):
-        ret[idxs.index(this_dim)] = 1
-    idx_vars, valid_vars = idx.vars(), valid.vars()
-    for i,tidx in enumerate(idxs):
-      if tidx in valid_vars and not ignore_valid: ret[i] = None
-      elif tidx not in idx_vars: ret[i] = 0
-    return tuple(ret)
+    return _real_strides(tuple(self.views), ignore_valid)
   def unit_stride_axes(self, ignore_valid=False) -> List[int]: return [i for i,st in enumerate(self.real_strides(ignore_valid)) if st == 1]
 
   def _expr_idx(self, idx, valid):
@@ -182,55 +170,36 @@ class ShapeTracker:
     return idx, valid
 
   def simplify(self):
-    if len(self.views) >= 2:
-      new_view = merge_views(self.views[-2], self.views[-1])
-      if new_view:
-        if DEBUG >= 4: print(f"st simplify : {self.views[-2]} + {self.views[-1]} = {new_view}")
-        self.views = self.views[:-2] + [new_view]
-        self.simplify()
+    if len(self.views) >= 2: self.views = list(_simplify(tuple(self.views)))
 
   def expr_idxs(self, idxs=None):
     if idxs is None: idxs = [Variable(f"idx{i}", 0, s-1) for i,s in enumerate(self.shape)]
-    idx = self.views[-1].expr_idxs(tuple(idxs))
-    valid = self.views[-1].expr_node_mask(idxs_to_idx(self.views[-1].shape, tuple(idxs)))
-    return self._expr_idx(idx, valid)
+    return _expr_idxs(tuple(self.views), tuple(idxs))
 
   def expr_node(self, idx='idx'):
     if idx.__class__ is str: idx = Variable(idx, 0, prod(self.shape)-1)
-    return self._expr_idx(self.views[-1].expr_node(idx), self.views[-1].expr_node_mask(idx))
+    return _expr_node(tuple(self.views), idx)
 
   def needs_valid(self) -> bool:
     return any(v.mask is not None for v in self.views)
 
   # *** under this line are the movement ops ***
-
-  def __unsafe_resize(self, arg: Tuple[Tuple[int, int], ...], mask=None):
-    offset = get_unsafe_resize_offset(self.views[-1].strides, arg)
-    if self.views[-1].mask:
-      # move the old mask
-      nmask = tuple([(max(mx-ax, 0), min(my-ax, ay-ax)) for (mx,my),(ax,ay) in zip(self.views[-1].mask, arg)])
-      # merge the masks if we have two
-      mask = tuple([(max(mx1, mx2), min(my1, my2)) for (mx1, my1), (mx2, my2) in zip(nmask, mask)]) if mask is not None else nmask
-    self.views[-1] = View(tuple([y-x for x,y in arg]), self.views[-1].strides, self.views[-1].offset+offset, mask)
+  # NOTE: the views are immutable, so the new last view is memoized on the old one and the arg
 
   def pad(self, arg: Tuple[Tuple[int, int], ...]):
     assert all((b>=0 and e>=0) for b,e in arg) and len(arg) == len(self.shape)
     if any(b or e for b, e in arg):
       zvarg, mask = get_pad_args(self.shape, arg)
-      self.__unsafe_resize(zvarg, mask=mask)
+      self.views[-1] = _unsafe_resize(self.views[-1], zvarg, mask)
     return self
 
   def shrink(self, arg: Tuple[Tuple[int, int], ...]):
     assert all((b>=0 and e<=s) for s,(b,e) in zip(self.shape,arg)) and len(arg) == len(self.shape)
-    self.__unsafe_resize(arg)
+    self.views[-1] = _unsafe_resize(self.views[-1], arg)
     return self
 
   def expand(self, new_shape: Tuple[int, ...]) -> ShapeTracker:
-    assert len(new_shape) == len(self.views[-1].shape)
-    assert all(isinstance(x, int) and (s == x or (s == 1 and st == 0)) for s,x,st in zip(self.shape, new_shape, self.views[-1].strides)), f"can't expand {self.shape} into {new_shape}"
-    # NOTE: can the mask ever be (0,0)?
-    mask = tuple([(((0,0) if m != (0,1) else (0,ns)) if s != ns else m) for m,s,ns in zip(self.views[-1].mask, self.shape, new_shape)]) if self.views[-1].mask else None
-    self.views[-1] = View(new_shape, self.views[-1].strides, self.views[-1].offset, mask)
+    self.views[-1] = _expand(self.views[-1], new_shape)
     return self
 
   def reshape(self, new_shape: Tuple[int, ...]):
@@ -243,30 +212,117 @@ class ShapeTracker:
     return self
 
   def permute(self, axis: Tuple[int, ...]):
-    assert all(isinstance(x, int) and x >= 0 and x < len(self.shape) for x in axis), f"invalid permute {axis} for {self.shape}"
-    assert len(set(axis)) == len(axis) and len(axis) == len(self.shape), f"can't permute {self.shape} with {axis}"
-    self.views[-1] = View(tuple([self.views[-1].shape[a] for a in axis]), tuple([self.views[-1].strides[a] for a in axis]), self.views[-1].offset, tuple([self.views[-1].mask[a] for a in axis]) if self.views[-1].mask is not None else None)
+    self.views[-1] = _permute(self.views[-1], axis)
     return self
 
   # except for the negative case, you can build this from the others. invertible in the negative case
   def stride(self, mul: Tuple[int, ...]):
-    assert all(isinstance(x, int) and x != 0 for x in mul), f"invalid stride {mul} for {self.shape}"
-    strides = tuple([z*m for z,m in zip(self.views[-1].strides, mul)])
-    new_shape = tuple([(s+(abs(m)-1))//abs(m) for s,m in zip(self.views[-1].shape, mul)])
-    offset = sum([(s-1)*z for s,z,m in zip(self.views[-1].shape, self.views[-1].strides, mul) if m < 0])
-    mask = tuple([(((mx if m > 0 else s-my)+(abs(m)-1))//abs(m), ((my if m > 0 else s-mx)+(abs(m)-1))//abs(m)) for (mx,my),s,m in zip(self.views[-1].mask, self.views[-1].shape, mul)]) if self.views[-1].mask is not None else None
-    self.views[-1] = View(new_shape, strides, self.views[-1].offset + offset, mask)
+    self.views[-1] = _stride(self.views[-1], mul)
+    return self
+
+  # overlapping windows over the last len(arg) dims, arg is (kernel, stride, dilation) for each. (..., i) -> (..., o, k) where [o, k] is [o*stride + k*dilation]
+  def window(self, arg: Tuple[Tuple[int, int, int], ...]):
+    assert 0 < len(arg) <= len(self.shape) and all(isinstance(x, int) and x > 0 for a in arg for x in a), f"invalid window {arg} for {self.shape}"
+    assert all((k-1)*d < i for i,(k,_,d) in zip(self.shape[-len(arg):], arg)), f"window {arg} is bigger than {self.shape}"
+    new_view, extra = _window(self.views[-1], arg)
+    if extra: self.views.append(new_view)
+    else: self.views[-1] = new_view
     return self
 
   # *** entry point for external ***
 
-  def movement_op(self, op: MovementOps, arg:Union[Tuple[int, ...], Tuple[Tuple[int, int], ...]]) -> ShapeTracker:
-    assert isinstance(arg, tuple) and (len(arg) == len(self.shape) or op == MovementOps.RESHAPE), f"arg {arg} for {op} doesn't match dim of shape {self.shape}"
+  def movement_op(self, op: MovementOps, arg:Union[Tuple[int, ...], Tuple[Tuple[int, int], ...], Tuple[Tuple[int, int, int], ...]]) -> ShapeTracker:
+    assert isinstance(arg, tuple) and (len(arg) == len(self.shape) or op in {MovementOps.RESHAPE, MovementOps.WINDOW}), f"arg {arg} for {op} doesn't match dim of shape {self.shape}"
     dispatch[op](self, arg)
     return self
 
 dispatch: Dict[MovementOps, Callable] = {MovementOps.RESHAPE: ShapeTracker.reshape, MovementOps.EXPAND: ShapeTracker.expand, MovementOps.PAD: ShapeTracker.pad,
-                                         MovementOps.SHRINK: ShapeTracker.shrink, MovementOps.PERMUTE: ShapeTracker.permute, MovementOps.STRIDE: ShapeTracker.stride}
+                                         MovementOps.SHRINK: ShapeTracker.shrink, MovementOps.PERMUTE: ShapeTracker.permute, MovementOps.STRIDE: ShapeTracker.stride,
+                                         MovementOps.WINDOW: ShapeTracker.window}
+
+# *** memoized on the (immutable) views, the linearizer asks for the same things many times ***
+
+@functools.lru_cache(maxsize=None)
+def _real_strides(views:Tuple[View, ...], ignore_valid:bool) -> Tuple[Optional[int], ...]:
+  idxs = [Variable(f"idx{i}", 0, s-1) for i,s in enumerate(views[-1].shape)]
+  idx, valid = _expr_idxs(views, tuple(idxs))
+  ret: List[Optional[int]] = [None] * len(views[-1].shape)
+  for this_dim in (idx.nodes if isinstance(idx, SumNode) else [idx]):
+    if isinstance(this_dim, MulNode) and isinstance(this_dim.a, Variable):
+      ret[idxs.index(this_dim.a)] = this_dim.b
+    elif isinstance(this_dim, Variable):
+      ret[idxs.index(this_dim)] = 1
+  idx_vars, valid_vars = idx.vars(), valid.vars()
+  for i,tidx in enumerate(idxs):
+    if tidx in valid_vars and not ignore_valid: ret[i] = None
+    elif tidx not in idx_vars: ret[i] = 0
+  return tuple(ret)
+
+@functools.lru_cache(maxsize=None)
+def _simplify(views:Tuple[View, ...]) -> Tuple[View, ...]:
+  while len(views) >= 2 and (new_view := merge_views(views[-2], views[-1])) is not None:
+    if DEBUG >= 4: print(f"st simplify : {views[-2]} + {views[-1]} = {new_view}")
+    views = views[:-2] + (new_view,)
+  return views
+
+@functools.lru_cache(maxsize=None)
+def _expr_idxs(views:Tuple[View, ...], idxs:Tuple[Node, ...]) -> Tuple[Node, Node]:
+  idx = views[-1].expr_idxs(idxs)
+  valid = views[-1].expr_node_mask(idxs_to_idx(views[-1].shape, idxs))
+  return ShapeTracker(views[-1].shape, list(views))._expr_idx(idx, valid)
+
+@functools.lru_cache(maxsize=None)
+def _expr_node(views:Tuple[View, ...], idx:Node) -> Tuple[Node, Node]:
+  return ShapeTracker(views[-1].shape, list(views))._expr_idx(views[-1].expr_node(idx), views[-1].expr_node_mask(idx))
+
+@functools.lru_cache(maxsize=None)
+def _unsafe_resize(view:View, arg:Tuple[Tuple[int, int], ...], mask=None) -> View:
+  offset = get_unsafe_resize_offset(view.strides, arg)
+  if view.mask:
+    # move the old mask
+    nmask = tuple([(max(mx-ax, 0), min(my-ax, ay-ax)) for (mx,my),(ax,ay) in zip(view.mask, arg)])
+    # merge the masks if we have two
+    mask = tuple([(max(mx1, mx2), min(my1, my2)) for (mx1, my1), (mx2, my2) in zip(nmask, mask)]) if mask is not None else nmask
+  return View(tuple([y-x for x,y in arg]), view.strides, view.offset+offset, mask)
+
+@functools.lru_cache(maxsize=None)
+def _expand(view:View, new_shape:Tuple[int, ...]) -> View:
+  assert len(new_shape) == len(view.shape)
+  assert all(isinstance(x, int) and (s == x or (s == 1 and st == 0)) for s,x,st in zip(view.shape, new_shape, view.strides)), f"can't expand {view.shape} into {new_shape}"
+  # NOTE: can the mask ever be (0,0)?
+  mask = tuple([(((0,0) if m != (0,1) else (0,ns)) if s != ns else m) for m,s,ns in zip(view.mask, view.shape, new_shape)]) if view.mask else None
+  return View(new_shape, view.strides, view.offset, mask)
+
+@functools.lru_cache(maxsize=None)
+def _permute(view:View, axis:Tuple[int, ...]) -> View:
+  assert all(isinstance(x, int) and x >= 0 and x < len(view.shape) for x in axis), f"invalid permute {axis} for {view.shape}"
+  assert len(set(axis)) == len(axis) and len(axis) == len(view.shape), f"can't permute {view.shape} with {axis}"
+  return View(tuple([view.shape[a] for a in axis]), tuple([view.strides[a] for a in axis]), view.offset, tuple([view.mask[a] for a in axis]) if view.mask is not None else None)
+
+@functools.lru_cache(maxsize=None)
+def _stride(view:View, mul:Tuple[int, ...]) -> View:
+  assert all(isinstance(x, int) and x != 0 for x in mul), f"invalid stride {mul} for {view.shape}"
+  strides = tuple([z*m for z,m in zip(view.strides, mul)])
+  new_shape = tuple([(s+(abs(m)-1))//abs(m) for s,m in zip(view.shape, mul)])
+  offset = sum([(s-1)*z for s,z,m in zip(view.shape, view.strides, mul) if m < 0])
+  mask = tuple([(((mx if m > 0 else s-my)+(abs(m)-1))//abs(m), ((my if m > 0 else s-mx)+(abs(m)-1))//abs(m)) for (mx,my),s,m in zip(view.mask, view.shape, mul)]) if view.mask is not None else None
+  return View(new_shape, strides, view.offset + offset, mask)
+
+@functools.lru_cache(maxsize=None)
+def window_shape_strides(shape:Tuple[int, ...], strides:Tuple[int, ...], arg:Tuple[Tuple[int, int, int], ...]) -> Tuple[Tuple[int, ...], Tuple[int, ...]]:
+  n = len(shape) - len(arg)
+  o_ = tuple([(i-d*(k-1)-1)//s + 1 for i,(k,s,d) in zip(shape[n:], arg)])
+  return shape[:n] + o_ + tuple([k for k,_,_ in arg]), strides[:n] + tuple([st*s for st,(_,s,_) in zip(strides[n:], arg)]) + tuple([st*d for st,(_,_,d) in zip(strides[n:], arg)])
+
+@functools.lru_cache(maxsize=None)
+def _window(view:View, arg:Tuple[Tuple[int, int, int], ...]) -> Tuple[View, bool]:
+  n = len(view.shape) - len(arg)
+  if view.mask is None or all(m == (0,s) for m,s in zip(view.mask[n:], view.shape[n:])):
+    new_shape, new_strides = window_shape_strides(view.shape, view.strides, arg)
+    return View(new_shape, new_strides, view.offset, view.mask[:n] + tuple([(0,s) for s in new_shape[n:]]) if view.mask is not None else None), False
+  # a window of a masked dimension isn't a box anymore, so it's a new view over the masked one
+  new_shape, new_strides = window_shape_strides(view.shape, strides_for_shape(view.shape), arg)
+  return View(new_shape, new_strides), True
 
 # returns the axes to create new_shape if new_shape can be created by combining axis from old_shape
 def get_contraction(old_shape:Tuple[int, ...], new_shape:Tuple[int, ...]) -> Optional[List[List[int]]]:
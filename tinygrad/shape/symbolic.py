@@ -19,6 +19,8 @@ class Node:
     if strip_parens and ret[0] == '(' and ret[-1] == ')': ret = ret[1:-1]
     return ret
   def vars(self): return []
+  # rebuild the node with some variables replaced, this resimplifies with the new bounds
+  def substitute(self, var_vals:Dict[Variable, Node]) -> Node: raise RuntimeError(self.__class__.__name__)
   @functools.cached_property
   def key(self) -> str: return self.render(ctx="DEBUG")
   @functools.cached_property
@@ -128,10 +130,12 @@ class Variable(Node):
   def __init__(self, expr:Optional[str], nmin:int, nmax:int):
     self.expr, self.min, self.max = expr, nmin, nmax
   def vars(self): return [self]
+  def substitute(self, var_vals:Dict[Variable, Node]) -> Node: return var_vals[self] if self in var_vals else self
 
 class NumNode(Node):
   def __init__(self, num:int):
     self.b, self.min, self.max = num, num, num
+  def substitute(self, var_vals:Dict[Variable, Node]) -> Node: return self
 
 def create_node(ret:Node):
   assert ret.min <= ret.max, f"min greater than max! {ret.min} {ret.max} when creating {type(ret)} {ret}"
@@ -150,6 +154,7 @@ class LtNode(OpNode):
   def __mul__(self, b: int): return (self.a*b) < (self.b*b)
   def __floordiv__(self, b: int, _=False): return (self.a//b) < (self.b//b)
   def get_bounds(self) -> Tuple[int, int]: return int(self.a.max < self.b), int(self.a.min < self.b)
+  def substitute(self, var_vals:Dict[Variable, Node]) -> Node: return self.a.substitute(var_vals) < self.b
 
 class MulNode(OpNode):
   def __mul__(self, b: int): return self.a*(self.b*b) # two muls in one mul
@@ -162,12 +167,14 @@ class MulNode(OpNode):
     return Node.__mod__(a, b)
   def get_bounds(self) -> Tuple[int, int]:
     return (self.a.min*self.b, self.a.max*self.b) if self.b >= 0 else (self.a.max*self.b, self.a.min*self.b)
+  def substitute(self, var_vals:Dict[Variable, Node]) -> Node: return self.a.substitute(var_vals) * self.b
 
 class DivNode(OpNode):
   def __floordiv__(self, b: int, _=False): return self.a//(self.b*b) # two divs is one div
   def get_bounds(self) -> Tuple[int, int]:
     assert self.a.min >= 0
     return self.a.min//self.b, self.a.max//self.b
+  def substitute(self, var_vals:Dict[Variable, Node]) -> Node: return self.a.substitute(var_vals) // self.b
 
 class ModNode(OpNode):
   def __floordiv__(self, b: int, factoring_allowed=True):
@@ -176,6 +183,7 @@ class ModNode(OpNode):
   def get_bounds(self) -> Tuple[int, int]:
     assert self.a.min >= 0
     return (0, self.b-1) if self.a.max - self.a.min >= self.b or (self.a.min != self.a.max and self.a.min%self.b >= self.a.max%self.b) else (self.a.min%self.b, self.a.max%self.b)
+  def substitute(self, var_vals:Dict[Variable, Node]) -> Node: return self.a.substitute(var_vals) % self.b
 
 class RedNode(Node):
   def __init__(self, nodes:List[Node]): self.nodes = nodes
@@ -212,6 +220,8 @@ class SumNode(RedNode):
       else: new_nodes.append(x)
     return Node.__mod__(Node.sum(new_nodes), b)
 
+  def substitute(self, var_vals:Dict[Variable, Node]) -> Node: return Node.sum([x.substitute(var_vals) for x in self.nodes])
+
   @property
   def flat_components(self): # recursively expand sumnode components
     new_nodes = []
@@ -221,6 +231,7 @@ class SumNode(RedNode):
 class AndNode(RedNode):
   def __mul__(self, b: int): Variable.ands([x*b for x in self.nodes])
   def __floordiv__(self, b: int, _=True): return Variable.ands([x//b for x in self.nodes])
+  def substitute(self, var_vals:Dict[Variable, Node]) -> Node: return Node.ands([x.substitute(var_vals) for x in self.nodes])
 
 def create_rednode(typ:Type[RedNode], nodes:List[Node]):
   ret = typ(nodes)
@@ -1,45 +1,159 @@
-import os, json, pathlib, zipfile, pickle
+import os, json, pathlib, zipfile, pickle, struct, itertools, mmap, threading
+from concurrent.futures import ThreadPoolExecutor, Future
+import numpy as np
 from tqdm import tqdm
-from typing import Dict, Union, List
+from typing import Dict, Union, List, Optional, Tuple, Any, Iterator, Type, TypeVar, cast, overload
 from tinygrad.tensor import Tensor
-from tinygrad.helpers import dtypes, prod, argsort, DEBUG, Timing, GlobalCounters
+from tinygrad.lazy import Device, LazyBuffer, DISK_ZEROCOPY, _disk_move_to_device
+from tinygrad.ops import MovementOps, LoadOps
+from tinygrad.runtime.lib import RawBuffer, RawMallocBuffer, RawBufferMapped
+from tinygrad.runtime.ops_disk import RawDiskBuffer
+from tinygrad.runtime.ops_cpu import RawNumpyBuffer, numpy_fxn_for_op
+from tinygrad.helpers import dtypes, prod, argsort, dedup, DEBUG, Timing, GlobalCounters, getenv
 from tinygrad.shape.shapetracker import strides_for_shape
 
-safe_dtypes = {"F16": dtypes.float16, "F32": dtypes.float32, "U8": dtypes.uint8, "I8": dtypes.int8, "I32": dtypes.int32, "I64": dtypes.int64}
+safe_dtypes = {"F16": dtypes.float16, "BF16": dtypes.bfloat16, "F32": dtypes.float32, "U8": dtypes.uint8, "I8": dtypes.int8, "I32": dtypes.int32, "I64": dtypes.int64}
 inverse_safe_dtypes = {v:k for k,v in safe_dtypes.items()}
+SAVE_THREADS, SAVE_CHUNK, SHARD_SIZE = getenv("SAVE_THREADS", 8), getenv("SAVE_CHUNK", 1<<26), getenv("SHARD_SIZE", 5<<30)
 
-def safe_load(fn:Union[Tensor,str]) -> Dict[str, Tensor]:
+def safe_load_metadata(fn:Union[Tensor,str]) -> Tuple[Tensor, int, Any]:
   t = fn if isinstance(fn, Tensor) else Tensor.empty(os.stat(fn).st_size, dtype=dtypes.uint8, device=f"disk:{fn}")
   json_len = t[0:1].cast(dtypes.int64).numpy()[0]
-  metadata = json.loads(t[8:8+json_len].numpy().tobytes())
+  return t, json_len, json.loads(t[8:8+json_len].numpy().tobytes())
+
+def safe_load(fn:Union[Tensor,str]) -> Dict[str, Tensor]:
+  t, json_len, metadata = safe_load_metadata(fn)
   return {k:t[8+json_len+v['data_offsets'][0]:].cast(safe_dtypes[v['dtype']])[:prod(v['shape'])].reshape(v['shape']) for k,v in metadata.items() if k != "__metadata__"}
 
-def safe_save(tensors:Dict[str, Tensor], fn:str):
-  metadata, offset = {}, 0
+# NOTE: windows has no pwrite, there the writers take turns to seek and write
+_seek_lock = threading.Lock()
+def _pwrite(fd:int, data:memoryview, offset:int):
+  if not hasattr(os, "pwrite"):
+    with _seek_lock:
+      os.lseek(fd, offset, os.SEEK_SET)
+      while len(data): data = data[os.write(fd, data):]
+    return
+  while len(data):
+    written = os.pwrite(fd, data, offset)
+    data, offset = data[written:], offset+written
+
+# the header is written first and the tensors are streamed to their offsets by a thread pool, with background=True it returns a Future to wait on
+def _safe_header(tensors:Dict[str, Tensor], metadata:Optional[Dict[str, str]]=None) -> Tuple[str, Dict[str, Any], int]:
+  headers: Dict[str, Any] = {}
+  offset = 0
+  if metadata: headers['__metadata__'] = metadata
   for k,v in tensors.items():
-    metadata[k] = {'dtype': inverse_safe_dtypes[v.dtype], 'shape': list(v.shape), 'data_offsets':[offset, offset+v.nbytes()]}
+    headers[k] = {'dtype': inverse_safe_dtypes[v.dtype], 'shape': list(v.shape), 'data_offsets':[offset, offset+v.nbytes()]}
     offset += v.nbytes()
-  j = json.dumps(metadata, separators=(',', ':'))
-  j += "\x20"*((8-len(j)%8)%8)
+  j = json.dumps(headers, separators=(',', ':'))
+  return j + "\x20"*((8-len(j)%8)%8), headers, offset
+
+# the host copy of a buffer that can't change under a background write, the host memory devices and DISK give a view of the buffer
+def _snapshot(buf:RawBuffer) -> np.ndarray:
+  x = buf.toCPU()
+  return x.copy() if x.base is not None or x is getattr(buf, "_buf", None) else x
+
+def safe_save(tensors:Dict[str, Tensor], fn:str, metadata:Optional[Dict[str, str]]=None, background=False) -> Optional[Future]:
+  j, headers, offset = _safe_header(tensors, metadata)
+  # NOTE: the kernels run here and the tensors are copied to the host as they are written, only SAVE_THREADS of them are on the host at once.
+  # in the background the tensors can change while they are written, the ones that would be read in place are copied first. toCPU is the storage, bfloat16 is the bits
+  bufs: List[Union[RawBuffer, np.ndarray]] = [v.lazydata.storage() for v in tensors.values()]
+  if background: bufs = [_snapshot(cast(RawBuffer, x)) for x in bufs]
   pathlib.Path(fn).unlink(missing_ok=True)
-  t = Tensor.empty(8+len(j)+offset, dtype=dtypes.uint8, device=f"disk:{fn}")
-  t[0:1].cast(dtypes.int64).assign([len(j)])
-  t[8:8+len(j)].assign(Tensor(list(j.encode('utf-8')), dtype=dtypes.uint8, device="cpu"))
-  for k,v in safe_load(t).items(): v.assign(tensors[k])
+  def write():
+    fd = os.open(fn, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0), 0o644)
+    try:
+      os.ftruncate(fd, 8+len(j)+offset)
+      _pwrite(fd, memoryview(struct.pack("<Q", len(j)) + j.encode('utf-8')), 0)
+      with ThreadPoolExecutor(SAVE_THREADS) as pool:
+        writing: List[List[Future]] = []
+        for k,x in zip(tensors.keys(), bufs):
+          # NOTE: the copy to the host is on this thread, not all the device runtimes can be used from the writers
+          if len(writing) == SAVE_THREADS:
+            for f in writing.pop(0): f.result()
+          data = (x if isinstance(x, np.ndarray) else x.toCPU()).reshape(-1).data.cast("B")
+          writing.append([pool.submit(_pwrite, fd, data[i:i+SAVE_CHUNK], 8+len(j)+headers[k]['data_offsets'][0]+i) for i in range(0, len(data), SAVE_CHUNK)])
+        for f in itertools.chain(*writing): f.result()
+      os.fsync(fd)
+    finally: os.close(fd)
+  if not background: return write()
+  pool = ThreadPoolExecutor(1)
+  ret = pool.submit(write)
+  pool.shutdown(wait=False)
+  return ret
+
+# sharded safetensors: the shards are safetensors files next to an index that maps each tensor to its file and byte range in it.
+# with parts > 1 there's a shard per part, and each tensor in splits is cut along its axis with part i in shard i, like for tensor parallelism
+def safe_save_sharded(tensors:Dict[str, Tensor], fn:str, max_shard_size=SHARD_SIZE, splits:Optional[Dict[str, int]]=None, parts=1, metadata:Optional[Dict[str, str]]=None):
+  splits = {k:v for k,v in (splits or {}).items() if k in tensors and v is not None} if parts > 1 else {}
+  shards: List[Dict[str, Tensor]] = [{} for _ in range(parts)]
+  for k,v in tensors.items():
+    if k in splits:
+      for shard,x in zip(shards, v.chunk(parts, splits[k])): shard[k] = x
+    elif parts > 1: min(shards, key=lambda x: sum(t.nbytes() for t in x.values()))[k] = v
+    else:
+      if shards[-1] and sum(t.nbytes() for t in shards[-1].values()) + v.nbytes() > max_shard_size: shards.append({})
+      shards[-1][k] = v
+  base = fn[:-len(".index.json")] if fn.endswith(".index.json") else fn
+  base = base[:-len(".safetensors")] if base.endswith(".safetensors") else base
+  names = [f"{pathlib.Path(base).name}-{i+1:05d}-of-{len(shards):05d}.safetensors" for i in range(len(shards))]
+  index: Dict[str, Any] = {"metadata": {**(metadata or {}), "total_size": str(sum(v.nbytes() for v in tensors.values()))}, "weight_map": {}, "tensors": {}}
+  for name,shard in zip(names, shards):
+    j, headers, _ = _safe_header(shard)
+    for k in shard:
+      index["weight_map"].setdefault(k, name)
+      index["tensors"].setdefault(k, {"dtype": inverse_safe_dtypes[tensors[k].dtype], "shape": list(tensors[k].shape), "axis": splits.get(k), "parts": []})
+      index["tensors"][k]["parts"].append([name, *[8+len(j)+x for x in headers[k]["data_offsets"]]])
+  # NOTE: the shards are written one after the other, the writers of a shard already keep the disk busy and the host copies stay bounded
+  for name,shard in zip(names, shards): safe_save(shard, str(pathlib.Path(base).parent / name))
+  pathlib.Path(fn).write_text(json.dumps(index, indent=2))
+
+# loads the tensors in keys from a sharded safetensors index, only the files they are in are opened. the parts of a split tensor are concatenated on device,
+# and with a world_size, rank gets its slice of them along the axis of the split. the index of a huggingface checkpoint without byte ranges works too
+def safe_load_sharded(fn:str, keys:Optional[List[str]]=None, rank=0, world_size=1, device:Optional[str]=None) -> Dict[str, Tensor]:
+  index, root, files = json.loads(pathlib.Path(fn).read_text()), pathlib.Path(fn).parent, {}
+  def disk(name:str) -> Tensor:
+    if name not in files: files[name] = Tensor.empty(os.stat(root/name).st_size, dtype=dtypes.uint8, device=f"disk:{root/name}")
+    return files[name]
+  if "tensors" not in index:
+    loaded = {name:safe_load(disk(name)) for name in dedup([index["weight_map"][k] for k in (keys or index["weight_map"].keys())])}
+    return {k:loaded[index["weight_map"][k]][k] for k in (keys or index["weight_map"].keys())}
+  ret = {}
+  for k in (keys or index["tensors"].keys()):
+    meta = index["tensors"][k]
+    dtype, shape, axis = safe_dtypes[meta["dtype"]], meta["shape"], meta["axis"]
+    # each part is read from its byte range, it's the full shape but for its share of the axis
+    rest = prod(shape)//shape[axis] if axis is not None else prod(shape)
+    parts = [(f, st, (en-st)//dtype.itemsize) for f,st,en in meta["parts"]]
+    pieces = [disk(f)[st:].cast(dtype)[:n].reshape(shape[:axis]+[n//rest]+shape[axis+1:] if axis is not None else shape) for f,st,n in parts]
+    if axis is None:
+      ret[k] = pieces[0]
+      continue
+    lo, hi, off, sliced = shape[axis]*rank//world_size, shape[axis]*(rank+1)//world_size, 0, []
+    for p in pieces:
+      if off < hi and off+p.shape[axis] > lo: sliced.append(p.shrink(tuple((max(lo-off, 0), min(hi-off, p.shape[axis])) if i == axis else (0, s) for i,s in enumerate(p.shape))))
+      off += p.shape[axis]
+    ret[k] = sliced[0] if len(sliced) == 1 else disk_cat(sliced, axis, device or Device.DEFAULT)
+  return ret
 
 # state dict
 
 from collections import OrderedDict
-def get_state_dict(obj, prefix:str='', tensor_type=Tensor) -> Dict[str, Tensor]:
+T = TypeVar("T")
+@overload
+def get_state_dict(obj, prefix:str='') -> Dict[str, Tensor]: ...
+@overload
+def get_state_dict(obj, prefix:str='', *, tensor_type:Type[T]) -> Dict[str, T]: ...
+def get_state_dict(obj, prefix:str='', tensor_type:Any=Tensor) -> Dict[str, Any]:
   if isinstance(obj, tensor_type): return {prefix.strip('.'):obj}
-  if hasattr(obj, '_asdict'): return get_state_dict(obj._asdict(), prefix, tensor_type)  # namedtuple
-  if isinstance(obj, OrderedDict): return get_state_dict(dict(obj), prefix, tensor_type)
-  if hasattr(obj, '__dict__'): return get_state_dict(obj.__dict__, prefix, tensor_type)
+  if hasattr(obj, '_asdict'): return get_state_dict(obj._asdict(), prefix, tensor_type=tensor_type)  # namedtuple
+  if isinstance(obj, OrderedDict): return get_state_dict(dict(obj), prefix, tensor_type=tensor_type)
+  if hasattr(obj, '__dict__'): return get_state_dict(obj.__dict__, prefix, tensor_type=tensor_type)
   state_dict = {}
   if isinstance(obj, (list, tuple)):
-    for i,x in enumerate(obj): state_dict.update(get_state_dict(x, f"{prefix}{str(i)}.", tensor_type))
+    for i,x in enumerate(obj): state_dict.update(get_state_dict(x, f"{prefix}{str(i)}.", tensor_type=tensor_type))
   elif isinstance(obj, dict):
-    for k,v in obj.items(): state_dict.update(get_state_dict(v, f"{prefix}{str(k)}.", tensor_type))
+    for k,v in obj.items(): state_dict.update(get_state_dict(v, f"{prefix}{str(k)}.", tensor_type=tensor_type))
   return state_dict
 def get_parameters(obj) -> List[Tensor]: return list(get_state_dict(obj).values())
 
@@ -47,15 +161,92 @@ def load_state_dict(model, state_dict, strict=True):
   with Timing("loaded weights in ", lambda et_ns: f", {GlobalCounters.mem_used/1e9:.2f} GB loaded at {GlobalCounters.mem_used/et_ns:.2f} GB/s"):
     model_state_dict = get_state_dict(model)
     if DEBUG >= 1 and len(state_dict) > len(model_state_dict): print("WARNING: unused weights in state_dict", sorted(list(state_dict.keys() - model_state_dict.keys())))
-    for k,v in (t := tqdm(model_state_dict.items())):
+    if DEBUG >= 1 and not strict:
+      for k in model_state_dict.keys() - state_dict.keys(): print(f"WARNING: not loading {k}")
+    # with PREFETCH=1 the weights are read from disk by the prefetcher while the previous ones are assigned
+    weights = {k:state_dict[k].to(v.device) for k,v in model_state_dict.items() if strict or k in state_dict}
+    for k,w in (t := tqdm(disk_prefetch(weights) if PREFETCH else weights.items(), total=len(weights))):
       t.set_description(f"ram used: {GlobalCounters.mem_used/1e9:5.2f} GB, {k:50s}")
-      if k not in state_dict and not strict:
-        if DEBUG >= 1: print(f"WARNING: not loading {k}")
-        continue
-      v.assign(state_dict[k].to(v.device)).realize()
+      model_state_dict[k].assign(w).realize()
+
+# *** async disk reads ***
+
+PREFETCH, PREFETCH_DEPTH, PREFETCH_THREADS, PREFETCH_CHUNK, DISK_DIRECT = getenv("PREFETCH"), getenv("PREFETCH_DEPTH", 16), getenv("PREFETCH_THREADS", 4), getenv("PREFETCH_CHUNK", 1<<24), getenv("DISK_DIRECT")
+DIRECT_ALIGN = 4096
+
+# fill buf from offset in the file, with O_DIRECT it bypasses the page cache through an aligned bounce buffer
+def _pread(src:RawDiskBuffer, buf:memoryview, offset:int, direct=False):
+  if not direct or not hasattr(os, "preadv"): return src.pread(buf, offset)
+  st, en = offset - offset % DIRECT_ALIGN, -(-(offset+len(buf))//DIRECT_ALIGN)*DIRECT_ALIGN
+  try: fd = os.open(src._buf[0].name, os.O_RDONLY | getattr(os, "O_DIRECT", 0))
+  except OSError: return src.pread(buf, offset)  # the filesystem doesn't do O_DIRECT
+  # NOTE: anonymous maps are page aligned, the reads are whole blocks and the last one stops at the end of the file
+  bounce = memoryview(mmap.mmap(-1, en-st))
+  try:
+    got = 0
+    while st+got < offset+len(buf): got += _check_read(os.preadv(fd, [bounce[got:]], st+got))
+    buf[:] = bounce[offset-st:offset-st+len(buf)]
+  finally: os.close(fd)
+
+def _check_read(read:int) -> int:
+  assert read != 0, "unexpected end of file"
+  return read
+
+# the copy from DISK of a device tensor, under the movement ops that are done on the device
+def _disk_load(x:LazyBuffer) -> Optional[LazyBuffer]:
+  while not x.realized and x.optype is MovementOps: x = cast(LazyBuffer, x.op.src[0])
+  return x if not x.realized and x.op.op == LoadOps.FROM and cast(LazyBuffer, x.op.src[0]).device.startswith("DISK") else None
+
+# yields the tensors in order, the reads from DISK for the next ones are queued on a thread pool while the caller uses the current one
+def disk_prefetch(tensors:Dict[str, Tensor], depth=PREFETCH_DEPTH, threads=PREFETCH_THREADS, direct=DISK_DIRECT) -> Iterator[Tuple[str, Tensor]]:
+  def start(t:Tensor) -> Optional[Tuple[LazyBuffer, Any, List[Future]]]:
+    # NOTE: CPU already uses the mmap of the file without a copy
+    if (x:=_disk_load(t.lazydata)) is None or DISK_ZEROCOPY or Device[x.device].buffer is RawNumpyBuffer: return None
+    src = cast(RawDiskBuffer, cast(LazyBuffer, x.op.src[0]).realize().realized)
+    # host memory devices are read into directly, the others through numpy
+    mapped = issubclass(Device[x.device].buffer, RawBufferMapped)
+    dst = Device[x.device].buffer(prod(x.shape), x.dtype, **x._device_extra_args()) if mapped else np.empty(prod(x.shape), x.dtype.np)
+    mv = (cast(RawBufferMapped, dst)._buffer() if mapped else cast(np.ndarray, dst).data).cast("B")
+    if src.st is not None: return x, dst, [pool.submit(src.readinto, mv)]
+    return x, dst, [pool.submit(_pread, src, mv[i:i+PREFETCH_CHUNK], src.offset+i, direct) for i in range(0, len(mv), PREFETCH_CHUNK)]
+  with ThreadPoolExecutor(threads) as pool:
+    queue = [(k, t, start(t)) for k,t in itertools.islice(tensors.items(), depth)]
+    for k,t in itertools.islice(tensors.items(), depth, None):
+      yield _finish(*queue.pop(0))
+      queue.append((k, t, start(t)))
+    for q in queue: yield _finish(*q)
+
+def _finish(k:str, t:Tensor, load:Optional[Tuple[LazyBuffer, Any, List[Future]]]) -> Tuple[str, Tensor]:
+  if load is not None:
+    x, dst, reads = load
+    for r in reads: r.result()
+    x.realized = dst if isinstance(dst, RawBuffer) else Device[x.device].buffer.fromCPU(dst.reshape(x.shape), **x._device_extra_args())
+  return k, t
+
+# the numpy view of a DISK tensor, the movement ops that don't read less from DISK are done by numpy without a copy
+def _disk_numpy(x:LazyBuffer) -> np.ndarray:
+  if _disk_move_to_device(x): return numpy_fxn_for_op[x.op.op](_disk_numpy(cast(LazyBuffer, x.op.src[0])), x.op.arg)
+  return cast(RawBuffer, x.realize().realized).toCPU().reshape(x.shape)
+
+# concatenate DISK tensors (like the shards of a checkpoint) on a host memory device, they are read in parallel straight into the preallocated output
+def disk_cat(tensors:List[Tensor], dim:int, device:str) -> Tensor:
+  if Device[device].buffer not in (RawMallocBuffer, RawNumpyBuffer) or tensors[0].dtype.np is None: return tensors[0].to(device).cat(*[t.to(device) for t in tensors[1:]], dim=dim)
+  dim = dim + len(tensors[0].shape) if dim < 0 else dim
+  ret = Tensor.empty(*tensors[0].shape[:dim], sum(t.shape[dim] for t in tensors), *tensors[0].shape[dim+1:], dtype=tensors[0].dtype, device=device).realize()
+  dst, offsets = cast(RawBuffer, ret.lazydata.realized).toCPU().reshape(ret.shape), list(itertools.accumulate([0]+[t.shape[dim] for t in tensors]))
+  with ThreadPoolExecutor(len(tensors)) as pool:
+    for f in [pool.submit(np.copyto, *x) for t,st,en in zip(tensors, offsets, offsets[1:]) for x in _tiles(dst[(slice(None),)*dim + (slice(st, en),)], _disk_numpy(t.lazydata))]: f.result()
+  return ret
+
+# a permuted source is copied in tiles of the last two dims, a strided walk over the whole thing misses the cache and TLB on every read
+def _tiles(dst:np.ndarray, src:np.ndarray, tile=128) -> List[Tuple[np.ndarray, np.ndarray]]:
+  if src.ndim < 2 or src.flags.c_contiguous: return [(dst, src)]
+  return [(dst[..., r:r+tile, c:c+tile], src[..., r:r+tile, c:c+tile]) for r in range(0, src.shape[-2], tile) for c in range(0, src.shape[-1], tile)]
 
 # torch support!
 
+# NOTE: nothing is read here, the tensors are lazy views of the file. the storages are read concurrently by load_state_dict with PREFETCH=1 (see disk_prefetch)
+# and by disk_cat for the shards of a checkpoint, else one at a time when each tensor is realized
 def torch_load(fn:str):
   t = Tensor.empty(os.stat(fn).st_size, dtype=dtypes.uint8, device=f"disk:{fn}")
 
@@ -68,19 +259,18 @@ def torch_load(fn:str):
     byte_offset = offsets[storage[2]]+storage_offset*storage[1].itemsize
     ret = t[byte_offset:byte_offset+prod(size)].cast(storage[1])
 
-    # 7 lines to deal with permuted tensors. NOTE: this currently requires reading off the disk
+    # permuted tensors. NOTE: the permute is done on the device the tensor is moved to
     shape_strides = [(s, st) for s,st in zip(size, stride) if s != 1]
     permute_indexes = [len(shape_strides)-1-y for y in argsort([x[1] for x in shape_strides])]
     if tuple(permute_indexes) != tuple(range(len(permute_indexes))):
       intermediate_shape = tuple([shape_strides[x][0] for x in argsort(permute_indexes)])
       assert tuple([shape_strides[i][1] for i in argsort(permute_indexes)]) == strides_for_shape(intermediate_shape), "nonpermutable strides"
-      if DEBUG >= 2: print(f"WARNING: this torch load is slow. CPU to permute {intermediate_shape} with {permute_indexes}")
-      # TODO: find a nice way to support all shapetracker on disktensors
-      ret = ret.cpu().reshape(intermediate_shape).permute(permute_indexes)
+      # NOTE: realizing the DISK cast doesn't read anything, it keeps the permute from being shuffled under it
+      ret = ret.realize().reshape(intermediate_shape).permute(permute_indexes)
 
     return ret.reshape(size)
 
-  intercept = {"HalfStorage": dtypes.float16, "FloatStorage": dtypes.float32, "IntStorage": dtypes.int32, "LongStorage": dtypes.int64, "_rebuild_tensor_v2": _rebuild_tensor_v2}
+  intercept = {"HalfStorage": dtypes.float16, "BFloat16Storage": dtypes.bfloat16, "FloatStorage": dtypes.float32, "IntStorage": dtypes.int32, "LongStorage": dtypes.int64, "_rebuild_tensor_v2": _rebuild_tensor_v2}
   whitelist = {"torch", "collections", "numpy", "_codecs"}  # NOTE: this is not for security, only speed
   class Dummy: pass
   class TorchPickle(pickle.Unpickler):
@@ -6,10 +6,10 @@ from itertools import accumulate, filterfalse
 import operator
 import numpy as np
 from typing import List, Tuple, Callable, Optional, ClassVar, Type, Union, Sequence, cast
-from tinygrad.helpers import ImageDType, argfix, make_pair, getenv, IMAGE, DEBUG, flatten, DType, dtypes
+from tinygrad.helpers import ImageDType, argfix, make_pair, getenv, IMAGE, DEBUG, WINO, INT32_ACC, flatten, DType, dtypes, bf16_to_float, float_to_bf16
 from math import ceil, pi, prod, sqrt, log, cos, copysign
 from tinygrad.lazy import Device, LazyBuffer
-from tinygrad.ops import LoadOps
+from tinygrad.ops import LoadOps, BinaryOps
 
 # An instantiation of the Function is the Context
 class Function:
@@ -29,8 +29,37 @@ class Function:
     if ctx.requires_grad and not Tensor.no_grad: ret._ctx = ctx    # used by autograd engine
     return ret
 
+# the grad of a gather with sparse=True: the rows in values are added to the rows at idx of a tensor of shape
+# NOTE: an index can be in idx more than once, the sparse steps of the optimizers coalesce them
+class SparseGrad:
+  __slots__ = "idx", "values", "shape"
+  def __init__(self, idx:Union[Tensor, LazyBuffer], values:Union[Tensor, LazyBuffer], shape:Tuple[int, ...]):
+    self.idx, self.values = [x if isinstance(x, Tensor) else Tensor(x, device=x.device, requires_grad=False) for x in (idx, values)]
+    self.shape = shape
+
+  @property
+  def device(self) -> str: return self.values.device
+
+  # sparse plus sparse is sparse, sparse plus dense is dense
+  def __add__(self, x:Union[SparseGrad, Tensor]) -> Union[SparseGrad, Tensor]:
+    if isinstance(x, SparseGrad): return SparseGrad(self.idx.cat(x.idx), self.values.cat(x.values), self.shape)
+    return x.index_add(self.idx, self.values)
+
+  def realize(self) -> SparseGrad:
+    for x in (self.idx, self.values): x.realize()
+    return self
+  def dense(self) -> Tensor: return Tensor.zeros(*self.shape, device=self.device, dtype=self.values.dtype).index_add(self.idx, self.values)
+  def numpy(self) -> np.ndarray: return self.dense().numpy()
+
 import tinygrad.mlops as mlops
 
+# Bt, G and At of winograd F(2x2,3x3) and F(4x4,3x3)
+winograd_matrices = {
+  2: ([[1, 0, -1, 0], [0, 1, 1, 0], [0, -1, 1, 0], [0, 1, 0, -1]], [[1, 0, 0], [1/2, 1/2, 1/2], [1/2, -1/2, 1/2], [0, 0, 1]], [[1, 1, 1, 0], [0, 1, -1, -1]]),
+  4: ([[4, 0, -5, 0, 1, 0], [0, -4, -4, 1, 1, 0], [0, 4, -4, -1, 1, 0], [0, -2, -1, 2, 1, 0], [0, 2, -1, -2, 1, 0], [0, 4, 0, -5, 0, 1]],
+      [[1/4, 0, 0], [-1/6, -1/6, -1/6], [-1/6, 1/6, -1/6], [1/24, 1/12, 1/6], [1/24, -1/12, 1/6], [0, 0, 1]],
+      [[1, 1, 1, 1, 1, 0], [0, 1, -1, 2, -2, 0], [0, 1, 1, 4, 4, 0], [0, 1, -1, 8, -8, 1]])}
+
 # **** start with two base classes, Tensor and Function ****
 
 class Tensor:
@@ -55,7 +84,7 @@ class Tensor:
     if data.__class__ is LazyBuffer:
       data = cast(LazyBuffer, data) # NOTE: this is a noop, it makes mypy happy
       assert dtype is None or dtype == data.dtype, "dtype doesn't match, and casting isn't supported"
-      self.lazydata = data if data.device == device else LazyBuffer.loadop(LoadOps.FROM, data.shape, data.dtype, device, src=data)
+      self.lazydata = data if data.device == device else data.copy_to_device(device)
       return
 
     if isinstance(data, (int, float)):
@@ -64,11 +93,11 @@ class Tensor:
 
     if data.__class__ is list:
       assert dtype is None or dtype.np is not None, f"{dtype} doesn't have a numpy dtype"
-      data = np.array(data, dtype=(dtype or Tensor.default_type).np)
+      data = float_to_bf16(np.array(data, dtype=np.float32)) if dtype == dtypes.bfloat16 else np.array(data, dtype=(dtype or Tensor.default_type).np)
 
     if isinstance(data, np.ndarray):
       data = LazyBuffer.fromCPU(data)
-      self.lazydata = data if data.device == device else LazyBuffer.loadop(LoadOps.FROM, data.shape, data.dtype, device, src=data)
+      self.lazydata = data if data.device == device else data.copy_to_device(device)
       return
 
     raise RuntimeError(f"can't create Tensor from {data}")
@@ -98,7 +127,7 @@ class Tensor:
     # TODO: this is a hack for writing to DISK
     if self.device.startswith("DISK"):
       if x.__class__ is not Tensor: x = Tensor(x, device="CPU", dtype=self.dtype)
-      self.lazydata.realize().realized._copyin(x.numpy())  # type: ignore
+      self.lazydata.realize().realized._copyin(x.lazydata.toCPU())  # type: ignore
       return self
     if x.__class__ is not Tensor: x = Tensor(x, device=self.device, dtype=self.dtype)
     assert self.shape == x.shape and self.device == x.device, f"assign shape mismatch {self.shape} != {x.shape} or device mismatch {self.device} != {x.device}"
@@ -109,7 +138,8 @@ class Tensor:
     return self
 
   def detach(self): return Tensor(self.lazydata, device=self.device, requires_grad=False)
-  def numpy(self) -> np.ndarray: return self.lazydata.toCPU()
+  # NOTE: the numpy array of a bfloat16 tensor is float32, lazydata.toCPU() has the bits
+  def numpy(self) -> np.ndarray: return self.lazydata.toCPU() if self.dtype != dtypes.bfloat16 else bf16_to_float(self.lazydata.toCPU())
 
   # TODO: if things are realized this won't work
   def to_(self, device:str):
@@ -217,12 +247,12 @@ class Tensor:
         continue
       assert (t0.grad is not None)
       grads = t0._ctx.backward(t0.grad.lazydata)
-      grads = [Tensor(g, device=self.device, requires_grad=False) if g is not None else None
+      grads = [Tensor(g, device=self.device, requires_grad=False) if isinstance(g, LazyBuffer) else g
         for g in ([grads] if len(t0._ctx.parents) == 1 else grads)]
       for t, g in zip(t0._ctx.parents, grads):
         if g is not None and t.requires_grad:
           assert g.shape == t.shape, f"grad shape must match tensor shape, {g.shape!r} != {t.shape!r}"
-          t.grad = g if t.grad is None else (t.grad + g)
+          t.grad = g if t.grad is None else (g + t.grad if isinstance(g, SparseGrad) else t.grad + g)  # type: ignore
       del t0._ctx
 
   # ***** movement mlops *****
@@ -262,6 +292,8 @@ class Tensor:
   #          is possible.
   #        - Apply Shrink to do the slice [:, 0] on axes of shapes [dim_sz_padded // s, s].
   def __getitem__(self, val):
+    # a Tensor of indices picks rows of the first axis, like numpy
+    if isinstance(val, Tensor): return self.index_select(val)
     def normalize_int(e, i, dim_sz):
       if -dim_sz <= e < dim_sz: return e if e != -1 else dim_sz-1
       raise IndexError(f"index {e} is out of bounds for dimension {i} with size {self.shape[i]}")
@@ -311,6 +343,12 @@ class Tensor:
         final_shape.append(1)
     return sliced_tensor.reshape(tuple(final_shape))  # Reshape
 
+  # the rows of the first axis at the int indices in idx, with sparse=True the grad is a SparseGrad of them
+  def index_select(self, idx:Tensor, sparse=False) -> Tensor: return mlops.Gather.apply(self, idx, sparse=sparse)
+  # the rows at the int indices in idx added to or replaced by the rows of src. these are for the grads and the optimizers, they have no grad
+  def index_add(self, idx:Tensor, src:Tensor) -> Tensor: return Tensor(self.lazydata.scatter(idx.lazydata, src.lazydata, BinaryOps.ADD), device=self.device, requires_grad=False)
+  def index_copy(self, idx:Tensor, src:Tensor) -> Tensor: return Tensor(self.lazydata.scatter(idx.lazydata, src.lazydata), device=self.device, requires_grad=False)
+
   def cat(self, *args, dim=0):
     dim = (dim + len(self.shape)) if dim < 0 else dim
     assert all(len(y.shape) == len(self.shape) and all(y.shape[i] == s for i,s in enumerate(self.shape) if i != dim) for y in args)
@@ -407,33 +445,12 @@ class Tensor:
     assert len(self.shape) >= len(k_), f"can't pool {self.shape} with {k_}"
     s_, d_ = make_pair(stride, len(k_)), make_pair(dilation, len(k_))
     assert len(k_) == len(s_) and len(k_) == len(d_), f"stride/dilation mismatch kernel:{k_} stride:{s_} dilation:{d_}"
-    slc_prefix, prefix, i_ = [(0,x) for x in self.shape[0:-len(k_)]], self.shape[0:-len(k_)], self.shape[-len(k_):]
-    if any(k > s for k,s in zip(k_, s_)) or any(d != 1 for d in d_):
-      o_ = [(i - d * (k-1) - 1)//s + 1 for i,d,k,s in zip(i_, d_, k_, s_)]
-      e_ = [ceil(k*(i+d) / i) for k,i,d in zip(k_, i_, d_)]  # expands such that we don't need padding
-      xup = self.reshape(*prefix, *([1]*len(_insert_dims)), *flatten((1,i) for i in i_)).expand(*prefix, *_insert_dims, *flatten((e,i) for e,i in zip(e_, i_))).reshape(*prefix, *_insert_dims, *[e*i for e,i in zip(e_, i_)])
-      # NOTE: _insert_dims is required because reduces can't be merged (yet)
-      prefix += _insert_dims
-      slc_prefix += [(0,x) for x in _insert_dims]
-      # slide by dilation
-      xup = xup.slice(slc_prefix + [(0,k*(i+d)) for k,i,d in zip(k_, i_, d_)])
-      xup = xup.reshape(*prefix, *flatten((k,i+d) for k,i,d in zip(k_, i_, d_)))
-      xup = xup.slice(slc_prefix + flatten(((0,k), (0,o*s)) for k,o,s in zip(k_, o_, s_)))
-      # handle stride, and permute to move reduce to the end
-      xup = xup.reshape(*prefix, *flatten((k,o,s) for k,o,s in zip(k_, o_, s_)))
-      xup = xup.slice(slc_prefix + flatten(((0,k), (0,o), (0,1)) for k,o in zip(k_, o_)))
-      xup = xup.reshape(*prefix, *flatten((k,o) for k,o in zip(k_, o_)))
-      return xup.permute(*range(len(prefix)), *[len(prefix)+i*2+1 for i in range(len(k_))], *[len(prefix)+i*2 for i in range(len(k_))])
-    # TODO: once the shapetracker can optimize well, remove this alternative implementation. or not if the CPU implementation doesn't use ShapeTracker
-    o_ = [(i+(s-k))//s for i,s,k in zip(i_, s_, k_)]
-    xup = self.slice(slc_prefix + [(0,o*s) for o,s in zip(o_, s_)])
-    xup = xup.reshape(*prefix, *([1]*len(_insert_dims)), *flatten(((o, s) for o,s in zip(o_, s_))))
-    if len(_insert_dims):
-      xup = xup.expand(*prefix, *_insert_dims, *flatten(((o, s) for o,s in zip(o_, s_))))
-      prefix += _insert_dims
-      slc_prefix += [(0,x) for x in _insert_dims]
-    xup = xup.slice(slc_prefix + flatten(((0,o), (0,k)) for o,k in zip(o_, k_)))
-    return xup.permute(*range(len(prefix)), *[len(prefix)+i*2 for i in range(len(k_))], *[len(prefix)+i*2+1 for i in range(len(k_))])
+    # (*prefix, *i_) -> (*prefix, *o_, *k_) in a single overlapping strided view
+    xup = mlops.Window.apply(self, arg=tuple(zip(k_, s_, d_)))
+    if not len(_insert_dims): return xup
+    # NOTE: _insert_dims is required because reduces can't be merged (yet)
+    prefix, ok_ = xup.shape[0:-2*len(k_)], xup.shape[-2*len(k_):]
+    return xup.reshape(*prefix, *([1]*len(_insert_dims)), *ok_).expand(*prefix, *_insert_dims, *ok_)
 
   # NOTE: these work for more than 2D
   def avg_pool2d(self, kernel_size=(2,2), stride=None): return self._pool(make_pair(kernel_size), stride if stride is not None else kernel_size).mean(axis=tuple(range(0-len(make_pair(kernel_size)), 0)))
@@ -457,6 +474,14 @@ class Tensor:
     if isinstance(padding, (tuple,list)): assert len(padding) == 2*len(HW) or len(padding) == len(HW), f"Expected padding of length {2*len(HW)} or {len(HW)}, but got {len(padding)} for tensor of shape {self.shape}"
     padding_ = [padding]*2*len(HW) if isinstance(padding, int) else (padding if len(padding) == 2*len(HW) else [p for p in padding for _ in range(2)][::-1])
 
+    # with WINO=1 the 3x3 stride 1 convs are winograd. with less than 16 input or output channels the transforms cost more than they save
+    if WINO and HW == (3, 3) and make_pair(stride) == (1, 1) and make_pair(dilation) == (1, 1) and min(cin, cout//groups) >= 16: return self._winograd(weight, bias, groups, padding_)
+
+    # depthwise and grouped convs are a window reduce of the input in place, the backward doesn't copy the windows of the grad (see mlops.Conv)
+    if groups > 1 and not dtypes.is_int(self.dtype):
+      ret = mlops.Conv.apply(self.pad2d(padding_), weight, groups=groups, stride=make_pair(stride, len(HW)), dilation=make_pair(dilation, len(HW)))
+      return ret if bias is None else ret.add(bias.reshape(1, -1, *[1] * len(HW)))
+
     # conv2d is a pooling op (with padding)
     x = self.pad2d(padding_)._pool(HW, stride, dilation)   # (bs, groups*cin, oy, ox, H, W)
     rcout, oyx = cout//groups, x.shape[2:-len(HW)]
@@ -469,16 +494,50 @@ class Tensor:
     #x = x.reshape(bs, groups, cin, rcout, oy, ox, H, W).permute(0,1,3,4,5,2,6,7)
 
     # conv! broadcasted to (bs, groups, rcout, *oyx, cin, *HW)
-    ret = (x * weight.reshape(1, groups, rcout, *[1] * len(oyx), cin, *HW)).sum([-1-i for i in range(1+len(oyx))], keepdim=True).reshape(bs, cout, *oyx)
+    x, w = x._widened(weight.reshape(1, groups, rcout, *[1] * len(oyx), cin, *HW))
+    ret = (x * w).sum([-1-i for i in range(1+len(oyx))], keepdim=True).reshape(bs, cout, *oyx)
     return ret if bias is None else ret.add(bias.reshape(1, -1, *[1] * len(HW)))
 
+  # winograd F(mxm,3x3) https://arxiv.org/abs/1509.09308, a (m+2)x(m+2) tile of the input is m x m outputs with (m+2)**2 multiplies per channel
+  # pair instead of 9*m*m. the transforms of the tiles, the weights and the outputs are small reduces with a constant matrix
+  # NOTE: F(4x4,3x3) is 4x fewer multiplies than the direct conv and F(2x2,3x3) is 2.25x, the small outputs use F(2x2,3x3) to waste less padding
+  def _winograd(self, weight:Tensor, bias:Optional[Tensor], groups:int, padding_:List[int]) -> Tensor:
+    bs, (cout,cin) = self.shape[0], weight.shape[:2]
+    oyx = [s + padding_[2*i] + padding_[2*i+1] - 2 for i,s in enumerate(self.shape[:-3:-1])][::-1]
+    m = 4 if min(oyx) >= 8 else 2
+    Bt, G, At = winograd_matrices[m]
+    # mat @ t @ mat.T on the first two axes, one reduce over each of them
+    def apply_matrix(mat, t:Tensor) -> Tensor:
+      n, k, rest = len(mat), len(mat[0]), t.shape[2:]
+      mt = Tensor(mat, device=t.device, requires_grad=False)
+      t = (mt.reshape(n, k, 1, *[1]*len(rest)) * t.reshape(1, k, k, *rest)).sum(1)
+      return (mt.reshape(1, n, k, *[1]*len(rest)) * t.reshape(n, 1, k, *rest)).sum(2)
+    # the input is padded to a whole number of tiles, with the tile moved to the front: (m+2, m+2, bs, cin_, ty, tx)
+    d = self.pad2d(flatten((padding_[2*i], padding_[2*i+1] + (-o) % m) for i,o in enumerate(oyx[::-1])))._pool((m+2, m+2), m).permute(4, 5, 0, 1, 2, 3)
+    ty, tx = d.shape[-2:]
+    # the product of the transformed tiles and weights is summed over cin, like a matmul for each of the (m+2)**2 elements of a tile
+    gfactors = apply_matrix(G, weight.permute(2, 3, 0, 1)).contiguous().reshape(m+2, m+2, 1, groups, cout//groups, cin, 1, 1)
+    dfactors = apply_matrix(Bt, d).contiguous().reshape(m+2, m+2, bs, groups, 1, cin, ty, tx)
+    ret = apply_matrix(At, (gfactors * dfactors).sum(axis=5))   # (m, m, bs, groups, rcout, ty, tx)
+    ret = ret.permute(2, 3, 4, 5, 0, 6, 1).reshape(bs, cout, ty*m, tx*m).shrink(((0, bs), (0, cout), (0, oyx[0]), (0, oyx[1])))
+    return ret if bias is None else ret.add(bias.reshape(1, -1, 1, 1))
+
   def dot(self, w:Tensor) -> Tensor:
     n1, n2 = len(self.shape), len(w.shape)
     assert n1 != 0 and n2 != 0, f"both arguments to matmul need to be at least 1D, but they are {n1}D and {n2}D"
     x = self.reshape(*self.shape[0:-1], *[1]*min(n1-1, n2-1, 1), self.shape[-1])
     w = w.reshape(*w.shape[0:-2], *[1]*min(n1-1, n2-1, 1), *w.shape[-min(n2, 2):]).transpose(-1, -min(n2, 2))
+    x, w = x._widened(w)
     return (x*w).sum(-1)
 
+  # with INT32_ACC=1 int8 and uint8 are multiplied and summed in int32, exact past 2**24 where the float math isn't. the casts are after the expands,
+  # so they fuse into the reduce kernel. NOTE: it's off by default, clang doesn't vectorize the int MACs and it's ~3x slower than the float math
+  def _widened(self, w:Tensor) -> Tuple[Tensor, Tensor]:
+    if not (INT32_ACC and self.dtype in (dtypes.int8, dtypes.uint8) and w.dtype in (dtypes.int8, dtypes.uint8)): return self, w
+    x, w = self.reshape((1,)*(w.ndim-self.ndim)+self.shape), w.reshape((1,)*(self.ndim-w.ndim)+w.shape)
+    shape = tuple(max(a, b) for a,b in zip(x.shape, w.shape))
+    return x.expand(shape).cast(dtypes.int32), w.expand(shape).cast(dtypes.int32)
+
   def cumsum(self, axis=0):
     axis = (axis + self.ndim) if axis < 0 else axis
     x = self.permute(*(i for i in range(self.ndim) if i != axis), axis)
@@ -559,6 +618,11 @@ class Tensor:
   def sub(self, x:Union[Tensor, float], reverse=False) -> Tensor: return self._broadcasted(mlops.Sub, x, reverse) if x.__class__ is Tensor or x or reverse else self
   def mul(self, x:Union[Tensor, float], reverse=False) -> Tensor: return self._broadcasted(mlops.Mul, x, reverse) if x.__class__ is Tensor or x != 1.0 else self
   def div(self, x:Union[Tensor, float], reverse=False) -> Tensor: return self._broadcasted(mlops.Div, x, reverse) if x.__class__ is Tensor or reverse or not x else self.mul(1/x)
+  # NOTE: fmod has the sign of the dividend like C's fmod, mod has the sign of the divisor like python's %
+  def fmod(self, x:Union[Tensor, float], reverse=False) -> Tensor: return self._broadcasted(mlops.Mod, x, reverse)
+  def mod(self, x:Union[Tensor, float], reverse=False) -> Tensor:
+    r, y = self.fmod(x, reverse), self if reverse else x
+    return (r * y < 0).detach().where(r + y, r)
   def pow(self, x:Union[Tensor, float], reverse=False) -> Tensor:
     if x.__class__ is not Tensor and not reverse:
       # simple pow identities
@@ -611,6 +675,7 @@ class Tensor:
   def __mul__(self, x) -> Tensor: return self.mul(x)
   def __pow__(self, x) -> Tensor: return self.pow(x)
   def __truediv__(self, x) -> Tensor: return self.div(x)
+  def __mod__(self, x) -> Tensor: return self.mod(x)
   def __matmul__(self, x) -> Tensor: return self.matmul(x)
 
   def __radd__(self, x) -> Tensor: return self.add(x, True)
@@ -618,6 +683,7 @@ class Tensor:
   def __rmul__(self, x) -> Tensor: return self.mul(x, True)
   def __rpow__(self, x) -> Tensor: return self.pow(x, True)
   def __rtruediv__(self, x) -> Tensor: return self.div(x, True)
+  def __rmod__(self, x) -> Tensor: return self.mod(x, True)
   def __rmatmul__(self, x) -> Tensor: return self.matmul(x, True)
 
   def __iadd__(self, x) -> Tensor: return self.assign(self.add(x))